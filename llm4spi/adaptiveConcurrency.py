@@ -0,0 +1,174 @@
+#
+# An adaptive controller for the requests sent to LLM providers. It bounds the number of
+# requests in flight, and adapts that bound AIMD-style (additive increase, multiplicative
+# decrease), like TCP congestion control:
+#
+#   * every successful request raises the bound a little (by about one per 'window' of
+#     requests);
+#   * a request that is throttled by the provider (429, 503, 529) halves the bound;
+#   * a request that fails transiently (e.g. a 5xx or a timeout) lowers it a little.
+#
+# The latency of a request is not used as a signal: the latency of an LLM grows with the
+# length of its answer, so a slow request is usually just a long answer.
+#
+# Throttled and transiently failing requests are retried, after the delay the provider asks
+# for in its Retry-After header if any, or else after a jittered exponential backoff.
+# So the throughput converges to what the provider can actually handle, without tuning
+# sleeps or concurrency per model. The SDK clients should then not retry by themselves (see
+# TransportFactory), else the controller only sees the throttling once the SDK gives up.
+# A controller whose minLimit and maxLimit are the same does not adapt, and only retries.
+#
+import threading
+import random
+import time
+import email.utils
+
+# statuses meaning the provider is overloaded or throttling us:
+THROTTLE_STATUSES = { 429, 503, 529 }
+# other statuses worth retrying:
+TRANSIENT_STATUSES = { 408, 500, 502, 504 }
+
+def error_status(e:Exception) -> int :
+    """
+    Return the HTTP status of an error raised by a provider SDK, or None if unknown.
+    """
+    for attr in [ "status_code", "code", "status" ]:
+        status = getattr(e, attr, None)
+        if isinstance(status,int): return status
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    if isinstance(status,int): return status
+    return None
+
+def is_transient_connection_error(e:Exception) -> bool :
+    name = type(e).__name__
+    return "Timeout" in name or "Connection" in name
+
+def retry_after(e:Exception) -> float :
+    """
+    Return the delay (in seconds) the provider asks for in the Retry-After header of the
+    response that caused the error, or None if there is none.
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers == None: return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value != None: return float(value) / 1000
+        value = headers.get("retry-after")
+        if value == None: return None
+        try:
+            return float(value)
+        except ValueError:
+            # it can also be an http-date:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class AdaptiveController:
+    """
+    Bound and adapt the number of requests in flight; retry throttled requests.
+    """
+    def __init__(self, initialLimit:int=4, maxLimit:int=64, minLimit:int=1,
+                 maxRetries:int=8, baseDelay:float=1, maxDelay:float=120):
+        self.limit = float(initialLimit)
+        self.maxLimit = maxLimit
+        self.minLimit = minLimit
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.inflight = 0
+        self.lock = threading.Condition()
+        # statistics:
+        self.numOfRequests = 0
+        self.numOfThrottled = 0
+        self.numOfRetries = 0
+        self.DEBUG = False
+
+    def enter(self):
+        with self.lock:
+            while self.inflight >= int(self.limit):
+                self.lock.wait()
+            self.inflight += 1
+
+    def tryEnter(self) -> bool :
+        """
+        Enter the bound if there is room right away (e.g. for a hedged duplicate, which should
+        not wait); returns whether it did.
+        """
+        with self.lock:
+            if self.inflight >= int(self.limit): return False
+            self.inflight += 1
+            return True
+
+    def exit(self):
+        with self.lock:
+            self.inflight -= 1
+            self.lock.notify_all()
+
+    def onSuccess(self):
+        with self.lock:
+            self.numOfRequests += 1
+            self.limit = min(self.maxLimit, self.limit + 1/self.limit)
+            self.lock.notify_all()
+
+    def onTransientError(self):
+        with self.lock:
+            self.limit = max(self.minLimit, self.limit * 0.9)
+
+    def onThrottled(self):
+        with self.lock:
+            self.numOfThrottled += 1
+            self.limit = max(self.minLimit, self.limit / 2)
+            if self.DEBUG: print(f">>> throttled by the provider; max in flight now {int(self.limit)}")
+
+    def onError(self, e:Exception) -> bool :
+        """
+        Adapt the bound to a failed request; returns whether the request is worth retrying.
+        """
+        status = error_status(e)
+        if status in THROTTLE_STATUSES:
+            self.onThrottled()
+            return True
+        if status in TRANSIENT_STATUSES or (status == None and is_transient_connection_error(e)):
+            self.onTransientError()
+            return True
+        return False
+
+    def call(self, fn, beforeEachAttempt=None):
+        """
+        Return fn(), calling it within the in-flight bound, and retrying it if it fails
+        with a throttling or transient error. If given, beforeEachAttempt() is called
+        before each attempt, before waiting for the bound (e.g. to take a rate-limit budget).
+        """
+        attempt = 0
+        while True:
+            if beforeEachAttempt != None: beforeEachAttempt()
+            self.enter()
+            try:
+                result = fn()
+            except Exception as e:
+                self.exit()
+                if not self.onError(e) or attempt >= self.maxRetries:
+                    raise
+                delay = retry_after(e)
+                if delay == None:
+                    # full jitter:
+                    delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2**attempt))
+                if self.DEBUG: print(f">>> request failed ({error_status(e)}: {e}); retrying in {delay:.1f}s")
+                with self.lock: self.numOfRetries += 1
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.exit()
+            self.onSuccess()
+            return result
+
+    def stats(self) -> dict :
+        return {
+            "requests" : self.numOfRequests,
+            "throttled" : self.numOfThrottled,
+            "retries" : self.numOfRetries,
+            "max in flight" : int(self.limit)
+        }
@@ -5,7 +5,8 @@ import anthropic
 import os
 import time
 
-from openai4spi import PromptResponder, generate_results
+from openai4spi import PromptResponder, mark_truncated, generate_results
+from transport import TransportFactory
 
 
 
@@ -20,22 +21,39 @@ class MyAnthorpicClient(PromptResponder):
         PromptResponder.__init__(self)
         self.client = client
         self.model = modelId
+        # a fixed pause after every prompt; setting a rateLimiter is usually better
         self.sleepTime = None
+        self.maxParallelAnswers = 4
     
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str]:
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
-        answers = []
-        for k in range(multipleAnswer):
-            msg = self.client.messages.create(
-                max_tokens=1024,
-                temperature=0.7,
-                messages=[ {"role": "user", "content": prompt }],
-                model = self.model
-            )
-            A = msg.content[0].text
-            answers.append(A)
+        request = {
+            "max_tokens" : 1024 if maxTokens == None else maxTokens,
+            "temperature" : 0.7,
+            "messages" : [ {"role": "user", "content": prompt }],
+            "model" : self.model
+        }
+        def streamIt():
+            # a copy per call, as the answers are asked from several threads:
+            streamRequest = dict(request)
+            stops = self.stopSequencesFor(prompt)
+            if stops != None: streamRequest["stop_sequences"] = stops
+            with self.client.messages.stream(**streamRequest) as stream:
+                A = self.readStream(stream.text_stream, prompt)
+                # the stop reason is only known if the whole stream was read:
+                return mark_truncated(A, stream.current_message_snapshot.stop_reason == "max_tokens")
+        def ask(k):
+            if self.streaming:
+                A = self.send(streamIt, prompt)
+            else:
+                msg = self.send(lambda: self.client.messages.create(**request),
+                                prompt, usage = lambda msg: msg.usage.input_tokens + msg.usage.output_tokens)
+                A = mark_truncated(msg.content[0].text, msg.stop_reason == "max_tokens")
             if self.DEBUG: 
                 print(f">>> raw response {k}:\n {A}")
+            return A
+        # the answers are asked concurrently, up to maxParallelAnswers at a time:
+        answers = self.fanOut(multipleAnswer, ask)
         if self.sleepTime != None and self.sleepTime > 0 :
             if self.DEBUG: 
                 print(f">>> SLEEPING {self.sleepTime}s ...")
@@ -45,12 +63,14 @@ class MyAnthorpicClient(PromptResponder):
 
 if __name__ == '__main__':
     anthropic_api_key = os.environ.get('ANTHROPIC_API_KEY') 
-    underlying_client = Anthropic(api_key = anthropic_api_key)
+    transport = TransportFactory()
+    underlying_client = transport.anthropic(api_key = anthropic_api_key)
 
     # modelId = "claude-3-5-sonnet-latest"
     modelId = "claude-3-haiku-20240307"  #cheapest
     
     myAIclient = MyAnthorpicClient(underlying_client,modelId)
+    myAIclient.transport = transport
     myAIclient.DEBUG = True
     myAIclient.sleepTime = 20
 
@@ -18,6 +18,8 @@
 #
 from typing import Dict
 import textwrap
+import hashlib
+import json
 import data
 from collections import Counter
 import time
@@ -131,6 +133,58 @@ def listSplit(s:list, sep):
     segments.append(z)
     return segments
 
+def task_content_hash(task: Dict, condition: str) -> str:
+    """
+    Return a hash of the parts of the task that determine the outcome of evaluating
+    its pre- or post-condition: the header, the reference solution, and the tests.
+    If none of these change, evaluating the same candidates gives the same results.
+    """
+    content = [ task.get(f"{condition}_condition_incomplete"),
+                task.get(f"{condition}_condition_solution"),
+                task.get(f"{condition}_condition_tests") ]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+def reuse_task_result(task: Dict, condition: str, previous: Dict) -> bool:
+    """
+    Copy the evaluation results of the task's pre- or post-condition from a previous
+    result-record of the same task, if that record was produced on the same task content
+    (see task_content_hash) and on the same candidates. Return True if the results
+    are reused, and False otherwise.
+    """
+    if previous == None : return False
+    if previous.get(f"{condition}_condition_hash") != task_content_hash(task,condition) : return False
+    if previous.get(f"{condition}_condition_completions") != task[f"{condition}_condition_completions"] : return False
+    task[f"{condition}_condition_hash"] = previous[f"{condition}_condition_hash"]
+    task[f"{condition}_condition_reference_TestResults"]  = previous[f"{condition}_condition_reference_TestResults"]
+    task[f"{condition}_condition_candidates_TestResults"] = previous[f"{condition}_condition_candidates_TestResults"]
+    task[f"{condition}_condition_ResultsSummary"] = previous[f"{condition}_condition_ResultsSummary"]
+    return True
+
+def load_test_suites(tests: str) -> tuple :
+    """
+    Parse the string containing the test-cases of a pre- or post-condition, and return
+    them as a triple of test suites: base0, base1, and validation.
+    """
+    # if the test-cases are marked with a split token, this indicates that
+    # they consists of two groups: base-group and validation-group.
+    # We separate them:
+    splitToken = '==='
+    test_cases0 = eval(tests)
+    test_suites = listSplit(test_cases0,splitToken)
+    suite_Base0 = test_suites[0]
+    suite_Base1 = []
+    suite_Validation = []
+    if len(test_suites) == 2:
+       suite_Validation = test_suites[1]
+    elif len(test_suites) > 2: 
+        suite_Base1 = test_suites[1]
+        for suite in test_suites[2:] : suite_Validation.extend(suite)
+    else:
+        # should not happen... but if this does happen,
+        # then we simply have no validation suite
+        suite_Validation = []
+    return (suite_Base0, suite_Base1, suite_Validation)
+
 def evaluate_task_result(task: Dict, condition: str):
     """
     Given a single task T, described as a dictionary. This dictionary
@@ -151,20 +205,40 @@ def evaluate_task_result(task: Dict, condition: str):
     The collected results are added/updated as entries into the dictionary that
     represents the task (by side effect on the dictionary).
     """
+    job = prepare_task_evaluation(task, condition)
+    if job == None:
+        return
+    # now, evaliate each candidate-completion:
+    tasks_results = [ evaluate_candidate(job, job["suites"], job["reference"], k, body)
+                      for (k,body) in enumerate(task[f"{condition}_condition_completions"]) ]
+    summarize_task_result(task, condition, tasks_results)
+
+def prepare_task_evaluation(task: Dict, condition: str) -> Dict :
+    """
+    The first step of evaluate_task_result. It resets the evaluation entries of the task's
+    pre- or post-condition, then loads its test suites and runs them on the reference solution.
+
+    Returns None if the task has no such condition (or its solution cannot be loaded).
+    Else it returns a dictionary (a 'job') containing what is needed to evaluate the candidates,
+    each with evaluate_candidate: the task-id, the condition-type, the function header, 
+    the reference solution, the test suites (a triple base0, base1, validation), and the
+    reference results on those suites (also a triple).
+    """
     Tid = task["task_id"]
     print(f"** Start collecting raw results for Task {Tid}, {condition}-condition")
 
     task[f"{condition}_condition_reference_TestResults"]  = None
     task[f"{condition}_condition_candidates_TestResults"] = None
     task[f"{condition}_condition_ResultsSummary"] = None
+    task[f"{condition}_condition_hash"] = task_content_hash(task,condition)
 
     # we first handle the case when the task pre- or post-condition
     # does not exists:
     if not (f"{condition}_condition_solution" in task) : 
-        return
+        return None
     solution_function = task[f"{condition}_condition_solution"]
     if solution_function==None or solution_function=="":
-        return
+        return None
     
     # The task pre-/post- exists, we proceed. First we will execute the test suites on
     # the solution pre/post-cond
@@ -176,26 +250,9 @@ def evaluate_task_result(task: Dict, condition: str):
     except:
         print(">>>>>> Ouch. The def of the solution function CRASHED!")
         print(solution_function)
-        return
+        return None
 
-    # if the test-cases are marked with a split token, this indicates that
-    # they consists of two groups: base-group and validation-group.
-    # We separate them:
-    splitToken = '==='
-    test_cases0 = eval(task[f"{condition}_condition_tests"])
-    test_suites = listSplit(test_cases0,splitToken)
-    suite_Base0 = test_suites[0]
-    suite_Base1 = []
-    suite_Validation = []
-    if len(test_suites) == 2:
-       suite_Validation = test_suites[1]
-    elif len(test_suites) > 2: 
-        suite_Base1 = test_suites[1]
-        for suite in test_suites[2:] : suite_Validation.extend(suite)
-    else:
-        # should not happen... but if this does happen,
-        # then we simply have no validation suite
-        suite_Validation = []
+    (suite_Base0, suite_Base1, suite_Validation) = load_test_suites(task[f"{condition}_condition_tests"])
 
     # executing the test-cases on the solution-function, also not expecting these
     # to fail:
@@ -215,60 +272,79 @@ def evaluate_task_result(task: Dict, condition: str):
         print("   Reference tests results:")
         print(f"  {R}")
 
-    #
-    # Now we run the tests on each of the candidates from the AI:
-    #
+    return {
+        "task_id" : Tid,
+        "condition" : condition,
+        "header" : task[f"{condition}_condition_incomplete"],
+        "solution" : solution_function,
+        "suites" : (suite_Base0, suite_Base1, suite_Validation),
+        "reference" : (reference_results_Base0, reference_results_Base1, reference_results_Validation)
+    }
+
+def evaluate_candidate(job: Dict, suites: tuple, reference: tuple, k: int, body: str) -> Dict :
+    """
+    Run the test suites of a job (see prepare_task_evaluation) on the k-th candidate
+    pre-/post-condition proposed by the AI, whose function body is given. The suites
+    and the reference results are passed separately from the job, so that callers can
+    load them by other means than through the job itself (e.g. from shared memory).
 
-    # get all the AI-completions, indent each one of them as well:
-    AI_completions = [ textwrap.indent(body,'    ') if body != None else '' for body in task[f"{condition}_condition_completions"] ]
-    # now, evaliate each candidate-completion:
-    tasks_results = [] 
+    Returns a dictionary with the test results and verdicts of the candidate.
+    """
+    Tid = job["task_id"]
+    condition = job["condition"]
+    (suite_Base0, suite_Base1, suite_Validation) = suites
+    (reference_results_Base0, reference_results_Base1, reference_results_Validation) = reference
 
-    for k in range(len(AI_completions)):
-        indented_function_body = AI_completions[k]
-        complete_function = task[f"{condition}_condition_incomplete"] + "\n" + indented_function_body
-        dummy_function = task[f"{condition}_condition_incomplete"] + "\n   raise(\"dummy function invoked!\")"
+    # indent the AI-completion:
+    indented_function_body = textwrap.indent(body,'    ') if body != None else ''
+    complete_function = job["header"] + "\n" + indented_function_body
+    dummy_function = job["header"] + "\n   raise(\"dummy function invoked!\")"
 
-        U = { "nr" : k }
-        tasks_results.append(U)
-    
-        # executing the def. of the AI's function; it may fail (e.g. if AI's code is not even syntax correct)
-        try:
-            exec(dummy_function,globals())
-            exec(complete_function,globals())
-            U["def-loaded"] = "success"
-        except:
-            print(f">>>>>> The def of completion-proposal {k} crashed!")
-            print(f">>>>>> src:\n {complete_function}")
-            U["def-loaded"] = "failed"
-            continue
+    U = { "nr" : k }
     
-        print(f"      Running tests on candidate {k}")
-
-        # running the test-cases on the AI's function; this may fail too:
-        results_Base0 = [try_check_condition(test_case, task["task_id"],condition) for test_case in suite_Base0]
-        results_Base1 = [try_check_condition(test_case, task["task_id"],condition) for test_case in suite_Base1]
-        results_Validation = [try_check_condition(test_case, task["task_id"],condition) for test_case in suite_Validation]
-
-        U["base0"] =  results_Base0
-        U["base1"] =  results_Base1
-        U["validationSuite"] =  results_Validation
-        U["base0-verdict"] = compare_results(reference_results_Base0, results_Base0)
-        U["allBases-verdict"] = compare_results(
-                                        reference_results_Base0 + reference_results_Base1, 
-                                        results_Base0 + results_Base1)
-        U["validation-verdict"] = compare_results(reference_results_Validation, results_Validation)
-        U["allsuites-verdict"] = compare_results(
-                                        reference_results_Base0 + reference_results_Base1 + reference_results_Validation, 
-                                        results_Base0 + results_Base1 + results_Validation)
-        U["editDistance"] = similarity.levenshteinDistance(solution_function,complete_function)["relativeDistance"]
-
-        if DEBUG:
-            print(f"   Candidate {k}:")
-            print(complete_function)
-            print(f"   Candidate {k} tests results:")
-            print(f"  {R}")
+    # executing the def. of the AI's function; it may fail (e.g. if AI's code is not even syntax correct)
+    try:
+        exec(dummy_function,globals())
+        exec(complete_function,globals())
+        U["def-loaded"] = "success"
+    except:
+        print(f">>>>>> The def of completion-proposal {k} crashed!")
+        print(f">>>>>> src:\n {complete_function}")
+        U["def-loaded"] = "failed"
+        return U
     
+    print(f"      Running tests on candidate {k}")
+
+    # running the test-cases on the AI's function; this may fail too:
+    results_Base0 = [try_check_condition(test_case, Tid, condition) for test_case in suite_Base0]
+    results_Base1 = [try_check_condition(test_case, Tid, condition) for test_case in suite_Base1]
+    results_Validation = [try_check_condition(test_case, Tid, condition) for test_case in suite_Validation]
+
+    U["base0"] =  results_Base0
+    U["base1"] =  results_Base1
+    U["validationSuite"] =  results_Validation
+    U["base0-verdict"] = compare_results(reference_results_Base0, results_Base0)
+    U["allBases-verdict"] = compare_results(
+                                    reference_results_Base0 + reference_results_Base1, 
+                                    results_Base0 + results_Base1)
+    U["validation-verdict"] = compare_results(reference_results_Validation, results_Validation)
+    U["allsuites-verdict"] = compare_results(
+                                    reference_results_Base0 + reference_results_Base1 + reference_results_Validation, 
+                                    results_Base0 + results_Base1 + results_Validation)
+    U["editDistance"] = similarity.levenshteinDistance(job["solution"],complete_function)["relativeDistance"]
+
+    if DEBUG:
+        print(f"   Candidate {k}:")
+        print(complete_function)
+        print(f"   Candidate {k} tests results:")
+        print(f"  {U}")
+    return U
+
+def summarize_task_result(task: Dict, condition: str, tasks_results: list[Dict]):
+    """
+    The last step of evaluate_task_result. Add the results of evaluating the candidates 
+    of the task's pre- or post-condition into the task, along with a summary of them.
+    """
     task[f"{condition}_condition_candidates_TestResults"] = tasks_results
     nonCrashes = [ V for V in tasks_results if V["def-loaded"] == "success" ]
     defCrashes = len(tasks_results) - len(nonCrashes)
@@ -469,21 +545,55 @@ def write_perTask_summaries(tasks: Dict[str,Dict], reportfile_basename:str):
             worker(tId,task,"pre")
             worker(tId,task,"post")
 
-def evaluate_tasks_results(tasks: Dict[str,Dict], reportfile_basename:str)  :
+def evaluate_tasks_results(tasks: Dict[str,Dict], reportfile_basename:str, previousResults: Dict[str,Dict]=None,
+                           workers:int=1, coordinator:str=None, onResult=None)  :
     """
     Run the basic evaluation for all the tasks. This iterates over the tasks, and performs
     basic evaluation on each of then.
 
+    If previousResults is given, it maps task-ids to result-records of a previous evaluation
+    (as stored in a results/*_all_*.json file). The stored results of a pre-/post-condition
+    are then reused, rather than recomputed, if its header, reference solution, tests,
+    and candidates are unchanged since (see reuse_task_result).
+
+    If workers is more than one, the candidates are evaluated by a pool of that many
+    worker processes (see parallelEvaluate.py). If a coordinator address (host:port) is
+    given, the candidates are instead sent to worker daemons that connect to that
+    address (see distEvaluate.py); workers then is the number of daemons to also start
+    on this machine, if more than one.
+
+    If onResult is given, onResult(task,condition) is called each time the evaluation of
+    a pre-/post-condition of a task is complete (e.g. to checkpoint it).
+
     The collected data and the evaluation data per task is inserted into each task-dictionary.
     Additionally this function will print and save summaries. One summary for the whole
     dataset will be produced, and a csv-file containing per-task-summaries is also produced.
     """
+    numOfReused = 0
+    todo = []
     for tID in tasks:
         T = tasks[tID]
-        evaluate_task_result(T, "pre")
-        evaluate_task_result(T, "post")
+        previous = None if previousResults == None else previousResults.get(tID)
+        for condition in ["pre","post"]:
+            if reuse_task_result(T, condition, previous):
+                numOfReused = numOfReused + 1
+            else:
+                todo.append((tID,condition))
+    if previousResults != None:
+        print(f"** Reused the previous results of {numOfReused} pre-/post-conditions")
+    if coordinator != None:
+        import distEvaluate
+        (host,port) = distEvaluate.parse_address(coordinator)
+        distEvaluate.evaluate_tasks_distributed(tasks, todo, host, port, localWorkers = workers if workers > 1 else 0,
+                                                onResult=onResult)
+    elif workers > 1:
+        import parallelEvaluate
+        parallelEvaluate.evaluate_tasks_parallel(tasks, todo, workers, onResult)
+    else:
+        for (tID,condition) in todo:
+            evaluate_task_result(tasks[tID], condition)
+            if onResult != None: onResult(tasks[tID], condition)
     summaries = mk_results_summary(tasks)
     write_perTask_summaries(tasks,reportfile_basename)
     write_wholeSet_summary(summaries[0],summaries[1],reportfile_basename)
     
-
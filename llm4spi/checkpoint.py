@@ -0,0 +1,138 @@
+#
+# Checkpointing of a benchmark run (see generate_results), so that a run that crashed or was
+# interrupted can be resumed without asking the AI again the answers it already gave, nor
+# re-evaluating what was already evaluated.
+#
+# The checkpoint is a json-lines file results/<experiment>_checkpoint_<prompt-type>.jsonl. Its
+# first line describes the run (the provider, the model, the prompt type...), which must be
+# the same to resume it; each next line is appended as soon as the answers to a pre-/post-
+# condition are in, and as soon as they have been evaluated. Every line is flushed to the OS
+# right away, so it survives the crash of the run; it is synced to the disk at most every
+# SYNC_INTERVAL seconds (and when the checkpoint is closed), as syncing every line slows a
+# run with many quick answers down. If the run is interrupted while a line is being written,
+# that last line is ignored on resume.
+#
+# A run that is not resumed does not overwrite the checkpoint of an earlier interrupted run
+# of the same name; that one is kept aside, as <checkpoint>.<n>.
+#
+from typing import Dict
+import threading
+import json
+import time
+import os
+
+# the maximum time (in seconds) a written line may wait to be synced to the disk:
+SYNC_INTERVAL = 2
+
+def checkpoint_filename(experimentName:str, prompt_type:str) -> str :
+    return f"results/{experimentName}_checkpoint_{prompt_type}.jsonl"
+
+class Checkpoint:
+    """
+    The checkpoint of a run. If resume is true, the progress stored in an existing checkpoint
+    file is loaded; else the file is started anew.
+    """
+    def __init__(self, path:str, runInfo:Dict, resume:bool=False):
+        self.path = path
+        self.lock = threading.Lock()
+        # stored records, by (task-id,condition-type):
+        self.completions = {}
+        self.evaluations = {}
+        self.lastSync = time.monotonic()
+        if resume and os.path.exists(path):
+            self.load(runInfo)
+            self.file = open(path, "a")
+        else:
+            if resume: print(f">>> No checkpoint {path} to resume from; starting anew.")
+            if os.path.exists(path): self.keepAside()
+            self.file = open(path, "w")
+            self.write(runInfo)
+
+    def keepAside(self):
+        """
+        Rename the existing checkpoint file, of an earlier run that is not resumed.
+        """
+        n = 1
+        while os.path.exists(f"{self.path}.{n}"): n += 1
+        os.rename(self.path, f"{self.path}.{n}")
+        print(f">>> A checkpoint of an earlier run was there; it is kept as {self.path}.{n}. Use resume to continue that run instead.")
+
+    def load(self, runInfo:Dict):
+        with open(self.path, "r") as F:
+            lines = F.read().split("\n")
+        records = []
+        for line in lines:
+            if line.strip() == "": continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a line cut off by an interruption:
+                continue
+        if len(records) == 0 or records[0] != runInfo:
+            raise Exception(f"The checkpoint {self.path} is of a run with other settings: {records[0] if len(records)>0 else None}")
+        for R in records[1:]:
+            key = (R["task_id"], R["condition"])
+            if R["stage"] == "completions":
+                self.completions[key] = R
+            else:
+                self.evaluations[key] = R
+        print(f"** Resuming from {self.path}: {len(self.completions)} answered and {len(self.evaluations)} evaluated pre-/post-conditions")
+
+    def write(self, record:Dict):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            now = time.monotonic()
+            if now - self.lastSync >= SYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.lastSync = now
+
+    def restoreCompletions(self, task:Dict, condType:str, prompt:str) -> bool :
+        """
+        If the checkpoint has the answers to the given prompt for the task's pre- or
+        post-condition, put them back into the task, and return true.
+        """
+        R = self.completions.get((task["task_id"],condType))
+        if R == None or R["prompt"] != prompt: return False
+        task[condType + "_condition_raw_responses"] = R["raw_responses"]
+        task[condType + "_condition_completions"] = R["completions"]
+        return True
+
+    def saveCompletions(self, task:Dict, condType:str):
+        R = {
+            "task_id" : task["task_id"],
+            "condition" : condType,
+            "stage" : "completions",
+            "prompt" : task[condType + "_condition_prompt"],
+            "raw_responses" : task[condType + "_condition_raw_responses"],
+            "completions" : task[condType + "_condition_completions"]
+        }
+        self.completions[(R["task_id"],condType)] = R
+        self.write(R)
+
+    def saveEvaluation(self, task:Dict, condType:str):
+        R = { "task_id" : task["task_id"], "condition" : condType, "stage" : "evaluation" }
+        for field in ["hash", "completions", "reference_TestResults", "candidates_TestResults", "ResultsSummary"]:
+            R[field] = task[f"{condType}_condition_{field}"]
+        self.evaluations[(R["task_id"],condType)] = R
+        self.write(R)
+
+    def previousResults(self) -> Dict[str,Dict] :
+        """
+        The stored evaluations, as result-records by task-id, to be reused by the
+        evaluation (see basicEvaluate.reuse_task_result).
+        """
+        results = {}
+        for ((Tid,condType),R) in self.evaluations.items():
+            record = results.setdefault(Tid, { "task_id" : Tid })
+            for field in ["hash", "completions", "reference_TestResults", "candidates_TestResults", "ResultsSummary"]:
+                record[f"{condType}_condition_{field}"] = R[field]
+        return results
+
+    def close(self):
+        with self.lock:
+            if self.file.closed: return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
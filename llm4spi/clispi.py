@@ -4,8 +4,9 @@
 import sys, getopt
 import os
 import time
-from openai4spi import PromptResponder, generate_results, MyOpenAIClient
-from llm4spi import MyGPT4ALL_Client
+from openai4spi import PromptResponder, generate_results, MyOpenAIClient, rescore_results, rescore_results_dir
+from mergeResults import merge_results, merge_results_dir
+from llm4spi import MyGPT4ALL_Client, MyGPT4ALL_DaemonClient
 from groq4spi import MyGroqClient
 from anth4spi import MyAnthorpicClient
 from openai import OpenAI
@@ -14,7 +15,15 @@ from gpt4all import GPT4All
 from google import genai
 from google4spi import GoogleResponder
 from llama_cpp import Llama
-from llamacpp4spi import LLAMAcppClient
+from llamacpp4spi import LLAMAcppClient, BatchingServer, LLAMAcppBatchingClient, LLAMAcppDaemonClient
+from localPool import LocalPoolResponder
+from localDaemon import DEFAULT_SOCKET
+from transport import TransportFactory, DEFAULT_MAX_CONNECTIONS, DEFAULT_TIMEOUT
+from rateLimiter import RateLimiter
+from adaptiveConcurrency import AdaptiveController
+from responseCache import ResponseCache, CachingResponder
+from hedging import HedgingPolicy
+from recordReplay import RecordingResponder, ReplayResponder
 
 DEBUG = True
 
@@ -32,17 +41,46 @@ options = [
    ("benchmark", "The name of the benchmark-file to target, e.g. simplespecs.json. Mandatory."),
    ("prompt_type", "Specify the type of prompt to use. If not present, then usePrgDesc is used."),
    ("specificProblem", "If present specifies a single problem to test."),
+   ("select", "If present selects the problems to test: a comma-separated list of ids, re:<regex>, or sample:<n>:<seed>. Several can be combined with ';'."),
+   ("shard", "If present (i/N), only the i-th of N shards of the benchmark is tested. The shard is added to the experiment name."),
+   ("merge", "A folder, or a comma-separated list, of results/*_all_*.json files of shards to merge into one report. The provider and model are then not needed."),
    ("experimentName",  "The name of the experiment. Reports will be produced prefixed with this name."),
    ("enableEvaluation", "If present will enable or disable evaluation. If not present, evaluation is enabled."),
    ("allowMultipleAnswers", "If present specifies how many answers per problem are requested. If not present it is 1."),
+   ("concurrency", "If present specifies how many prompts can be sent to the LLM at the same time. If not present it is 1."),
+   ("batch", "If present specifies how many prompts (of different tasks) are packed in a single request. If not present it is 1."),
+   ("rescore", "A results/*_all_*.json file, or a folder of such files, to re-evaluate against the benchmark without querying any LLM. The provider and model are then not needed."),
+   ("incremental", "If present with --rescore, only the problems whose solution, tests, or header have changed since the previous run are re-evaluated."),
+   ("evaluationWorkers", "If present specifies the number of processes used to run the evaluation. If not present it is 1."),
+   ("evaluationCoordinator", "If present (host:port), the evaluation is distributed over worker daemons (see distEvaluate.py) connecting to this address. With --evaluationWorkers, that many daemons are also started locally."),
    ("gpt4all_localModelPath", "If a local GPT4ALL model is used, this point to the folder where GPT4AALL models are placed. Default is ../../models"),
    ("gpt4all_device", "If a local GPT4ALL model is used, this specifies to use cpu or gpu-id for running the model. if not specified, cpu is used."),
+   ("rpm", "Maximum requests per minute sent to the LLM provider. If none of rpm, tpm, and rpd is present, the provider client's own defaults are used."),
+   ("tpm", "Maximum tokens per minute sent to the LLM provider."),
+   ("rpd", "Maximum requests per day sent to the LLM provider."),
+   ("adaptive", "If present, the requests in flight are adapted to the provider's capacity, up to the given maximum, and throttled requests are retried. Combine it with --concurrency."),
+   ("stream", "If present, answers are streamed, and cut off as soon as they contain a complete code block. Only for the openAI, groq, anthropic, and gemini providers."),
+   ("answer_budget", "If present, the answers to each prompt get a maximum number of tokens estimated from its task, and truncated answers are asked again with twice the maximum (not for reasoning models). If not present, the provider client's default maximum is used."),
+   ("hedge", "If present, a request slower than the given percentile (e.g. 95) of the recent latencies is duplicated, and the first answer is used."),
+   ("cache", "If present specifies an sqlite file where the answers of the LLM are cached, so that re-running the same prompts does not ask them again."),
+   ("cache_mode", "readthrough, refresh, or offline (only use cached answers). If not present it is readthrough."),
+   ("cache_size", "If present specifies the maximum size of the cache, in MB; the least recently used answers are then evicted."),
+   ("record", "If present specifies a file (.jsonl.gz) where the prompts of the run and their answers are recorded, to replay them later."),
+   ("replay", "A recording, a results/*_all_*.json file, or a folder of these, or a comma-separated list of them, whose answers are replayed instead of asking an LLM. The provider is then not needed."),
+   ("replay_latency", "If present with --replay, each replayed request takes this many seconds, or as long as it took when recorded if the value is 'recorded'."),
+   ("resume", "If present, resume the interrupted run with the given experiment name, reusing the answers and evaluations in its checkpoint (in /results)."),
+   ("http_pool", f"The maximum number of connections to the provider (for the openAI, groq, anthropic, and gemini providers). Default is {DEFAULT_MAX_CONNECTIONS}."),
+   ("base_url", "If present, the URL of the OpenAI-compatible API used by the openAI and groq providers, e.g. that of a fakeOpenAIServer.py."),
+   ("http_timeout", f"The time (in sec) a request to the provider may take. Default is {DEFAULT_TIMEOUT}."),
    ("anthropic_sleep", "Sleep (in sec) added at the end of each problem for Anthropic models. If not present it is 0."),
 
    ("gemini_rpm", "Request per minute for Google Gemini models."),
    ("gemini_tpm", "Tokens per minute for Google Gemini models."),
    ("gemini_rpd", "Request per day for Google Gemini models."),
-   ("llamacpp_localModelPath", "Path to the folder containing gguf models that can be loaded by llama.cpp.")
+   ("llamacpp_localModelPath", "Path to the folder containing gguf models that can be loaded by llama.cpp."),
+   ("local_workers", "If present, for the gpt4all and llamacpp providers, the model runs in this many processes, each pinned to its own cores. Combine it with --concurrency."),
+   ("local_daemon", "If present, for the gpt4all and llamacpp providers, the model is kept loaded across runs by the daemon (see localDaemon.py) on this Unix socket, or on its default socket if the value is 'default'. The daemon is started if it is not running."),
+   ("llamacpp_slots", "If present, the llama.cpp model generates up to this many answers together, of different prompts too (continuous batching). Combine it with --concurrency.")
 ]
 
 helptxt = "python clispi.py [--option=arg]*\n"
@@ -59,15 +97,44 @@ def main(argv):
    experimentName_ = None
    prompt_type_ = "usePrgDesc"
    specificProblem_ = None
+   select_ = None
+   shard_ = None
+   merge_ = None
    enableEvaluation_ = True
    allowMultipleAnswers_ = 1
    anthropic_sleep_ = None
    gpt4all_localModelPath_ = os.path.join(ROOT, "..", "..", "models") 
    gpt4all_device_ = "cpu"
+   rpm_ = None
+   tpm_ = None
+   rpd_ = None
+   adaptive_ = None
+   stream_ = False
+   hedge_ = None
+   answer_budget_ = False
+   cache_ = None
+   cache_mode_ = "readthrough"
+   cache_size_ = None
+   record_ = None
+   replay_ = None
+   replay_latency_ = None
+   resume_ = None
    gemini_rpm_ = 15
    gemini_tpm_ = 1000000
    gemini_rpd_ = 1500
    llamacpp_localModelPath_ = os.path.join(ROOT, "..", "..", "models")
+   llamacpp_slots_ = None
+   local_workers_ = None
+   local_daemon_ = None
+   http_pool_ = DEFAULT_MAX_CONNECTIONS
+   http_timeout_ = DEFAULT_TIMEOUT
+   base_url_ = None
+   concurrency_ = 1
+   batch_ = 1
+   rescore_ = None
+   incremental_ = False
+   evaluationWorkers_ = 1
+   evaluationCoordinator_ = None
 
    try:
       opts, args = getopt.getopt(argv,"h", [ o[0] + "=" for o in options])
@@ -93,10 +160,36 @@ def main(argv):
          case "--benchmark" : benchmark_ = arg
          case "--benchmarkDir" : benchmarkDir_ = arg
          case "--specificProblem" : specificProblem_ = arg
+         case "--select" : select_ = arg
+         case "--shard" : shard_ = arg
+         case "--merge" : merge_ = arg
          case "--enableEvaluation" : enableEvaluation_ = bool(arg)
          case "--allowMultipleAnswers" : allowMultipleAnswers_ = int(arg)
          case "--experimentName" : experimentName_ = arg
+         case "--concurrency" : concurrency_ = int(arg)
+         case "--batch" : batch_ = int(arg)
+         case "--rescore" : rescore_ = arg
+         case "--incremental" : incremental_ = bool(arg)
+         case "--evaluationWorkers" : evaluationWorkers_ = int(arg)
+         case "--evaluationCoordinator" : evaluationCoordinator_ = arg
 
+         case "--rpm" : rpm_ = int(arg)
+         case "--tpm" : tpm_ = int(arg)
+         case "--rpd" : rpd_ = int(arg)
+         case "--adaptive" : adaptive_ = int(arg)
+         case "--stream" : stream_ = bool(arg)
+         case "--hedge" : hedge_ = float(arg)
+         case "--answer_budget" : answer_budget_ = bool(arg)
+         case "--cache" : cache_ = arg
+         case "--cache_mode" : cache_mode_ = arg
+         case "--cache_size" : cache_size_ = int(arg)
+         case "--record" : record_ = arg
+         case "--replay" : replay_ = arg
+         case "--replay_latency" : replay_latency_ = arg if arg == "recorded" else float(arg)
+         case "--resume" : resume_ = arg
+         case "--http_pool" : http_pool_ = int(arg)
+         case "--http_timeout" : http_timeout_ = float(arg)
+         case "--base_url" : base_url_ = arg
          case "--anthropic_sleep" : anthropic_sleep_ = int(arg)
 
          case "--gemini_rpm": gemini_rpm_ = int(arg)
@@ -104,16 +197,58 @@ def main(argv):
          case "--gemini_rpd": gemini_rpd_ = int(arg)
 
          case "--llamacpp_localModelPath": llamacpp_localModelPath_ = arg
+         case "--llamacpp_slots": llamacpp_slots_ = int(arg)
+         case "--local_workers": local_workers_ = int(arg)
+         case "--local_daemon": local_daemon_ = arg
 
-   # create the client:
+   dataset = os.path.join(benchmarkDir_, benchmark_)
+
+   # neither merging nor re-scoring previous results needs an LLM:
+   if merge_ != None :
+      if os.path.isdir(merge_) :
+         merge_results_dir(dataset, merge_, experimentName=experimentName_)
+      else :
+         merge_results(dataset, merge_.split(","), experimentName=experimentName_)
+      return
+
+   if rescore_ != None :
+      if os.path.isdir(rescore_) :
+         rescore_results_dir(dataset, rescore_, incremental=incremental_, evaluationWorkers=evaluationWorkers_,
+                             evaluationCoordinator=evaluationCoordinator_)
+      else :
+         rescore_results(dataset, rescore_, experimentName=experimentName_, incremental=incremental_,
+                         evaluationWorkers=evaluationWorkers_, evaluationCoordinator=evaluationCoordinator_)
+      return
+
+   # create the client; the remote ones share a tuned connection pool:
+   # with a rate limit, or adaptive concurrency, the throttled requests are retried by an
+   # AdaptiveController (going through the rate limiter again), rather than by the SDK clients:
+   rateLimited = rpm_ != None or tpm_ != None or rpd_ != None
+   transport = TransportFactory(maxConnections=http_pool_, timeout=http_timeout_,
+                                maxRetries = 0 if rateLimited or adaptive_ != None else None)
+   # the pool of local model processes, if any, to stop at the end:
+   localPool = None
    match provider_ :
+      case _ if replay_ != None :
+          myAIclient = ReplayResponder.load(replay_.split(","), latency=replay_latency_)
+          if model_ == None : model_ = myAIclient.model
+      case "gpt4all" | "llamacpp" if local_workers_ != None :
+          modelPath = gpt4all_localModelPath_ if provider_ == "gpt4all" else llamacpp_localModelPath_
+          myAIclient = LocalPoolResponder(provider_, model_, modelPath, local_workers_, device=gpt4all_device_, DEBUG=DEBUG)
+          localPool = myAIclient
+      case "gpt4all" | "llamacpp" if local_daemon_ != None :
+          socketPath = DEFAULT_SOCKET if local_daemon_ == "default" else local_daemon_
+          if provider_ == "gpt4all" :
+             myAIclient = MyGPT4ALL_DaemonClient(model_, gpt4all_localModelPath_, device=gpt4all_device_, socketPath=socketPath)
+          else :
+             myAIclient = LLAMAcppDaemonClient(model_, llamacpp_localModelPath_, socketPath=socketPath)
       case "openAI" : 
           openai_api_key = os.environ.get('OPENAI_API_KEY') 
-          openAIclient = OpenAI(api_key=openai_api_key)
+          openAIclient = transport.openai(api_key=openai_api_key, base_url=base_url_)
           myAIclient = MyOpenAIClient(openAIclient,model_)
       case "openAI-1x" : 
           openai_api_key = os.environ.get('OPENAI_API_KEY') 
-          openAIclient = OpenAI(api_key=openai_api_key)
+          openAIclient = transport.openai(api_key=openai_api_key, base_url=base_url_)
           myAIclient = MyOpenAIClient(openAIclient,model_)
           myAIclient.enableMultipleAnswer = False
       case "gpt4all" :
@@ -121,38 +256,94 @@ def main(argv):
           myAIclient = MyGPT4ALL_Client(gpt4allClient)
       case "groq" :
           groq_api_key = os.environ.get('GROQ_API_KEY') 
-          openAIclient = OpenAI(base_url="https://api.groq.com/openai/v1",
-                                api_key=groq_api_key)    
+          openAIclient = transport.openai(base_url="https://api.groq.com/openai/v1" if base_url_ == None else base_url_,
+                                          api_key=groq_api_key)    
           myAIclient = MyGroqClient(openAIclient,model_)
       case "anthropic" :
          anthropic_api_key = os.environ.get('ANTHROPIC_API_KEY') 
-         anthropic_client = Anthropic(api_key = anthropic_api_key)
+         anthropic_client = transport.anthropic(api_key = anthropic_api_key)
          myAIclient = MyAnthorpicClient(anthropic_client,model_)
          if anthropic_sleep_ != None :
             myAIclient.sleepTime = anthropic_sleep_      
       case "gemini" :
           gemini_api_key = os.environ.get('GEMINI_API_KEY')
-          geminiClient = genai.Client(api_key=gemini_api_key)
+          geminiClient = transport.genai(api_key=gemini_api_key)
           myAIclient = GoogleResponder(client=geminiClient, modelId=model_, rpm_limit=gemini_rpm_, tpm_limit=gemini_tpm_, rpd_limit=gemini_rpd_)
       case "llamacpp" :
           llamacppClient =  Llama(model_path=os.path.join(llamacpp_localModelPath_,model_) , n_gpu_layers=-1)
-          myAIclient = LLAMAcppClient(llamacppClient)
+          if llamacpp_slots_ == None :
+             myAIclient = LLAMAcppClient(llamacppClient)
+          else :
+             myAIclient = LLAMAcppBatchingClient(BatchingServer(llamacppClient, slots=llamacpp_slots_))
 
 
    myAIclient.DEBUG = DEBUG
+   if provider_ in ["openAI", "openAI-1x", "groq", "anthropic", "gemini"] :
+      myAIclient.transport = transport
+   if rateLimited :
+      myAIclient.rateLimiter = RateLimiter(rpm=rpm_, tpm=tpm_, rpd=rpd_)
+   if myAIclient.rateLimiter != None :
+      myAIclient.rateLimiter.DEBUG = DEBUG
+   if adaptive_ != None :
+      myAIclient.controller = AdaptiveController(initialLimit=min(4,adaptive_), maxLimit=adaptive_)
+      myAIclient.controller.DEBUG = DEBUG
+      # the answers to a prompt may then all be in flight; the controller bounds them:
+      myAIclient.maxParallelAnswers = max(myAIclient.maxParallelAnswers, adaptive_)
+   elif rateLimited :
+      # a controller that does not adapt the concurrency, only retrying throttled requests:
+      bound = concurrency_ * max(1, myAIclient.maxParallelAnswers)
+      myAIclient.controller = AdaptiveController(initialLimit=bound, minLimit=bound, maxLimit=bound)
+      myAIclient.controller.DEBUG = DEBUG
+   myAIclient.streaming = stream_
+   if hedge_ != None :
+      # the requests in flight, each with a possible duplicate, and some abandoned ones:
+      inflight = adaptive_ if adaptive_ != None else concurrency_ * max(1, myAIclient.maxParallelAnswers)
+      myAIclient.hedging = HedgingPolicy(percentile=hedge_, maxWorkers = 2 * inflight + 4)
+      myAIclient.hedging.DEBUG = DEBUG
+   if cache_ != None :
+      cache = ResponseCache(cache_, maxBytes = None if cache_size_ == None else cache_size_ * 1024 * 1024)
+      myAIclient = CachingResponder(myAIclient, cache, mode=cache_mode_)
+      myAIclient.DEBUG = DEBUG
+   # the recording, if any, to close at the end, which finishes its gzip stream:
+   recording = None
+   if record_ != None :
+      # recording all the answers the run uses, including those from the cache:
+      myAIclient = RecordingResponder(myAIclient, record_)
+      myAIclient.DEBUG = DEBUG
+      recording = myAIclient
+
+   myAIclient.answerBudgets = answer_budget_
 
    # run the analysis:
-   dataset = os.path.join(benchmarkDir_, benchmark_)
-   if experimentName_ == None:
+   if resume_ != None:
+      # the name of the interrupted run already has its shard suffix, if any:
+      experimentName_ = resume_
+   elif experimentName_ == None:
       experimentName_ = f"{model_}_{prompt_type_}"
-   generate_results(myAIclient,
-                    dataset, 
-                    specificProblem  = specificProblem_ ,
-                    experimentName   = experimentName_,     
-                    enableEvaluation = enableEvaluation_, 
-                    allowMultipleAnswers = allowMultipleAnswers_,
-                    prompt_type = prompt_type_
-                    )
+   if shard_ != None and resume_ == None:
+      (i,N) = shard_.split("/")
+      experimentName_ = f"{experimentName_}_shard{i}of{N}"
+   try:
+      generate_results(myAIclient,
+                       dataset, 
+                       specificProblem  = specificProblem_ ,
+                       experimentName   = experimentName_,     
+                       enableEvaluation = enableEvaluation_, 
+                       allowMultipleAnswers = allowMultipleAnswers_,
+                       prompt_type = prompt_type_,
+                       evaluationWorkers = evaluationWorkers_,
+                       evaluationCoordinator = evaluationCoordinator_,
+                       taskSelection = select_,
+                       shard = shard_,
+                       concurrency = concurrency_,
+                       resume = resume_ != None,
+                       batchSize = batch_
+                       )
+   finally:
+      if recording != None :
+         recording.close()
+      if localPool != None :
+         localPool.close()
    
    
 if __name__ == "__main__":
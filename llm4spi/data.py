@@ -2,6 +2,8 @@ from typing import Iterable, Dict
 import gzip
 import json
 import os
+import re
+import random
 
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -14,6 +16,56 @@ def read_problems(data_file: str) -> Dict[str, Dict]:
     return {task["task_id"]: task for task in stream_json(data_file)}
 
 
+def select_tasks(tasks: Dict[str, Dict], selection: str) -> Dict[str, Dict]:
+    """
+    Select tasks by a selection expression. This is a sequence of filters, separated by ';', 
+    each applied to the result of the previous one:
+
+       * id1,id2,... : the tasks with these ids
+       * re:regex    : the tasks whose id fully matches the regular expression
+       * sample:n:seed : a random sample of n tasks, drawn with the given seed
+
+    The selected tasks keep the order they have in the dataset.
+    """
+    for filter in selection.split(';'):
+        filter = filter.strip()
+        if filter == "": continue
+        if filter.startswith("re:"):
+            regex = re.compile(filter[3:])
+            tasks = { Tid : tasks[Tid] for Tid in tasks if regex.fullmatch(Tid) }
+        elif filter.startswith("sample:"):
+            z = filter.split(':')
+            n = int(z[1])
+            seed = int(z[2]) if len(z) > 2 else 0
+            sample = set(random.Random(seed).sample(list(tasks), min(n,len(tasks))))
+            tasks = { Tid : tasks[Tid] for Tid in tasks if Tid in sample }
+        else:
+            ids = [ Tid.strip() for Tid in filter.split(',') ]
+            for Tid in ids:
+                if not (Tid in tasks): raise Exception(f"Unknown task {Tid} in selection {selection}")
+            tasks = { Tid : tasks[Tid] for Tid in tasks if Tid in ids }
+    return tasks
+
+def shard_tasks(tasks: Dict[str, Dict], shard: str) -> Dict[str, Dict]:
+    """
+    Return the i-th of N shards of the tasks, where shard is a string i/N, with 1 <= i <= N.
+    Tasks are dealt round-robin over the shards, in dataset order, so every task is in
+    exactly one shard, and the shards are about equally large.
+    """
+    (i,N) = [ int(z) for z in shard.split('/') ]
+    if N < 1 or i < 1 or i > N: raise Exception(f"Invalid shard {shard}")
+    return { Tid : tasks[Tid] for (k,Tid) in enumerate(tasks) if k % N == i-1 }
+
+def parse_results_filename(resultsfile: str) -> tuple:
+    """
+    Results-files are named <experiment>_all_<prompt-type>_<dd_mm_yyyy_hh_mm_ss>.json.
+    Return the experiment-name and the prompt-type in the name of the given file.
+    """
+    basename = os.path.splitext(os.path.basename(resultsfile))[0]
+    experimentName, rest = basename.split("_all_", 1)
+    prompt_type = "_".join(rest.split("_")[:-6])
+    return (experimentName, prompt_type)
+
 def stream_json(filename: str) -> Iterable[Dict]:
     """
     Parses each the json-file describing the problems, and yields a list of problems,
@@ -0,0 +1,408 @@
+#
+# Contain functions for running the basic evaluation (see basicEvaluate.py) on several
+# machines. A coordinator (run as part of the evaluation, see evaluate_tasks_results) listens
+# on a TCP port. Worker daemons, started on the same or on other machines with
+#
+#    python distEvaluate.py --host=<coordinator-host> --port=<port> [--processes=N]
+#
+# connect to it and ask for work. A work item is a single candidate of a single pre-/post-
+# condition of a task. The results are sent back to the coordinator, which merges them into
+# the tasks as the sequential evaluation would.
+#
+# The protocol is line-based JSON. The coordinator and a worker first authenticate each
+# other: the coordinator sends a challenge, the worker answers it with a hello carrying an
+# HMAC of both their nonces under the shared secret, and the coordinator proves it knows the
+# secret too in its welcome. The coordinator then sends the worker work items, preceded by
+# the test suites of the task if that worker has not seen them yet. The worker answers each
+# item with its result. Both sides send heartbeats; if a worker disconnects, or stays silent
+# longer than HEARTBEAT_TIMEOUT, its unfinished items are given to other workers, and a
+# worker whose coordinator stays silent that long drops the connection. When all items are
+# done, the coordinator sends 'done'. If no worker is connected for WORKER_TIMEOUT, the
+# coordinator evaluates the remaining items itself.
+#
+# Note that workers execute the candidates proposed by the AI, just like a local evaluation
+# does. Only connect workers to coordinators you trust, and vice versa. The shared secret is
+# taken from the environment variable LLM4SPI_EVAL_SECRET, unless given; it is required on
+# both sides, unless the coordinator only listens on a loopback address.
+#
+from typing import Dict
+from collections import deque
+import sys, getopt
+import socket
+import threading
+import ipaddress
+import hashlib
+import hmac
+import json
+import time
+import os
+
+from basicEvaluate import prepare_task_evaluation, evaluate_candidate, summarize_task_result, load_test_suites
+
+HEARTBEAT_INTERVAL = 2  # in seconds
+HEARTBEAT_TIMEOUT = 30  # in seconds
+RECONNECT_DELAY = 5     # in seconds
+WORKER_TIMEOUT = 60     # in seconds
+# how many work items a worker can have at the same time:
+PREFETCH = 2
+
+def parse_address(address:str) -> tuple :
+    """
+    Parse an address of the form host:port.
+    """
+    (host,port) = address.rsplit(":",1)
+    return (host,int(port))
+
+def send_message(sock:socket.socket, lock:threading.Lock, message:Dict):
+    data = (json.dumps(message) + "\n").encode('utf-8')
+    with lock:
+        sock.sendall(data)
+
+def default_secret() -> str :
+    return os.environ.get("LLM4SPI_EVAL_SECRET")
+
+def is_loopback(host:str) -> bool :
+    """
+    Whether all the addresses the host name resolves to are loopback addresses.
+    """
+    try:
+        addresses = [ info[4][0] for info in socket.getaddrinfo(host, None) ]
+    except OSError:
+        return False
+    return len(addresses) > 0 and all([ ipaddress.ip_address(A.split('%')[0]).is_loopback for A in addresses ])
+
+def check_secret(host:str, secret:str):
+    """
+    Refuse to evaluate without a shared secret, unless over a loopback address.
+    """
+    if (secret == None or secret == "") and not is_loopback(host):
+        raise Exception(f"A shared secret (LLM4SPI_EVAL_SECRET) is required to evaluate over {host}")
+
+def proof(secret:str, role:str, nonce1:str, nonce2:str) -> str :
+    """
+    The proof that the given side (coordinator or worker) knows the secret, for the given nonces.
+    """
+    key = ("" if secret == None else secret).encode('utf-8')
+    return hmac.new(key, f"{role}:{nonce1}:{nonce2}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+def read_message(reader) -> Dict :
+    line = reader.readline()
+    if line == "":
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+
+class Coordinator:
+    """
+    Hand out work items to the worker daemons that connect, and collect their results.
+    """
+    def __init__(self, host:str, port:int, secret:str=None, workerTimeout:float=WORKER_TIMEOUT):
+        if secret == None: secret = default_secret()
+        check_secret(host, secret)
+        self.secret = secret
+        self.workerTimeout = workerTimeout
+        self.server = socket.create_server((host,port))
+        self.server.settimeout(1)
+        self.address = self.server.getsockname()
+        self.lock = threading.Condition()
+        self.pending = deque()
+        self.items = {}
+        self.suites = {}
+        self.results = {}
+        self.finished = False
+        # the workers connected, and when the last one left (or the coordinator started):
+        self.numOfWorkers = 0
+        self.lastWorker = time.monotonic()
+
+    def run(self, items:list[Dict], suites:Dict[str,Dict]) -> Dict[int,Dict] :
+        """
+        Have the given work items done by the workers, and return their results, by item-id.
+        Each item is a dictionary with an id, a job, a candidate index k, a candidate body,
+        and a key into suites, which holds the tests and reference results of the job.
+        """
+        self.items = { item["id"] : item for item in items }
+        self.suites = suites
+        self.pending = deque([ item["id"] for item in items ])
+        acceptor = threading.Thread(target=self.accept_workers, daemon=True)
+        acceptor.start()
+        print(f"** Coordinator waiting for workers on {self.address[0]}:{self.address[1]}, {len(items)} work items")
+        self.lastWorker = time.monotonic()
+        with self.lock:
+            while len(self.results) < len(self.items):
+                self.lock.wait(1)
+                if self.numOfWorkers == 0 and time.monotonic() - self.lastWorker > self.workerTimeout and len(self.pending) > 0:
+                    self.lock.release()
+                    try:
+                        self.evaluate_locally()
+                    finally:
+                        self.lock.acquire()
+            self.finished = True
+            self.lock.notify_all()
+        acceptor.join()
+        self.server.close()
+        return self.results
+
+    def evaluate_locally(self):
+        """
+        Evaluate the pending items here, as long as no worker is connected.
+        """
+        print(f">>> No worker for {self.workerTimeout}s; evaluating the remaining work items locally")
+        suites = {}
+        while True:
+            with self.lock:
+                if self.numOfWorkers > 0 or len(self.pending) == 0: return
+                id = self.pending.popleft()
+            item = self.items[id]
+            if not (item["key"] in suites):
+                S = self.suites[item["key"]]
+                suites[item["key"]] = (load_test_suites(S["tests"]), tuple(S["reference"]))
+            (testSuites,reference) = suites[item["key"]]
+            U = evaluate_candidate(item["job"], testSuites, reference, item["k"], item["body"])
+            with self.lock:
+                if not (id in self.results): self.results[id] = U
+                self.lock.notify_all()
+
+    def accept_workers(self):
+        while not self.finished:
+            try:
+                (conn,addr) = self.server.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=self.serve_worker, args=(conn,addr), daemon=True).start()
+
+    def serve_worker(self, conn:socket.socket, addr):
+        sendLock = threading.Lock()
+        inflight = set()
+        sentSuites = set()
+        conn.settimeout(HEARTBEAT_TIMEOUT)
+        reader = conn.makefile("r", encoding="utf-8")
+        workerName = f"{addr[0]}:{addr[1]}"
+        joined = False
+        stopped = threading.Event()
+        try:
+            nonce = os.urandom(16).hex()
+            send_message(conn, sendLock, { "type" : "challenge", "nonce" : nonce })
+            hello = read_message(reader)
+            workerNonce = str(hello.get("nonce"))
+            if hello.get("type") != "hello" or not hmac.compare_digest(str(hello.get("proof")), proof(self.secret, "worker", nonce, workerNonce)):
+                print(f">>> Refused worker {workerName}")
+                return
+            send_message(conn, sendLock, { "type" : "welcome", "proof" : proof(self.secret, "coordinator", workerNonce, nonce) })
+            workerName = hello.get("worker", workerName)
+            with self.lock:
+                self.numOfWorkers += 1
+                joined = True
+            print(f"** Worker {workerName} joined")
+            threading.Thread(target=send_heartbeats, args=(conn,sendLock,stopped), daemon=True).start()
+            while True:
+                # hand out new items, up to the prefetch limit:
+                with self.lock:
+                    if self.finished:
+                        send_message(conn, sendLock, { "type" : "done" })
+                        return
+                    toSend = []
+                    while len(inflight) + len(toSend) < PREFETCH and len(self.pending) > 0:
+                        toSend.append(self.pending.popleft())
+                    inflight.update(toSend)
+                for id in toSend:
+                    item = self.items[id]
+                    if not (item["key"] in sentSuites):
+                        send_message(conn, sendLock, { "type" : "suites", "key" : item["key"], "suites" : self.suites[item["key"]] })
+                        sentSuites.add(item["key"])
+                    send_message(conn, sendLock, { "type" : "work", "item" : item })
+                # wait for a result or a heartbeat:
+                message = read_message(reader)
+                if message["type"] == "result":
+                    with self.lock:
+                        inflight.discard(message["id"])
+                        # the item may also have been re-queued and done by someone else:
+                        if not (message["id"] in self.results):
+                            self.results[message["id"]] = message["result"]
+                        self.lock.notify_all()
+        except (OSError, ValueError) as e:
+            print(f">>> Lost worker {workerName}: {e}")
+        finally:
+            stopped.set()
+            with self.lock:
+                if joined:
+                    self.numOfWorkers -= 1
+                    self.lastWorker = time.monotonic()
+                requeue = [ id for id in inflight if not (id in self.results) ]
+                if len(requeue) > 0:
+                    print(f">>> Re-queueing {len(requeue)} work items of worker {workerName}")
+                self.pending.extendleft(requeue)
+                self.lock.notify_all()
+            conn.close()
+
+
+def evaluate_tasks_distributed(tasks: Dict[str,Dict], todo: list[tuple], host:str, port:int,
+                               secret:str=None, localWorkers:int=0,
+                               onResult=None):
+    """
+    Evaluate the given (task-id,condition) pairs of the tasks, as evaluate_task_result
+    would do, but sending the candidates to worker daemons connecting to the given
+    host and port. The results are added into the task-dictionaries, in the same
+    order as the sequential evaluation would.
+
+    If localWorkers is more than zero, that many workers are also started on this machine.
+    If secret is None, it is taken from LLM4SPI_EVAL_SECRET. If given, onResult(task,condition) is called as each pre-/post-condition is complete.
+    """
+    items = []
+    suites = {}
+    jobs = []
+    for (tID,condition) in todo:
+        task = tasks[tID]
+        job = prepare_task_evaluation(task, condition)
+        if job == None:
+            # nothing to evaluate, but it is still complete, in its order:
+            jobs.append((task,condition,None))
+            continue
+        key = f"{tID}/{condition}"
+        # workers re-parse the tests from the dataset string, which is more faithful than
+        # sending the parsed inputs as json:
+        suites[key] = { "tests" : task[f"{condition}_condition_tests"], "reference" : job["reference"] }
+        smallJob = { k:job[k] for k in job if not (k in ["suites","reference"]) }
+        ids = []
+        for (k,body) in enumerate(task[f"{condition}_condition_completions"]):
+            ids.append(len(items))
+            items.append({ "id" : len(items), "key" : key, "job" : smallJob, "k" : k, "body" : body })
+        jobs.append((task,condition,ids))
+
+    if secret == None: secret = default_secret()
+    coordinator = Coordinator(host, port, secret)
+    (host,port) = coordinator.address[0], coordinator.address[1]
+    localProcesses = start_worker_processes(host, port, localWorkers, secret, reconnect=False)
+    results = coordinator.run(items, suites)
+    for P in localProcesses:
+        P.join()
+    for (task,condition,ids) in jobs:
+        if ids != None:
+            summarize_task_result(task, condition, [ results[id] for id in ids ])
+        if onResult != None: onResult(task, condition)
+
+
+def send_heartbeats(sock:socket.socket, sendLock:threading.Lock, stopped:threading.Event):
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        try:
+            send_message(sock, sendLock, { "type" : "heartbeat" })
+        except OSError:
+            return
+
+def serve_coordinator(sock:socket.socket, name:str, secret:str):
+    """
+    Do work items for the coordinator at the other end of the socket, until it says done.
+    The coordinator must prove it knows the secret before any item is accepted from it.
+    """
+    sendLock = threading.Lock()
+    stopped = threading.Event()
+    # a coordinator that is silent for too long (e.g. its host died) is given up:
+    sock.settimeout(HEARTBEAT_TIMEOUT)
+    reader = sock.makefile("r", encoding="utf-8")
+    suites = {}
+    try:
+        challenge = read_message(reader)
+        if challenge.get("type") != "challenge":
+            raise ConnectionError("the coordinator did not send a challenge")
+        coordinatorNonce = str(challenge.get("nonce"))
+        nonce = os.urandom(16).hex()
+        send_message(sock, sendLock, { "type" : "hello", "worker" : name, "nonce" : nonce,
+                                       "proof" : proof(secret, "worker", coordinatorNonce, nonce) })
+        welcome = read_message(reader)
+        if welcome.get("type") != "welcome" or not hmac.compare_digest(str(welcome.get("proof")), proof(secret, "coordinator", nonce, coordinatorNonce)):
+            raise ConnectionError("the coordinator could not prove it knows the secret")
+        threading.Thread(target=send_heartbeats, args=(sock,sendLock,stopped), daemon=True).start()
+        while True:
+            message = read_message(reader)
+            match message["type"]:
+                case "suites":
+                    S = message["suites"]
+                    suites[message["key"]] = (load_test_suites(S["tests"]), tuple(S["reference"]))
+                case "work":
+                    item = message["item"]
+                    (testSuites,reference) = suites[item["key"]]
+                    U = evaluate_candidate(item["job"], testSuites, reference, item["k"], item["body"])
+                    send_message(sock, sendLock, { "type" : "result", "id" : item["id"], "result" : U })
+                case "done":
+                    return
+    except ValueError as e:
+        raise ConnectionError(f"bad message from the coordinator: {e}")
+    finally:
+        stopped.set()
+        sock.close()
+
+def run_worker(host:str, port:int, name:str=None, secret:str=None, reconnect:bool=True):
+    """
+    Run a worker daemon, serving the coordinator at the given host and port. If reconnect
+    is true, the worker keeps (re-)connecting to serve the next evaluations too. If secret
+    is None, it is taken from LLM4SPI_EVAL_SECRET.
+    """
+    if secret == None: secret = default_secret()
+    check_secret(host, secret)
+    if name == None:
+        name = f"{socket.gethostname()}-{os.getpid()}"
+    while True:
+        try:
+            sock = socket.create_connection((host,port))
+            serve_coordinator(sock, name, secret)
+        except OSError as e:
+            print(f">>> Lost the coordinator {host}:{port}: {e}")
+            if not reconnect: return
+            time.sleep(RECONNECT_DELAY)
+            continue
+        if not reconnect: return
+
+def start_worker_processes(host:str, port:int, N:int, secret:str=None, reconnect:bool=True) -> list :
+    """
+    Start N worker daemons on this machine, each in its own process.
+    """
+    import multiprocessing
+    processes = []
+    for k in range(N):
+        P = multiprocessing.Process(target=run_worker, args=(host,port,None,secret,reconnect), daemon=True)
+        P.start()
+        processes.append(P)
+    return processes
+
+
+options = [
+   ("host", "The host of the coordinator. Default is localhost."),
+   ("port", "The port of the coordinator. Mandatory."),
+   ("processes", "The number of worker daemons to run on this machine. Default is 1."),
+   ("secret", "The secret shared with the coordinator; required unless it is on a loopback address. Default is the value of LLM4SPI_EVAL_SECRET.")
+]
+
+helptxt = "python distEvaluate.py [--option=arg]*\n"
+helptxt += "   Options:\n"
+for o in options:
+   helptxt +=  f"   --{o[0]} : {o[1]}\n"
+
+def main(argv):
+   host_ = "localhost"
+   port_ = None
+   processes_ = 1
+   secret_ = default_secret()
+   try:
+      opts, args = getopt.getopt(argv,"h", [ o[0] + "=" for o in options])
+   except getopt.GetoptError:
+      print (helptxt)
+      sys.exit(2)
+   for opt, arg in opts:
+      match opt:
+         case "-h":
+            print (helptxt)
+            sys.exit()
+         case "--host" : host_ = arg
+         case "--port" : port_ = int(arg)
+         case "--processes" : processes_ = int(arg)
+         case "--secret" : secret_ = arg
+   if port_ == None:
+      print (helptxt)
+      sys.exit(2)
+   if processes_ == 1:
+      run_worker(host_, port_, secret=secret_)
+   else:
+      for P in start_worker_processes(host_, port_, processes_, secret_):
+         P.join()
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
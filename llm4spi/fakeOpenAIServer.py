@@ -0,0 +1,378 @@
+#
+# A local stand-in for an OpenAI-compatible chat-completions API, to load-test and benchmark
+# the clients of such APIs (MyOpenAIClient, MyGroqClient), and the rate limiter, the adaptive
+# concurrency, the retries, and the connection pool they use, without a network or quota.
+# It is started with
+#
+#    python fakeOpenAIServer.py [--option=arg]*
+#
+# and the clients are pointed at it with base_url=http://<host>:<port>/v1 (any path ending
+# with /chat/completions is served). It can also be run inside a test, see FakeOpenAIServer.
+#
+# Every request waits a latency drawn from a distribution, before its first token, and then
+# as long as generating its answers takes at the given throughput (in tokens per second, per
+# answer); streamed answers come in pieces at that pace. The n answers asked are all given,
+# cut off at max_tokens (finish_reason "length") and at the stop sequences. The answers are
+# taken from a file of canned answers, or else made from a template, per function header in
+# the prompt. Requests are throttled (429, with a Retry-After header) beyond a given number
+# of requests per minute, and at random with a given probability.
+#
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict
+import sys, getopt
+import threading
+import random
+import math
+import json
+import time
+import re
+
+from tokenCounting import heuristic_count, TEXT_PIECES
+
+DEFAULT_PORT = 8765
+DEFAULT_LATENCY = "lognormal:0.5:0.5"
+DEFAULT_THROUGHPUT = 100        # in tokens per second
+DEFAULT_RETRY_AFTER = 1         # in seconds
+DEFAULT_TEMPLATE = "```python\n{header}\n    return True\n```"
+FILLER = "Let us first reason about what the function should check. "
+
+_header = re.compile(r"^\s*def\s+(\w+)\s*\(.*\)[^:]*:\s*$")
+
+def latency_sampler(spec:str, rng:random.Random):
+    """
+    A function drawing latencies (in seconds) from the distribution in spec, one of
+    <seconds>, fixed:<seconds>, uniform:<min>:<max>, exp:<mean>, or lognormal:<median>:<sigma>.
+    """
+    parts = spec.split(":")
+    args = [ float(x) for x in parts[1:] ]
+    match parts[0]:
+        case "fixed": return lambda: args[0]
+        case "uniform": return lambda: rng.uniform(args[0], args[1])
+        case "exp": return lambda: rng.expovariate(1 / args[0]) if args[0] > 0 else 0
+        case "lognormal": return lambda: rng.lognormvariate(math.log(args[0]), args[1])
+    try:
+        seconds = float(spec)
+        return lambda: seconds
+    except ValueError:
+        raise Exception(f"Unknown latency distribution {spec}")
+
+def cut_at_tokens(text:str, maxTokens:int) -> tuple :
+    """
+    Cut the text at the given number of tokens (as counted by heuristic_count). Returns the
+    text and whether it was cut.
+    """
+    count = 0
+    end = 0
+    for m in TEXT_PIECES.finditer(text):
+        count += heuristic_count(m.group())
+        if count > maxTokens: return (text[0 : end], True)
+        end = m.end()
+    return (text, False)
+
+def cut_at_stop(text:str, stop) -> tuple :
+    """
+    Cut the text before the first of the stop sequences in it, if any. Returns the text and
+    whether it was cut.
+    """
+    if stop == None: return (text, False)
+    if isinstance(stop, str): stop = [ stop ]
+    positions = [ text.find(S) for S in stop if S != "" and text.find(S) >= 0 ]
+    if len(positions) == 0: return (text, False)
+    return (text[0 : min(positions)], True)
+
+
+class FakeOpenAIServer:
+    """
+    Serve the chat-completions API at the given host and port (if the port is 0, a free one
+    is taken), answering as described at the top of this module. The answers are taken at
+    random from the canned ones if given, else made from the template, in which {header} and
+    {name} are replaced by the header and name of each function in the prompt. Answers are
+    prefixed with filler text to make them about answerTokens long, if given.
+    """
+    def __init__(self, host:str="127.0.0.1", port:int=DEFAULT_PORT, latency:str=DEFAULT_LATENCY,
+                 throughput:float=DEFAULT_THROUGHPUT, rpm:int=None, throttleRate:float=0,
+                 retryAfter:float=DEFAULT_RETRY_AFTER, cannedAnswers:list[str]=None,
+                 template:str=DEFAULT_TEMPLATE, answerTokens:int=None, seed:int=None):
+        self.rng = random.Random(seed)
+        self.rngLock = threading.Lock()
+        self.latency = latency_sampler(latency, self.rng)
+        self.throughput = throughput
+        self.rpm = rpm
+        self.throttleRate = throttleRate
+        self.retryAfter = retryAfter
+        self.cannedAnswers = cannedAnswers
+        self.template = template
+        self.answerTokens = answerTokens
+        self.lock = threading.Lock()
+        # the times of the requests of the last minute, for the rpm limit:
+        self.recent = []
+        # statistics:
+        self.numOfRequests = 0
+        self.numOfThrottled = 0
+        self.numOfAnswers = 0
+        self.numOfTokens = 0
+        self.inFlight = 0
+        self.maxInFlight = 0
+        server = self
+        class Handler(ChatCompletionsHandler):
+            fake = server
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str :
+        (host,port) = self.httpd.server_address[0:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread != None: self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def random(self, f):
+        with self.rngLock: return f()
+
+    def throttle(self) -> float :
+        """
+        If the next request is to be throttled, return the delay it should retry after,
+        else None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.numOfRequests += 1
+            self.recent = [ t for t in self.recent if now - t < 60 ]
+            delay = None
+            if self.rpm != None and len(self.recent) >= self.rpm:
+                delay = max(1, math.ceil(60 - (now - self.recent[0])))
+            elif self.throttleRate > 0 and self.random(self.rng.random) < self.throttleRate:
+                delay = self.retryAfter
+            if delay != None:
+                self.numOfThrottled += 1
+                return delay
+            self.recent.append(now)
+            return None
+
+    def answerTo(self, prompt:str) -> str :
+        if self.cannedAnswers != None:
+            answer = self.random(lambda: self.rng.choice(self.cannedAnswers))
+        else:
+            functions = [ (z.strip(), m.group(1)) for z in prompt.split('\n') for m in [_header.match(z)] if m != None ]
+            if len(functions) == 0: functions = [ ("def f():", "f") ]
+            answer = "\n".join([ self.template.replace("{header}", header).replace("{name}", name) for (header,name) in functions ])
+        if self.answerTokens != None:
+            fillerTokens = heuristic_count(FILLER)
+            n = max(0, self.answerTokens - heuristic_count(answer)) // fillerTokens
+            if n > 0: answer = FILLER * n + "\n\n" + answer
+        return answer
+
+    def complete(self, request:Dict) -> tuple :
+        """
+        The answers to a chat-completion request, as (text,finish_reason) pairs, and the
+        number of tokens of its prompt.
+        """
+        prompt = "\n".join([ M["content"] if isinstance(M.get("content"),str) else json.dumps(M.get("content"))
+                             for M in request.get("messages", []) ])
+        maxTokens = request.get("max_completion_tokens", request.get("max_tokens"))
+        answers = []
+        for k in range(request.get("n") or 1):
+            (text,stopped) = cut_at_stop(self.answerTo(prompt), request.get("stop"))
+            (text,truncated) = (text,False) if maxTokens == None else cut_at_tokens(text, maxTokens)
+            answers.append((text, "length" if truncated else "stop"))
+        return (answers, heuristic_count(prompt))
+
+    def enter(self):
+        with self.lock:
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+
+    def leave(self, answers:list[tuple]):
+        with self.lock:
+            self.inFlight -= 1
+            self.numOfAnswers += len(answers)
+            self.numOfTokens += sum([ heuristic_count(text) for (text,_) in answers ])
+
+    def stats(self) -> Dict :
+        with self.lock:
+            return {
+                "requests" : self.numOfRequests,
+                "throttled" : self.numOfThrottled,
+                "answers" : self.numOfAnswers,
+                "completion tokens" : self.numOfTokens,
+                "max in flight" : self.maxInFlight
+            }
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    # keep-alive connections, as the real APIs; the streams are sent chunked:
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendJson(self, status:int, body:Dict, headers:Dict=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for (name,value) in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendChunk(self, data:bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self.sendJson(200, self.fake.stats())
+        else:
+            self.sendJson(404, { "error" : { "message" : f"Unknown path {self.path}", "type" : "invalid_request_error" } })
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.sendJson(404, { "error" : { "message" : f"Unknown path {self.path}", "type" : "invalid_request_error" } })
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.sendJson(400, { "error" : { "message" : "The body is not valid JSON", "type" : "invalid_request_error" } })
+            return
+        delay = self.fake.throttle()
+        if delay != None:
+            self.sendJson(429, { "error" : { "message" : "Rate limit reached (fake server)", "type" : "requests", "code" : "rate_limit_exceeded" } },
+                          { "Retry-After" : str(delay), "retry-after-ms" : str(int(delay * 1000)) })
+            return
+        self.fake.enter()
+        answers = []
+        try:
+            (answers,promptTokens) = self.fake.complete(request)
+            time.sleep(self.fake.random(self.fake.latency))
+            completion = {
+                "id" : f"chatcmpl-fake{self.fake.numOfRequests}",
+                "created" : int(time.time()),
+                "model" : request.get("model", "fake")
+            }
+            if request.get("stream"):
+                self.stream(completion, answers)
+            else:
+                # the answers are generated in parallel:
+                time.sleep(max([ heuristic_count(text) for (text,_) in answers ]) / self.fake.throughput)
+                completionTokens = sum([ heuristic_count(text) for (text,_) in answers ])
+                completion.update({
+                    "object" : "chat.completion",
+                    "choices" : [ { "index" : k, "message" : { "role" : "assistant", "content" : text }, "finish_reason" : reason }
+                                  for (k,(text,reason)) in enumerate(answers) ],
+                    "usage" : { "prompt_tokens" : promptTokens, "completion_tokens" : completionTokens,
+                                "total_tokens" : promptTokens + completionTokens }
+                })
+                self.sendJson(200, completion)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream, e.g. after a complete code block:
+            self.close_connection = True
+        finally:
+            self.fake.leave(answers)
+
+    def stream(self, completion:Dict, answers:list[tuple]):
+        """
+        Send the answers as server-sent events, a token at a time of each answer, at the
+        throughput of the server.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        completion["object"] = "chat.completion.chunk"
+        def event(choices):
+            chunk = dict(completion)
+            chunk["choices"] = choices
+            self.sendChunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        pieces = [ [ m.group() for m in TEXT_PIECES.finditer(text) ] for (text,_) in answers ]
+        for i in range(max([ len(P) for P in pieces ] + [0])):
+            event([ { "index" : k, "delta" : { "content" : P[i] }, "finish_reason" : None } for (k,P) in enumerate(pieces) if i < len(P) ])
+            time.sleep(1 / self.fake.throughput)
+        event([ { "index" : k, "delta" : {}, "finish_reason" : reason } for (k,(_,reason)) in enumerate(answers) ])
+        self.sendChunk(b"data: [DONE]\n\n")
+        self.sendChunk(b"")
+
+
+options = [
+   ("host", "The address to listen on. Default is 127.0.0.1."),
+   ("port", f"The port to listen on. Default is {DEFAULT_PORT}."),
+   ("latency", f"The distribution of the latency before the first token: <sec>, fixed:<sec>, uniform:<min>:<max>, exp:<mean>, or lognormal:<median>:<sigma>. Default is {DEFAULT_LATENCY}."),
+   ("throughput", f"The tokens per second at which each answer is generated. Default is {DEFAULT_THROUGHPUT}."),
+   ("rpm", "If present, requests beyond this many per minute are throttled (429)."),
+   ("throttle_rate", "If present, this fraction of the requests (e.g. 0.05) is throttled (429) at random."),
+   ("retry_after", f"The Retry-After (in sec) of the requests throttled at random. Default is {DEFAULT_RETRY_AFTER}."),
+   ("answers", "If present, a json file with a list of canned answers, or a text file with a template of the answer to each function header in the prompt, where {header} and {name} are replaced by the header and name of the function."),
+   ("answer_tokens", "If present, answers are padded with text to about this many tokens."),
+   ("seed", "If present, the seed of the random latencies, throttling, and answers.")
+]
+
+helptxt = "python fakeOpenAIServer.py [--option=arg]*\n"
+helptxt += "   Options:\n"
+for o in options:
+   helptxt +=  f"   --{o[0]} : {o[1]}\n"
+
+def main(argv):
+   host_ = "127.0.0.1"
+   port_ = DEFAULT_PORT
+   latency_ = DEFAULT_LATENCY
+   throughput_ = DEFAULT_THROUGHPUT
+   rpm_ = None
+   throttle_rate_ = 0
+   retry_after_ = DEFAULT_RETRY_AFTER
+   answers_ = None
+   answer_tokens_ = None
+   seed_ = None
+   try:
+      opts, args = getopt.getopt(argv,"h", [ o[0] + "=" for o in options])
+   except getopt.GetoptError:
+      print (helptxt)
+      sys.exit(2)
+   for opt, arg in opts:
+      match opt:
+         case "-h":
+            print (helptxt)
+            sys.exit()
+         case "--host" : host_ = arg
+         case "--port" : port_ = int(arg)
+         case "--latency" : latency_ = arg
+         case "--throughput" : throughput_ = float(arg)
+         case "--rpm" : rpm_ = int(arg)
+         case "--throttle_rate" : throttle_rate_ = float(arg)
+         case "--retry_after" : retry_after_ = float(arg)
+         case "--answers" : answers_ = arg
+         case "--answer_tokens" : answer_tokens_ = int(arg)
+         case "--seed" : seed_ = int(arg)
+   cannedAnswers = None
+   template = DEFAULT_TEMPLATE
+   if answers_ != None:
+      with open(answers_, "r") as fp:
+         if answers_.endswith(".json"):
+            cannedAnswers = json.load(fp)
+         else:
+            template = fp.read()
+   server = FakeOpenAIServer(host=host_, port=port_, latency=latency_, throughput=throughput_, rpm=rpm_,
+                             throttleRate=throttle_rate_, retryAfter=retry_after_, cannedAnswers=cannedAnswers,
+                             template=template, answerTokens=answer_tokens_, seed=seed_)
+   print(f"** Fake OpenAI-compatible server on {server.url}")
+   try:
+      server.httpd.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      print(f"** {server.stats()}")
+      server.close()
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -11,7 +11,10 @@ import time
 from google import genai
 from google.genai import types
 
-from openai4spi import PromptResponder, generate_results
+from openai4spi import PromptResponder, mark_truncated, generate_results
+from rateLimiter import RateLimiter
+from tokenCounting import token_counter
+from transport import TransportFactory
 
 class GoogleResponder(PromptResponder):
     """
@@ -24,99 +27,60 @@ class GoogleResponder(PromptResponder):
     def __init__(self, client: genai.Client, modelId: str, rpm_limit: int, tpm_limit: int , rpd_limit: int):
         PromptResponder.__init__(self)
         self.client = client
-
-        # to exceed num of request  per minute
-        self.last_time_seen = -1
-        # to set as parameters
-        self.rpm_limit = rpm_limit
-        self.tpm_limit = tpm_limit
-        self.rpd_limit = rpd_limit
-        # used resources
-        self.rpm_used = 0
-        self.tpm_used = 0
-        self.rpd_used = 0
-        # timers for minutes and days
-        self.minute_timer = 0
-        self.day_timer = 0
+        # all three limits are enforced by a rate limiter:
+        self.rateLimiter = RateLimiter(rpm=rpm_limit, tpm=tpm_limit, rpd=rpd_limit)
         # save model name
-        self.model_id = modelId
+        self.model = modelId
+        # free tiers have a low rpm, so only ask a few answers at the same time:
+        self.maxParallelAnswers = 2
+        # tokens are counted locally, rather than asking the API to count them:
+        self.tokenCounter = token_counter("gemini", modelId)
 
 
-    def completeIt(self, multipleAnswer: int, prompt: str) -> list[str]:
+    def completeIt(self, multipleAnswer: int, prompt: str, maxTokens: int = None) -> list[str]:
 
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
-        answers = []
 
         # Google client configuration
         cfg = types.GenerateContentConfig(
             temperature=0.7,
-            max_output_tokens=1024
+            max_output_tokens=1024 if maxTokens == None else maxTokens,
+            stop_sequences = self.stopSequencesFor(prompt) if self.streaming else None
         )
 
-        # first call
-        if self.last_time_seen == -1:
-            self.last_time_seen = time.time()
-            passed_time = 0
-        else:
-            # time passed since the last call
-            passed_time = time.time() - self.last_time_seen
-
-        # More than one minute is passed
-        if passed_time > 60:
-            # reset minute counters
-            self.minute_timer = 0
-            self.rpd_used = 0
-            self.tpm_used = 0
-
-        # One day is passed
-        if passed_time > 60 * 60 * 24:
-            # reset day counters
-            self.day_timer = 0
-            self.rpd_used = 0
-
-        # estimate token usage
-        prompt_tokens = self.client.models.count_tokens(model=self.model_id, contents=prompt)
-
-
-        # iterate
-        for k in range(multipleAnswer):
-
-            # check if free resource are consumed
-            if self.rpm_used + 1 >= self.rpm_limit or self.tpm_used + prompt_tokens.total_tokens + 1 >= self.tpm_limit :
-                sleep_time = max(1,60 - self.minute_timer)
-                if self.DEBUG: print(f">>> sleep {sleep_time}s\n" )
-                time.sleep(sleep_time)
-                self.rpm_used = 0
-                self.tpm_used = 0
-                self.minute_timer = 0
-
-            # rpd finished
-            if self.rpd_used >= self.rpd_limit :
-                sleep_time = max(1, ( 60 * 60 * 12) - self.day_timer)
-                if self.DEBUG: print(f">>> sleep {sleep_time}s\n")
-                time.sleep(sleep_time)
-                self.rpd_used = 0
-                self.day_timer = 0
-
-            t0 = time.time()
-            response = self.client.models.generate_content( model = self.model_id, contents = prompt, config = cfg )
-            used_time = time.time() - t0
-            self.minute_timer += used_time
-            self.day_timer += used_time
-            self.rpm_used += 1
-            self.rpd_used += 1
-            self.tpm_used += response.usage_metadata.total_token_count
-
-            usage_data = response.usage_metadata
-            answers.append(response.text)
-
-        self.last_time_seen = time.time()
-        return answers
+        def streamIt():
+            chunks = self.client.models.generate_content_stream( model = self.model, contents = prompt, config = cfg )
+            finishReasons = []
+            def texts():
+                for chunk in chunks:
+                    if chunk.candidates != None and len(chunk.candidates) > 0:
+                        finishReasons.append(chunk.candidates[0].finish_reason)
+                    yield chunk.text
+            try:
+                A = self.readStream(texts(), prompt)
+            finally:
+                # the rest of the stream is not read when the answer stops early; close it:
+                chunks.close()
+            # the finish reason is only known if the whole stream was read:
+            return mark_truncated(A, types.FinishReason.MAX_TOKENS in finishReasons)
+
+        def ask(k):
+            # the answers are asked concurrently, within the limits:
+            if self.streaming:
+                return self.send(streamIt, prompt)
+            response = self.send(lambda: self.client.models.generate_content( model = self.model, contents = prompt, config = cfg ),
+                                 prompt,
+                                 usage = lambda response: response.usage_metadata.total_token_count)
+            truncated = len(response.candidates) > 0 and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+            return mark_truncated(response.text, truncated)
+
+        return self.fanOut(multipleAnswer, ask)
 
 
 if __name__ == '__main__':
     gemini_api_key = os.environ.get('GEMINI_API_KEY')
-    googleClient = genai.Client(api_key=gemini_api_key)
+    transport = TransportFactory()
+    googleClient = transport.genai(api_key=gemini_api_key)
 
     """
     An instance of prompt-responder that uses an LLM available at Google AI Studio as the backend model.
@@ -125,6 +89,7 @@ if __name__ == '__main__':
     modelId = "gemini-2.0-flash"
 
     myAiClient = GoogleResponder(googleClient, modelId, 10, 1000000, 1000)
+    myAiClient.transport = transport
 
     ROOT = os.path.dirname(os.path.abspath(__file__))
     dataset = os.path.join(ROOT, "..", "..", "llm4spiDatasets", "data", "HEx-compact.json")
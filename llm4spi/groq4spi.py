@@ -11,7 +11,9 @@ from openai import OpenAI
 import os
 import time
 
-from openai4spi import PromptResponder, generate_results
+from openai4spi import PromptResponder, chat_usage, stream_chat, mark_truncated, generate_results
+from rateLimiter import RateLimiter
+from transport import TransportFactory
 
 #
 # Groq actually has its own client-side API, but we will use OpenAI API since this is
@@ -21,60 +23,56 @@ class MyGroqClient(PromptResponder):
     """
     An instance of prompt-responder that uses an LLM available at Groq as the backend model.
     """
-    def __init__(self,client: OpenAI, modelId:str):
+    def __init__(self,client: OpenAI, modelId:str, rateLimiter:RateLimiter=None):
         """
-        Expecting an OpenAI-client.
+        Expecting an OpenAI-client. The rate limiter, if given, keeps the requests within
+        the limits of the account; those of the free tier are low, e.g. 30 requests and
+        6000 tokens/minute, pfff :(  (with clispi.py: --rpm 30 --tpm 6000).
         """
         PromptResponder.__init__(self)
         self.client = client
         self.model = modelId
-        # to keep track of time, towards deciding to pause so as not
-        # to exceed num of tokens/minute 
-        self.t0 = None
-        self.maxNumOfTokensPerMiniteLIMIT = 6000 # pfff :(
+        self.rateLimiter = rateLimiter
+        # with such a low limit, only ask a few answers at the same time:
+        self.maxParallelAnswers = 2
     
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str] :
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
         #
-        # Groq-side does not currently support multiple answers; so we will explicitly ask one at a time.
+        # Groq-side does not currently support multiple answers; so we will explicitly ask them
+        # one per request, sending up to maxParallelAnswers of these requests at the same time.
         #
-        responses = []
-        if self.t0 == None:
-            self.t0 = time.time()
-        totTokensSinceLastPause = 0
-        for k in range(multipleAnswer):
-            completion = self.client.chat.completions.create(
-                model = self.model,
-                temperature=0.7,
-                max_tokens=1024,
+        def ask(k):
+            request = {
+                "model" : self.model,
+                "temperature" : 0.7,
+                "max_tokens" : 1024 if maxTokens == None else maxTokens,
                 # n = ... ,
-                messages=[
+                "messages" : [
                     {
                         "role": "user",
                         "content": prompt
                     }
                     ]
-                )
-            R = completion.choices[0].message.content
-            estimatedNumOfTokens = 3* len(R.split())
-            responses.append(R)
+                }
+            if self.streaming:
+                stops = self.stopSequencesFor(prompt)
+                if stops != None: request["stop"] = stops
+                R = self.send(lambda: stream_chat(self, prompt, **request), prompt)[0]
+            else:
+                completion = self.send(lambda: self.client.chat.completions.create(**request), prompt, usage=chat_usage)
+                R = mark_truncated(completion.choices[0].message.content, completion.choices[0].finish_reason == "length")
             if self.DEBUG: 
-                print(f">>> raw response {k} (estimated #tokens {estimatedNumOfTokens}):\n {R}")
-            totTokensSinceLastPause = totTokensSinceLastPause + estimatedNumOfTokens
-            timeSinceLastPause = time.time() - self.t0
-            if multipleAnswer>1 and timeSinceLastPause >= 0.8*60 or totTokensSinceLastPause >= 0.8 * self.maxNumOfTokensPerMiniteLIMIT:
-                # add pause untill one minute over:
-                sleepTime = max(5,60 - timeSinceLastPause)
-                if self.DEBUG: 
-                    print(f">>> SLEEPING {sleepTime}s ...")
-                self.t0 = time.time()
-                time.sleep(sleepTime)
+                print(f">>> raw response {k}:\n {R}")
+            return R
+        responses = self.fanOut(multipleAnswer, ask)
 
         return responses
     
 if __name__ == '__main__':
     groq_api_key = os.environ.get('GROQ_API_KEY') 
-    openAIclient = OpenAI(
+    transport = TransportFactory()
+    openAIclient = transport.openai(
             base_url="https://api.groq.com/openai/v1",
             api_key=groq_api_key)
     
@@ -82,7 +80,8 @@ if __name__ == '__main__':
     #modelId = "llama3-70b-8192"
     modelId = "deepseek-r1-distill-llama-70b"
     
-    myAIclient = MyGroqClient(openAIclient,modelId)
+    myAIclient = MyGroqClient(openAIclient,modelId,rateLimiter=RateLimiter(rpm=30, tpm=6000))
+    myAIclient.transport = transport
     myAIclient.DEBUG = True
 
     ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,114 @@
+#
+# Hedged requests: when a request to an LLM provider takes longer than most requests do (longer
+# than a given percentile of the recent latencies), a duplicate of it is sent, and whichever
+# answers first is used. This cuts the tail latency of providers with occasional stragglers.
+#
+# The SDKs of the providers are synchronous, so the request that loses the race cannot really
+# be cancelled; it is abandoned, and the tokens it still uses are counted as wasted. To keep
+# the extra cost bounded, at most maxHedgeRate of the requests are hedged, and no hedging is
+# done before enough latencies have been seen to know what a slow request is. The duplicate
+# is a request like any other: the caller decides whether it can be sent (see the send of
+# PromptResponder, where it needs room in the adaptive controller and rate-limit budget).
+#
+# The requests run in a pool of threads, which should be large enough for all the requests
+# that can be in flight at the same time, their duplicates, and the abandoned ones; else a
+# request waits for a thread, and looks slower than it is.
+#
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+
+class HedgingPolicy:
+    """
+    Decide when to hedge a request, and run hedged requests.
+    """
+    def __init__(self, percentile:float=95, minSamples:int=20, window:int=200, maxHedgeRate:float=0.1,
+                 maxWorkers:int=64):
+        self.percentile = percentile
+        self.minSamples = minSamples
+        self.maxHedgeRate = maxHedgeRate
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        # the requests, including the abandoned ones, run in these threads:
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="hedge")
+        # statistics:
+        self.numOfRequests = 0
+        self.numOfHedges = 0
+        self.numOfHedgeWins = 0
+        self.wastedTokens = 0
+        self.DEBUG = False
+
+    def threshold(self) -> float :
+        """
+        The latency after which a request is hedged, or None if not known yet.
+        """
+        with self.lock:
+            if len(self.latencies) < self.minSamples: return None
+            L = sorted(self.latencies)
+        k = min(len(L)-1, int(len(L) * self.percentile / 100))
+        return L[k]
+
+    def mayHedge(self) -> bool :
+        with self.lock:
+            return self.numOfHedges + 1 <= self.maxHedgeRate * max(1,self.numOfRequests)
+
+    def record(self, latency:float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def call(self, fn, usage=None, duplicate=None):
+        """
+        Return fn(), hedging it if it is slow. The function usage(response), if given, returns
+        the number of tokens a response used, to count those of the abandoned request. The
+        function duplicate(), if given, is sent as the duplicate instead of fn; it may fail
+        when it cannot be sent (e.g. when there is no rate-limit budget for it), and fn is
+        then waited for. A duplicate still waiting for a thread when fn answers is cancelled.
+        """
+        with self.lock: self.numOfRequests += 1
+        threshold = self.threshold()
+        t0 = time.monotonic()
+        first = self.pool.submit(fn)
+        if threshold == None:
+            result = first.result()
+            self.record(time.monotonic() - t0)
+            return result
+        done,_ = wait([first], timeout=threshold)
+        if len(done) > 0 or not self.mayHedge():
+            result = first.result()
+            self.record(time.monotonic() - t0)
+            return result
+
+        with self.lock: self.numOfHedges += 1
+        if self.DEBUG: print(f">>> request slower than {threshold:.1f}s, hedging it")
+        second = self.pool.submit(fn if duplicate == None else duplicate)
+        pending = [first,second]
+        while True:
+            done,_ = wait(pending, return_when=FIRST_COMPLETED)
+            winner = done.pop()
+            pending.remove(winner)
+            # if one of them failed, wait for the other:
+            if winner.exception() == None or len(pending) == 0: break
+        # if both failed, the error of the request itself is the one to raise:
+        if winner.exception() != None: winner = first
+        loser = pending[0] if len(pending) > 0 else None
+        if winner is second:
+            with self.lock: self.numOfHedgeWins += 1
+        self.record(time.monotonic() - t0)
+        if loser != None and not loser.cancel():
+            loser.add_done_callback(lambda f: self.countWasted(f, usage))
+        return winner.result()
+
+    def countWasted(self, future, usage):
+        if usage == None or future.exception() != None: return
+        tokens = usage(future.result())
+        if tokens == None: return
+        with self.lock: self.wastedTokens += tokens
+
+    def stats(self) -> dict :
+        return {
+            "hedged" : self.numOfHedges,
+            "hedge wins" : self.numOfHedgeWins,
+            "hedge rate" : self.numOfHedges / max(1,self.numOfRequests),
+            "wasted tokens" : self.wastedTokens
+        }
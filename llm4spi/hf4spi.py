@@ -12,7 +12,7 @@ from typing import Dict, List
 import os
 
 
-from openai4spi import PromptResponder, MyOpenAIClient, generate_results
+from openai4spi import PromptResponder, chat_usage, mark_truncated, MyOpenAIClient, generate_results
 from prompting import create_prompt
 
 
@@ -24,20 +24,20 @@ class MyHugginface_Client(PromptResponder):
         PromptResponder.__init__(self)
         self.client = client
         self.model = modelId 
+        self.maxParallelAnswers = 4
 
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str]:
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
-        responses = []
         # Hugging Face does not support returning multiple answers for
         # the same prompt; or ... it could be depending on the model. For now
-        # We will just iterate over it, repeating the query n-times:
-        for k in range(multipleAnswer):
+        # We will just repeat the query n-times, concurrently:
+        def ask(k):
             # iterating inside the session does not work for various (open source) LLMs,
             # they keep giving the same answer despite the repeat-penalty
-            completion = self.client.chat.completions.create(
+            completion = self.send(lambda: self.client.chat.completions.create(
                 model = self.model,
                 temperature=0.7,
-                max_tokens=1024,
+                max_tokens=1024 if maxTokens == None else maxTokens,
                 # n = ... ,  --> Not supported by HF :(
                  messages=[
                     {
@@ -45,10 +45,9 @@ class MyHugginface_Client(PromptResponder):
                         "content": prompt
                     }
                     ]
-            )
-            R = completion.choices[0].message.content
-            responses.append(R)
-
+            ), prompt, usage=chat_usage)
+            return mark_truncated(completion.choices[0].message.content, completion.choices[0].finish_reason == "length")
+        responses = self.fanOut(multipleAnswer, ask)
         return responses
     
 
@@ -1,46 +1,352 @@
 from llama_cpp import Llama
+import llama_cpp
+from concurrent.futures import Future
 from datetime import datetime
 from typing import Dict
+import threading
+import random
 import time
 import os
 
-from openai4spi import PromptResponder, generate_results
+from openai4spi import PromptResponder, mark_truncated, generate_results
+from localDaemon import LocalDaemonClient, DEFAULT_SOCKET
 
 
+# The sampling parameters of the llama.cpp clients; those not set in Llama.create_completion
+# are its defaults, so that LLAMAcppClient and BatchingServer sample alike:
+SAMPLING_PARAMS = { "temperature" : 0.7, "top_k" : 40, "top_p" : 0.95, "min_p" : 0.05, "repeat_penalty" : 1.0 }
+
 class LLAMAcppClient(PromptResponder):
     """
     An instance of prompt-responder that uses a LLAMA cpp as backend model.
+
+    The multiple answers to a prompt are asked one after the other from the same Llama
+    instance. Llama.generate keeps the longest prefix of the previous tokens that is still
+    in the KV-cache, so only the first answer evaluates the whole prompt; the next ones only
+    re-evaluate its last token. On a CPU, evaluating the prompt is most of the work, so N
+    answers then cost about one prompt evaluation plus N times the generation of an answer.
     """
 
     def __init__(self, client:Llama):
         PromptResponder.__init__(self)
         self.client = client
+        # a Llama instance can only do one thing at a time:
+        self.lock = threading.Lock()
+
+    def samplingParams(self) -> Dict :
+        return dict(SAMPLING_PARAMS)
 
-    def completeIt(self, multipleAnswer: int, prompt: str) -> list[str]:
+    def completeIt(self, multipleAnswer: int, prompt: str, maxTokens: int = None) -> list[str]:
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
         answers = []
-        for k in range(multipleAnswer):
+        with self.lock:
+            for k in range(multipleAnswer):
+                # without a seed, every call draws a new one, so the answers differ:
+                A = self.client(prompt, max_tokens=1024 if maxTokens == None else maxTokens, **SAMPLING_PARAMS)
+                answers.append(mark_truncated(A["choices"][0]["text"].strip(), A["choices"][0]["finish_reason"] == "length"))
+                if self.DEBUG:
+                    print(f">>> raw response {k}:\n {A}")
+        return answers
 
-            # call the prompt
-            A = self.client(prompt, temperature=0.7,max_tokens=1024 )
+class _Request:
+    """
+    A prompt submitted to a BatchingServer, with the state of its answers.
+    """
+    def __init__(self, tokens:list[int], numOfAnswers:int, maxTokens:int):
+        self.tokens = tokens
+        self.maxTokens = maxTokens
+        # the answers that have no sequence yet:
+        self.toStart = numOfAnswers
+        self.answers = [ None ] * numOfAnswers
+        self.numOfFinished = 0
+        self.future = Future()
 
-            # A = self.client.create_chat_completion(
-            #     messages=[
-            #         {"role": "system", "content": "You are an expert developer."},
-            #         {
-            #             "role": "user",
-            #             "content": f"{prompt}"
-            #         }
-            #     ], temperature=0.7,max_tokens=1024
-            # )
+class _Sequence:
+    """
+    An answer being generated by a BatchingServer, in its own sequence of the KV-cache.
+    """
+    def __init__(self, request:_Request, index:int, seqId:int):
+        self.request = request
+        self.index = index
+        self.seqId = seqId
+        # the position of the next token in the sequence:
+        self.pos = len(request.tokens)
+        self.generated = []
+        # where its logits are in the last decoded batch:
+        self.logitsIndex = None
+        # its llama.cpp sampler chain, which keeps the tokens it sampled for the penalties:
+        self.sampler = None
 
-            answers.append(A["choices"][0]["text"].strip())
+class _Prefill:
+    """
+    A prompt being evaluated by a BatchingServer, for the answers of the given sequences.
+    Its tokens are shared by all of them in the KV-cache.
+    """
+    def __init__(self, request:_Request, sequences:list[_Sequence]):
+        self.request = request
+        self.sequences = sequences
+        self.numOfDone = 0
+        self.logitsIndex = None
 
-            # answers.append(A["choices"][0]['message']['content'].strip())
 
-            if self.DEBUG:
-                print(f">>> raw response {k}:\n {A}")
-        return answers
+class BatchingServer:
+    """
+    A local generation server doing continuous batching over a llama.cpp model. Prompts,
+    typically coming from many tasks at once (see the concurrency of generate_results), are
+    queued; every answer asked becomes a sequence of a shared context, and all sequences are
+    decoded together, one token each per step. A new prompt joins the batch as soon as there
+    is a free sequence; its evaluation is spread over the next steps, within the batch size.
+    A finished answer leaves the batch and its sequence is freed, without waiting for the others.
+
+    The N answers to a prompt share the evaluation of the prompt: its tokens are put in all
+    their sequences at once.
+
+    On a CPU, decoding a batch of tokens costs little more than decoding one, since the
+    weights are read once for the whole batch; so the throughput grows with the number of
+    sequences decoded together (the slots).
+
+    The answers are sampled by llama.cpp sampler chains built as Llama.create_completion
+    builds its own, with the same parameters as LLAMAcppClient (SAMPLING_PARAMS). The
+    server uses the llama.cpp C API directly, which changes between versions of
+    llama-cpp-python; it is written against the version pinned in requirements.txt.
+    """
+    def __init__(self, client:Llama, slots:int=8, contextPerSlot:int=None, params:Dict=None):
+        self.client = client
+        self.slots = slots
+        self.contextPerSlot = client.n_ctx() if contextPerSlot == None else contextPerSlot
+        self.params = dict(SAMPLING_PARAMS)
+        if params != None: self.params.update(params)
+        self.model = client.model
+        self.vocab = llama_cpp.llama_model_get_vocab(self.model)
+        # a context of its own, whose KV-cache holds all the sequences:
+        params = llama_cpp.llama_context_params.from_buffer_copy(client.context_params)
+        params.n_ctx = self.slots * self.contextPerSlot
+        params.n_seq_max = self.slots
+        self.batchSize = params.n_batch
+        self.ctx = llama_cpp.llama_init_from_model(self.model, params)
+        if self.ctx == None:
+            raise ValueError(f"Failed to create a llama.cpp context of {params.n_ctx} tokens")
+        self.batch = llama_cpp.llama_batch_init(self.batchSize, 0, self.slots)
+        # to draw a different seed for every answer:
+        self.random = random.Random()
+        self.lock = threading.Condition()
+        self.queue = []
+        self.freeSeqIds = list(range(self.slots))
+        self.prefills = []
+        self.sequences = []
+        self.closed = False
+        # statistics:
+        self.numOfSteps = 0
+        self.numOfGenerated = 0
+        self.DEBUG = False
+        self.thread = threading.Thread(target=self.run, name="llamacpp-batching", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt:str, numOfAnswers:int, maxTokens:int) -> Future :
+        """
+        Queue a prompt; the future gives the list of its (answer,truncated) once they are all in.
+        """
+        tokens = self.client.tokenize(prompt.encode("utf-8"), special=True)
+        R = _Request(tokens, numOfAnswers, maxTokens)
+        if len(tokens) >= self.contextPerSlot:
+            R.future.set_exception(ValueError(f"The prompt has {len(tokens)} tokens, more than the context window of {self.contextPerSlot}"))
+            return R.future
+        if numOfAnswers <= 0:
+            R.future.set_result([])
+            return R.future
+        with self.lock:
+            if self.closed: raise Exception("The batching server is closed")
+            self.queue.append(R)
+            self.lock.notify_all()
+        return R.future
+
+    def admit(self):
+        """
+        Give the free sequences to the queued prompts, oldest first.
+        """
+        with self.lock:
+            while len(self.queue) == 0 and len(self.prefills) == 0 and len(self.sequences) == 0 and not self.closed:
+                self.lock.wait()
+            while len(self.queue) > 0 and len(self.freeSeqIds) > 0:
+                R = self.queue[0]
+                k = min(R.toStart, len(self.freeSeqIds))
+                first = len(R.answers) - R.toStart
+                S = [ _Sequence(R, first + i, self.freeSeqIds.pop()) for i in range(k) ]
+                R.toStart -= k
+                if R.toStart == 0: self.queue.pop(0)
+                self.prefills.append(_Prefill(R, S))
+
+    def addToken(self, i:int, token:int, pos:int, seqIds:list[int], logits:bool):
+        B = self.batch
+        B.token[i] = token
+        B.pos[i] = pos
+        B.n_seq_id[i] = len(seqIds)
+        for (j,seqId) in enumerate(seqIds): B.seq_id[i][j] = seqId
+        B.logits[i] = 1 if logits else 0
+
+    def fillBatch(self) -> int :
+        """
+        Put in the batch the next token of every sequence being generated, then as many
+        tokens of the prompts being evaluated as fit. Returns the number of tokens.
+        """
+        n = 0
+        for S in self.sequences:
+            self.addToken(n, S.generated[-1], S.pos, [S.seqId], True)
+            S.logitsIndex = n
+            S.pos += 1
+            n += 1
+        for P in self.prefills:
+            if n >= self.batchSize: break
+            tokens = P.request.tokens
+            seqIds = [ S.seqId for S in P.sequences ]
+            while P.numOfDone < len(tokens) and n < self.batchSize:
+                last = P.numOfDone == len(tokens) - 1
+                self.addToken(n, tokens[P.numOfDone], P.numOfDone, seqIds, last)
+                if last: P.logitsIndex = n
+                P.numOfDone += 1
+                n += 1
+        self.batch.n_tokens = n
+        return n
+
+    def newSampler(self):
+        """
+        A sampler chain for an answer, as Llama.create_completion builds it: penalties,
+        top-k, typical, top-p, min-p, temperature, then a draw with a seed of its own.
+        """
+        P = self.params
+        chain = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        for sampler in [ llama_cpp.llama_sampler_init_penalties(self.client.last_n_tokens_size, P["repeat_penalty"], 0.0, 0.0),
+                         llama_cpp.llama_sampler_init_top_k(P["top_k"]),
+                         llama_cpp.llama_sampler_init_typical(1.0, 1),
+                         llama_cpp.llama_sampler_init_top_p(P["top_p"], 1),
+                         llama_cpp.llama_sampler_init_min_p(P["min_p"], 1),
+                         llama_cpp.llama_sampler_init_temp(P["temperature"]),
+                         llama_cpp.llama_sampler_init_dist(self.random.randrange(2**31)) ]:
+            llama_cpp.llama_sampler_chain_add(chain, sampler)
+        return chain
+
+    def step(self):
+        n = self.fillBatch()
+        if n == 0: return
+        status = llama_cpp.llama_decode(self.ctx, self.batch)
+        if status != 0:
+            # e.g. no room left in the KV-cache; fail the requests in the batch:
+            self.failAll(Exception(f"llama_decode failed with status {status}"))
+            return
+        self.numOfSteps += 1
+        self.numOfGenerated += len(self.sequences)
+        # prompts that are completely evaluated start their answers:
+        for P in [ P for P in self.prefills if P.logitsIndex != None ]:
+            self.prefills.remove(P)
+            self.sequences.extend(P.sequences)
+            for S in P.sequences:
+                S.logitsIndex = P.logitsIndex
+                S.sampler = self.newSampler()
+        for S in list(self.sequences):
+            # sampling also accepts the token into the chain, for the repeat penalty:
+            token = llama_cpp.llama_sampler_sample(S.sampler, self.ctx, S.logitsIndex)
+            # end-of-generation tokens include e.g. end-of-turn, besides end-of-sequence:
+            if llama_cpp.llama_vocab_is_eog(self.vocab, token):
+                self.finish(S, False)
+                continue
+            S.generated.append(token)
+            if len(S.generated) >= S.request.maxTokens or S.pos >= self.contextPerSlot:
+                self.finish(S, True)
+
+    def finish(self, S:_Sequence, truncated:bool):
+        self.sequences.remove(S)
+        self.release(S)
+        R = S.request
+        R.answers[S.index] = (self.client.detokenize(S.generated).decode("utf-8", errors="ignore"), truncated)
+        R.numOfFinished += 1
+        with self.lock:
+            self.freeSeqIds.append(S.seqId)
+        if R.numOfFinished == len(R.answers):
+            R.future.set_result(R.answers)
+
+    def release(self, S:_Sequence):
+        """
+        Drop the sequence from the KV-cache, and free its sampler chain.
+        """
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, S.seqId, -1, -1)
+        if S.sampler != None:
+            llama_cpp.llama_sampler_free(S.sampler)
+            S.sampler = None
+
+    def failAll(self, error:Exception):
+        failed = set()
+        for S in self.sequences + [ S for P in self.prefills for S in P.sequences ]:
+            self.release(S)
+            failed.add(S.request)
+        with self.lock:
+            self.freeSeqIds = list(range(self.slots))
+            self.sequences = []
+            self.prefills = []
+            # the rest of the answers of a failed request are not asked either:
+            self.queue = [ R for R in self.queue if not (R in failed) ]
+        for R in failed:
+            if not R.future.done(): R.future.set_exception(error)
+
+    def run(self):
+        while True:
+            self.admit()
+            if self.closed: break
+            try:
+                self.step()
+            except Exception as e:
+                self.failAll(e)
+        self.failAll(Exception("The batching server is closed"))
+        for R in self.queue:
+            R.future.set_exception(Exception("The batching server is closed"))
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join()
+
+    def stats(self) -> Dict :
+        return {
+            "decode steps" : self.numOfSteps,
+            "generated tokens" : self.numOfGenerated,
+            "tokens per step" : self.numOfGenerated / max(1,self.numOfSteps)
+        }
+
+
+class LLAMAcppBatchingClient(PromptResponder):
+    """
+    An instance of prompt-responder whose prompts are answered by a BatchingServer, so that
+    the prompts sent at the same time (e.g. with concurrency) are decoded together.
+    """
+    def __init__(self, server:BatchingServer):
+        PromptResponder.__init__(self)
+        self.server = server
+
+    def completeIt(self, multipleAnswer: int, prompt: str, maxTokens: int = None) -> list[str]:
+        if self.DEBUG: print(">>> PROMPT:\n" + prompt)
+        if maxTokens == None: maxTokens = 1024
+        answers = self.server.submit(prompt, multipleAnswer, maxTokens).result()
+        if self.DEBUG:
+            for (k,(A,_)) in enumerate(answers): print(f">>> raw response {k}:\n {A}")
+        return [ mark_truncated(A.strip(), truncated) for (A,truncated) in answers ]
+
+    def samplingParams(self) -> Dict :
+        return dict(self.server.params)
+
+    def requestStats(self) -> Dict :
+        stats = dict(PromptResponder.requestStats(self))
+        stats.update(self.server.stats())
+        return stats
+
+class LLAMAcppDaemonClient(LocalDaemonClient):
+    """
+    An instance of prompt-responder whose llama.cpp model is kept loaded across runs by the
+    local model daemon (see localDaemon.py), which is started if it is not running.
+    """
+    def __init__(self, model:str, modelPath:str, socketPath:str=DEFAULT_SOCKET):
+        LocalDaemonClient.__init__(self, "llamacpp", model, modelPath, socketPath=socketPath)
 
 if __name__ == '__main__':
     llamaClient = Llama(model_path="~/.local/share/nomic.ai/GPT4All/mistral-7b-instruct-v0.1.Q4_0.gguf", n_gpu_layers=-1)
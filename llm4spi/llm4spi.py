@@ -4,41 +4,94 @@
 #
 from datetime import datetime
 from gpt4all import GPT4All
+from gpt4all.gpt4all import DEFAULT_PROMPT_TEMPLATE
 from typing import Dict
+import threading
 import time
 import os
 
-from openai4spi import PromptResponder, generate_results
+from openai4spi import PromptResponder, mark_truncated, generate_results
+from localDaemon import LocalDaemonClient, DEFAULT_SOCKET
+
+# the sampling parameters of the answers; those of GPT4All.generate, with a higher
+# repeat-penalty:
+GENERATION_PARAMS = { "temp" : 0.7, "top_k" : 40, "top_p" : 0.4, "min_p" : 0.0,
+                      "repeat_penalty" : 1.5, "repeat_last_n" : 64, "n_batch" : 8 }
+
+def ignore_response(token_id:int, response:str) -> bool :
+    return True
 
 class MyGPT4ALL_Client(PromptResponder):
     """
     An instance of prompt-responder that uses a GPT4All's LLM as the backend model.
+
+    The system prompt and the prompt are ingested once for all the answers. Before sampling
+    each answer, the model's context is rewound to the end of the prompt: the KV-cache keeps
+    the prompt, and the model drops what comes after it when it evaluates new tokens. The
+    start of the answer in the chat template is evaluated again, to sample the first token
+    from. The random generator is not rewound, so the answers differ as much as when each
+    was asked in its own chat session; asking them in one chat session gives the same
+    answer over and over, as each follows the previous ones.
     """
     def __init__(self, client:GPT4All):
         PromptResponder.__init__(self)
         self.client = client
-    
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str]:
+        # the model has one context, so it answers one prompt at a time:
+        self.lock = threading.Lock()
+
+    def samplingParams(self) -> Dict :
+        return GENERATION_PARAMS
+
+    def ingest(self, prompt:str, userStart:str) -> tuple :
+        """
+        Ingest the system prompt, and the prompt in the user's turn of the chat template, in
+        a fresh context, as GPT4All.chat_session and generate do. Returns where the context
+        is then, as (n_past, tokens_size).
+        """
+        model = self.client.model
+        model.prompt_model(self.client.config.get("systemPrompt", ""), "%1%2", ignore_response,
+                           n_predict=0, reset_context=True, special=True, **GENERATION_PARAMS)
+        # the special tokens of the template are recognized, not those of the prompt:
+        model.prompt_model(prompt, userStart + "%1%2", ignore_response, n_predict=0, **GENERATION_PARAMS)
+        return (model.context.n_past, model.context.tokens_size)
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
+        if maxTokens == None: maxTokens = 1024
+        # the chat template, split at the prompt: the start of the user's turn, and the rest
+        # up to the start of the answer:
+        template = self.client.config.get("promptTemplate", DEFAULT_PROMPT_TEMPLATE).format("%1","%2")
+        (userStart, answerStart) = template.split("%2")[0].split("%1")
+        if answerStart == "":
+            # something has to be evaluated before sampling; the last character of the prompt:
+            (prompt, answerStart) = (prompt[:-1], prompt[-1:])
+        model = self.client.model
         answers = []
-        for k in range(multipleAnswer):
-            # iterating inside the session does not work for various (open source) LLMs,
-            # they keep giving the same answer despite the repeat-penalty
-            with self.client.chat_session():
-                A = self.client.generate(prompt, 
-                                temp=0.7,
-                                max_tokens=1024,
-                                repeat_penalty=1.5
-                                #repeat_last_n=multipleAnswer
-                                )
+        with self.lock:
+            promptEnd = self.ingest(prompt, userStart)
+            for k in range(multipleAnswer):
+                (model.context.n_past, model.context.tokens_size) = promptEnd
+                # streamed, just to count the tokens, to know if the answer was truncated:
+                tokens = list(model.prompt_model_streaming("", answerStart + "%1%2",
+                                n_predict=maxTokens, **GENERATION_PARAMS))
+                A = mark_truncated("".join(tokens), len(tokens) >= maxTokens)
                 answers.append(A)
-                #answer2 = self.client.generate("Please only give the Python code, without comment.", max_tokens=1024)
-                # srtipping header seems difficult for some LLM :|
-                #answer3 = self.client.generate("Please remove the function header.", max_tokens=1024)
-                if self.DEBUG: 
+                if self.DEBUG:
                     print(f">>> raw response {k}:\n {A}")
+                # an answer that overflows the context makes the model erase the start of
+                # it, the prompt included; it is then ingested again:
+                if model.context.n_past < promptEnd[0] + len(tokens) and k+1 < multipleAnswer:
+                    promptEnd = self.ingest(prompt, userStart)
         return answers
 
+class MyGPT4ALL_DaemonClient(LocalDaemonClient):
+    """
+    An instance of prompt-responder whose GPT4All model is kept loaded across runs by the
+    local model daemon (see localDaemon.py), which is started if it is not running.
+    """
+    def __init__(self, model:str, modelPath:str, device:str="cpu", socketPath:str=DEFAULT_SOCKET):
+        LocalDaemonClient.__init__(self, "gpt4all", model, modelPath, device=device, socketPath=socketPath)
+
 
 if __name__ == '__main__':
     #gpt4allClient = GPT4All("orca-mini-3b-gguf2-q4_0.gguf", model_path="/root/models", device="cuda:NVIDIA A16 (3)") #device is specific to cluster's GPU, change accordingly when run on a different computer
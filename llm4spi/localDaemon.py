@@ -0,0 +1,345 @@
+#
+# A daemon keeping local models (llama.cpp and GPT4All) loaded across runs, so that each
+# run of clispi.py does not have to load a multi-GB model again before its first prompt.
+# It is started with
+#
+#    python localDaemon.py [--socket=<path>] [--memory=<GB>] [--idle_timeout=<minutes>]
+#
+# or automatically by the first client that finds no daemon. Clients (see LocalDaemonClient,
+# and its subclasses in llamacpp4spi and llm4spi) send their prompts over a Unix socket; the
+# daemon loads the model a prompt asks for if it does not have it yet. Models stay loaded
+# as long as their total size fits in the memory budget; beyond it, the least recently used
+# ones are unloaded. Models in use are not unloaded: a model that does not fit then waits
+# until they are released (a model larger than the whole budget is refused). The daemon
+# stops by itself after being idle for a while. A daemon started by a client writes its
+# output to <socket>.log.
+#
+# The protocol is line-based JSON, as in distEvaluate: a client sends a request, and the
+# daemon answers it, on the same connection. A client can have several connections, which
+# the daemon serves at the same time; prompts to the same model are answered one at a time.
+#
+from collections import OrderedDict
+from typing import Dict
+import sys, getopt
+import subprocess
+import tempfile
+import threading
+import socket
+import json
+import time
+import os
+
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated
+from localPool import create_local_responder, available_cores
+
+DEFAULT_SOCKET = os.environ.get("LLM4SPI_DAEMON_SOCKET", os.path.join(tempfile.gettempdir(), f"llm4spi-daemon-{os.getuid()}.sock"))
+DEFAULT_MEMORY = 32         # in GB
+DEFAULT_IDLE_TIMEOUT = 60   # in minutes
+STARTUP_TIMEOUT = 30        # in seconds
+
+def send_message(conn:socket.socket, message:Dict):
+    conn.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+
+class LoadedModel:
+    def __init__(self, key:tuple, AI:PromptResponder, size:int):
+        self.key = key
+        self.AI = AI
+        self.size = size
+        # prompts to the same model are answered one at a time:
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class LocalModelDaemon:
+    """
+    Serve the prompts of the clients connecting to the given Unix socket, keeping the
+    models they use loaded within the given memory budget (in bytes).
+    """
+    def __init__(self, socketPath:str, maxBytes:int, idleTimeout:float=None):
+        self.socketPath = socketPath
+        self.maxBytes = maxBytes
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Condition()
+        # the loaded models, least recently used first:
+        self.models = OrderedDict()
+        self.loading = set()
+        # the memory taken by the models being loaded:
+        self.reserved = 0
+        self.lastActivity = time.monotonic()
+        self.numOfConnections = 0
+        self.numOfLoads = 0
+        self.numOfPrompts = 0
+        if os.path.exists(socketPath):
+            if daemon_is_running(socketPath):
+                raise Exception(f"A local model daemon is already listening on {socketPath}")
+            # left by a daemon that did not stop cleanly:
+            os.remove(socketPath)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socketPath)
+        self.server.listen()
+        self.server.settimeout(1)
+
+    def run(self):
+        print(f"** Local model daemon listening on {self.socketPath}, memory budget {self.maxBytes / 2**30:.1f} GB")
+        try:
+            while True:
+                try:
+                    (conn,_) = self.server.accept()
+                except socket.timeout:
+                    if self.idleTimeout == None: continue
+                    with self.lock:
+                        idle = self.numOfConnections == 0 and time.monotonic() - self.lastActivity > self.idleTimeout
+                    if idle:
+                        print("** Local model daemon idle, stopping")
+                        return
+                    continue
+                with self.lock: self.numOfConnections += 1
+                threading.Thread(target=self.serveClient, args=(conn,), daemon=True).start()
+        finally:
+            self.server.close()
+            if os.path.exists(self.socketPath): os.remove(self.socketPath)
+
+    def serveClient(self, conn:socket.socket):
+        reader = conn.makefile("r", encoding="utf-8")
+        try:
+            for line in reader:
+                request = json.loads(line)
+                try:
+                    match request.get("type"):
+                        case "complete":
+                            answers = self.complete(request)
+                            send_message(conn, { "type" : "answers", "answers" : [ [str(A), isinstance(A,TruncatedAnswer)] for A in answers ] })
+                        case "load":
+                            self.release(self.acquire(request))
+                            send_message(conn, { "type" : "loaded" })
+                        case "stats":
+                            send_message(conn, { "type" : "stats", "stats" : self.stats() })
+                        case _:
+                            send_message(conn, { "type" : "error", "error" : f"Unknown request {request.get('type')}" })
+                except Exception as e:
+                    send_message(conn, { "type" : "error", "error" : f"{type(e).__name__}: {e}" })
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                self.numOfConnections -= 1
+                self.lastActivity = time.monotonic()
+
+    def complete(self, request:Dict) -> list[str] :
+        M = self.acquire(request)
+        with self.lock: self.numOfPrompts += 1
+        try:
+            with M.lock:
+                return M.AI.completeIt(request["n"], request["prompt"], maxTokens=request.get("maxTokens"))
+        finally:
+            self.release(M)
+
+    def acquire(self, request:Dict) -> LoadedModel :
+        """
+        Return the model the request asks for, loading it if needed; it is marked as in
+        use until released.
+        """
+        key = (request["provider"], os.path.abspath(os.path.join(request["modelPath"], request["model"])), request.get("device","cpu"))
+        with self.lock:
+            # the same model may be being loaded for another client:
+            while key in self.loading: self.lock.wait()
+            M = self.models.get(key)
+            if M != None:
+                self.models.move_to_end(key)
+                M.users += 1
+                return M
+            self.loading.add(key)
+        reservedSize = 0
+        try:
+            size = os.path.getsize(key[1]) if os.path.exists(key[1]) else 0
+            self.makeRoom(size)
+            reservedSize = size
+            print(f"** Loading {key[1]}")
+            AI = create_local_responder(request["provider"], request["model"], request["modelPath"], len(available_cores()), key[2])
+            with self.lock:
+                M = LoadedModel(key, AI, size)
+                self.models[key] = M
+                M.users += 1
+                self.numOfLoads += 1
+                return M
+        finally:
+            with self.lock:
+                self.loading.discard(key)
+                # what makeRoom reserved is now taken by the loaded model, or it failed to load:
+                self.reserved -= reservedSize
+                self.lock.notify_all()
+
+    def release(self, M:LoadedModel):
+        with self.lock:
+            M.users -= 1
+            self.lastActivity = time.monotonic()
+            # a load may be waiting for the model to be unused:
+            self.lock.notify_all()
+
+    def makeRoom(self, size:int):
+        """
+        Unload the least recently used models that are not in use, until a model of the
+        given size fits in the memory budget, and reserve that size for it. If it does not
+        fit because of models in use, wait until they are released.
+        """
+        if size > self.maxBytes:
+            raise Exception(f"The model ({size / 2**30:.1f} GB) does not fit in the memory budget of the daemon ({self.maxBytes / 2**30:.1f} GB)")
+        with self.lock:
+            while True:
+                total = self.reserved + sum(M.size for M in self.models.values())
+                for M in list(self.models.values()):
+                    if total + size <= self.maxBytes: break
+                    if M.users > 0: continue
+                    print(f"** Unloading {M.key[1]}")
+                    del self.models[M.key]
+                    total -= M.size
+                    close = getattr(getattr(M.AI, "client", None), "close", None)
+                    if close != None: close()
+                if total + size <= self.maxBytes: break
+                print(f"** Waiting for models in use to be released, to load a model of {size / 2**30:.1f} GB")
+                self.lock.wait()
+            self.reserved += size
+
+    def stats(self) -> Dict :
+        with self.lock:
+            return {
+                "loaded models" : [ M.key[1] for M in self.models.values() ],
+                "loaded bytes" : sum(M.size for M in self.models.values()),
+                "loads" : self.numOfLoads,
+                "prompts" : self.numOfPrompts
+            }
+
+
+def daemon_is_running(socketPath:str) -> bool :
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def start_daemon(socketPath:str=DEFAULT_SOCKET):
+    """
+    Start a daemon on the given socket, in the background, and wait until it listens. Its
+    output goes to <socketPath>.log.
+    """
+    script = os.path.abspath(__file__)
+    logfile = socketPath + ".log"
+    with open(logfile, "a") as log:
+        # unbuffered (-u), so that the log is up to date if the daemon dies:
+        subprocess.Popen([sys.executable, "-u", script, f"--socket={socketPath}"],
+                         cwd=os.path.dirname(script),
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if daemon_is_running(socketPath): return
+        time.sleep(0.1)
+    raise Exception(f"The local model daemon did not start on {socketPath}; see {logfile}")
+
+
+class LocalDaemonClient(PromptResponder):
+    """
+    A prompt-responder whose prompts are answered by a local model loaded in the daemon
+    listening on the given socket. If there is no daemon, one is started.
+    """
+    def __init__(self, provider:str, model:str, modelPath:str, device:str="cpu",
+                 socketPath:str=DEFAULT_SOCKET, autostart:bool=True):
+        PromptResponder.__init__(self)
+        self.provider = provider
+        self.model = model
+        self.modelPath = os.path.abspath(modelPath)
+        self.device = device
+        self.socketPath = socketPath
+        self.autostart = autostart
+        # each thread has its own connection, so that prompts can be sent at the same time:
+        self.local = threading.local()
+
+    def connection(self):
+        C = getattr(self.local, "connection", None)
+        if C != None: return C
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socketPath)
+        except OSError:
+            if not self.autostart: raise
+            start_daemon(self.socketPath)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socketPath)
+        C = (sock, sock.makefile("r", encoding="utf-8"))
+        self.local.connection = C
+        return C
+
+    def ask(self, request:Dict) -> Dict :
+        (sock,reader) = self.connection()
+        try:
+            send_message(sock, request)
+            line = reader.readline()
+        except OSError:
+            self.local.connection = None
+            raise
+        if line == "":
+            self.local.connection = None
+            raise Exception(f"The local model daemon on {self.socketPath} closed the connection")
+        answer = json.loads(line)
+        if answer["type"] == "error":
+            raise Exception(answer["error"])
+        return answer
+
+    def modelRequest(self, requestType:str) -> Dict :
+        return { "type" : requestType, "provider" : self.provider, "model" : self.model,
+                 "modelPath" : self.modelPath, "device" : self.device }
+
+    def load(self):
+        """
+        Have the daemon load the model, if it does not have it yet.
+        """
+        self.ask(self.modelRequest("load"))
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        if self.DEBUG: print(">>> PROMPT:\n" + prompt)
+        request = self.modelRequest("complete")
+        request.update({ "n" : multipleAnswer, "prompt" : prompt, "maxTokens" : maxTokens })
+        answers = [ mark_truncated(A, truncated) for (A,truncated) in self.ask(request)["answers"] ]
+        if self.DEBUG:
+            for (k,A) in enumerate(answers): print(f">>> raw response {k}:\n {A}")
+        return answers
+
+
+options = [
+   ("socket", f"The Unix socket to listen on. Default is {DEFAULT_SOCKET} (or LLM4SPI_DAEMON_SOCKET)."),
+   ("memory", f"The memory budget for the loaded models, in GB. Default is {DEFAULT_MEMORY}."),
+   ("idle_timeout", f"The daemon stops after being idle this many minutes. Default is {DEFAULT_IDLE_TIMEOUT}; 0 means never.")
+]
+
+helptxt = "python localDaemon.py [--option=arg]*\n"
+helptxt += "   Options:\n"
+for o in options:
+   helptxt +=  f"   --{o[0]} : {o[1]}\n"
+
+def main(argv):
+   socket_ = DEFAULT_SOCKET
+   memory_ = DEFAULT_MEMORY
+   idle_timeout_ = DEFAULT_IDLE_TIMEOUT
+   try:
+      opts, args = getopt.getopt(argv,"h", [ o[0] + "=" for o in options])
+   except getopt.GetoptError:
+      print (helptxt)
+      sys.exit(2)
+   for opt, arg in opts:
+      match opt:
+         case "-h":
+            print (helptxt)
+            sys.exit()
+         case "--socket" : socket_ = arg
+         case "--memory" : memory_ = float(arg)
+         case "--idle_timeout" : idle_timeout_ = float(arg)
+   daemon = LocalModelDaemon(socket_, int(memory_ * 2**30), None if idle_timeout_ == 0 else idle_timeout_ * 60)
+   daemon.run()
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,245 @@
+#
+# A pool of processes, each running its own instance of a local model (llama.cpp or GPT4All),
+# to use a many-core machine: one instance does not scale past a handful of threads, but
+# several instances, each on its own cores, do.
+#
+# Every worker process is pinned to a disjoint set of cores, and its model uses as many
+# threads as it has cores. The pool gives each prompt to a worker that is free, through a
+# queue of that worker; so if a worker dies, the pool knows which prompt it had, and gives
+# it to another worker. The gguf model file is mmap'd by every worker, so its
+# pages are in memory once, shared by all of them.
+#
+# The pool is a PromptResponder, answering up to one prompt per worker at the same time; run
+# generate_results with a concurrency of at least the number of workers to keep them busy.
+#
+from concurrent.futures import Future
+from typing import Dict
+import multiprocessing
+import collections
+import itertools
+import threading
+import queue
+import os
+
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated
+
+LOCAL_PROVIDERS = [ "llamacpp", "gpt4all" ]
+# how many times a prompt is given to a worker, if its workers die:
+MAX_ATTEMPTS = 2
+# how long (in seconds) closing the pool waits for a worker to finish its prompt:
+CLOSE_TIMEOUT = 30
+
+def available_cores() -> list[int] :
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def partition_cores(workers:int, cores:list[int]=None) -> list[list[int]] :
+    """
+    Split the cores into the given number of disjoint sets, as equal as possible. If there
+    are fewer cores than workers, some workers share a core.
+    """
+    if cores == None: cores = available_cores()
+    if workers >= len(cores):
+        return [ [cores[k % len(cores)]] for k in range(workers) ]
+    size = len(cores) // workers
+    extra = len(cores) % workers
+    sets = []
+    start = 0
+    for k in range(workers):
+        end = start + size + (1 if k < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+def create_local_responder(provider:str, model:str, modelPath:str, threads:int, device:str="cpu") -> PromptResponder :
+    """
+    Load a local model, using the given number of threads, and return its PromptResponder.
+    """
+    match provider:
+        case "llamacpp":
+            from llama_cpp import Llama
+            from llamacpp4spi import LLAMAcppClient
+            client = Llama(model_path=os.path.join(modelPath,model), n_gpu_layers=-1,
+                           n_threads=threads, n_threads_batch=threads, use_mmap=True, verbose=False)
+            return LLAMAcppClient(client)
+        case "gpt4all":
+            from gpt4all import GPT4All
+            from llm4spi import MyGPT4ALL_Client
+            client = GPT4All(model, model_path=modelPath, device=device, n_threads=threads)
+            return MyGPT4ALL_Client(client)
+    raise Exception(f"Unknown local provider {provider}, it should be one of {LOCAL_PROVIDERS}")
+
+def _serve_local_model(workerId:int, spec:Dict, cores:list[int], threads:int, requests, results):
+    """
+    The loop of a worker process: answer the prompts from its requests queue, until a None.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    AI = create_local_responder(spec["provider"], spec["model"], spec["modelPath"], threads, spec["device"])
+    AI.DEBUG = spec["DEBUG"]
+    while True:
+        job = requests.get()
+        if job == None: break
+        (jobId, multipleAnswer, prompt, maxTokens) = job
+        try:
+            answers = AI.completeIt(multipleAnswer, prompt, maxTokens=maxTokens)
+            results.put(("done", jobId, [ (str(A), isinstance(A,TruncatedAnswer)) for A in answers ]))
+        except Exception as e:
+            results.put(("failed", jobId, f"{type(e).__name__}: {e}"))
+
+
+class LocalPoolResponder(PromptResponder):
+    """
+    A prompt-responder spreading the prompts over a pool of worker processes, each with its
+    own instance of a local model (see the top of this module).
+    """
+    def __init__(self, provider:str, model:str, modelPath:str, workers:int,
+                 device:str="cpu", threadsPerWorker:int=None, DEBUG:bool=False):
+        PromptResponder.__init__(self)
+        if not (provider in LOCAL_PROVIDERS):
+            raise Exception(f"Unknown local provider {provider}, it should be one of {LOCAL_PROVIDERS}")
+        self.model = model
+        self.workers = workers
+        self.DEBUG = DEBUG
+        spec = { "provider" : provider, "model" : model, "modelPath" : modelPath, "device" : device, "DEBUG" : DEBUG }
+        # the workers are spawned, rather than forked, as this process may already run threads:
+        context = multiprocessing.get_context("spawn")
+        # each worker has its own queue of prompts, so that the pool knows who has which:
+        self.requests = [ context.Queue() for k in range(workers) ]
+        self.results = context.Queue()
+        self.processes = []
+        for (k,cores) in enumerate(partition_cores(workers)):
+            threads = len(cores) if threadsPerWorker == None else threadsPerWorker
+            if DEBUG: print(f">>> local worker {k} on cores {cores}, {threads} threads")
+            P = context.Process(target=_serve_local_model, args=(k, spec, cores, threads, self.requests[k], self.results), daemon=True)
+            P.start()
+            self.processes.append(P)
+        self.lock = threading.Lock()
+        self.jobIds = itertools.count()
+        # the prompts not answered yet, by job-id: their future, and the job itself:
+        self.pending = {}
+        self.jobs = {}
+        # the jobs waiting for a worker, the workers waiting for a job, which worker has
+        # which job, and how many times a job was given to a worker:
+        self.waiting = collections.deque()
+        self.idle = list(range(workers))
+        self.assignedTo = {}
+        self.attempts = {}
+        self.dead = set()
+        # statistics:
+        self.numOfPrompts = [ 0 ] * workers
+        self.numOfRequeued = 0
+        # when closing, the workers stop, and are not dead:
+        self.closing = False
+        self.closed = False
+        self.collector = threading.Thread(target=self.collect, name="local-pool", daemon=True)
+        self.collector.start()
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        F = Future()
+        with self.lock:
+            if self.closed: raise Exception("The pool of local models is closed")
+            jobId = next(self.jobIds)
+            self.pending[jobId] = F
+            self.jobs[jobId] = (jobId, multipleAnswer, prompt, maxTokens)
+            self.waiting.append(jobId)
+            self.dispatch()
+        return [ mark_truncated(A, truncated) for (A,truncated) in F.result() ]
+
+    def dispatch(self):
+        """
+        Give the waiting jobs to the idle workers. The lock should be held.
+        """
+        while len(self.waiting) > 0 and len(self.idle) > 0:
+            k = self.idle.pop(0)
+            jobId = self.waiting.popleft()
+            self.assignedTo[jobId] = k
+            self.attempts[jobId] = self.attempts.get(jobId,0) + 1
+            self.numOfPrompts[k] += 1
+            self.requests[k].put(self.jobs[jobId])
+
+    def collect(self):
+        """
+        Pass the answers coming from the workers to the prompts waiting for them; give the
+        prompts of the workers that died to the others.
+        """
+        while not self.closed:
+            try:
+                (kind, jobId, payload) = self.results.get(timeout=1)
+            except queue.Empty:
+                self.checkWorkers()
+                continue
+            with self.lock:
+                F = self.pending.pop(jobId, None)
+                self.jobs.pop(jobId, None)
+                self.attempts.pop(jobId, None)
+                k = self.assignedTo.pop(jobId, None)
+                if k != None and not (k in self.dead): self.idle.append(k)
+                self.dispatch()
+            if F == None: continue
+            if kind == "done":
+                F.set_result(payload)
+            else:
+                F.set_exception(Exception(payload))
+
+    def checkWorkers(self):
+        """
+        Requeue the prompts of the workers that died, once; a prompt whose worker died twice
+        (e.g. because it crashes the model) fails. If all workers died, all prompts fail.
+        """
+        with self.lock:
+            if self.closing: return
+            dead = [ k for (k,P) in enumerate(self.processes) if not (k in self.dead) and not P.is_alive() ]
+            if len(dead) == 0: return
+            self.dead.update(dead)
+            self.idle = [ k for k in self.idle if not (k in self.dead) ]
+            lost = [ jobId for (jobId,k) in self.assignedTo.items() if k in dead ]
+            failed = []
+            for jobId in lost:
+                del self.assignedTo[jobId]
+                if self.attempts[jobId] >= MAX_ATTEMPTS:
+                    failed.append(jobId)
+                else:
+                    self.waiting.appendleft(jobId)
+                    self.numOfRequeued += 1
+            if len(self.dead) == len(self.processes):
+                # nobody is left to answer the waiting prompts either:
+                failed.extend(self.waiting)
+                self.waiting.clear()
+            futures = [ self.pending.pop(jobId) for jobId in failed if jobId in self.pending ]
+            for jobId in failed:
+                self.jobs.pop(jobId, None)
+                self.attempts.pop(jobId, None)
+            self.dispatch()
+        if self.DEBUG: print(f">>> local worker(s) {dead} died; {len(lost)} prompts given to the others")
+        for F in futures:
+            F.set_exception(Exception(f"The local model worker(s) {sorted(self.dead)} died"))
+
+    def close(self):
+        """
+        Stop the workers, once they are done with the prompts they have.
+        """
+        with self.lock: self.closing = True
+        for Q in self.requests: Q.put(None)
+        for P in self.processes:
+            P.join(CLOSE_TIMEOUT)
+            if P.is_alive(): P.terminate()
+        with self.lock: self.closed = True
+        self.collector.join()
+        # the prompts still waiting, or given to a worker that had to be stopped, are not
+        # answered; do not leave their callers waiting:
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending = {}
+            self.jobs = {}
+            self.waiting.clear()
+            self.assignedTo = {}
+        for F in futures:
+            F.set_exception(Exception("The pool of local models was closed before the prompt was answered"))
+
+    def requestStats(self) -> Dict :
+        stats = dict(PromptResponder.requestStats(self))
+        stats["prompts per local worker"] = list(self.numOfPrompts)
+        if self.numOfRequeued > 0: stats["prompts requeued"] = self.numOfRequeued
+        return stats
@@ -0,0 +1,105 @@
+#
+# Contain functions for merging the results of a benchmark run that was split in shards
+# (see the --shard option of clispi.py), e.g. to run them on several machines or with
+# several API keys. The merged reports are the same as those of a single run over the
+# whole benchmark.
+#
+from datetime import datetime
+from typing import Dict
+import json
+import glob
+import os
+import re
+
+from data import read_problems, write_json, parse_results_filename
+from basicEvaluate import mk_results_summary, write_perTask_summaries, write_wholeSet_summary
+
+def merge_results(datafile:str, resultsfiles:list[str], experimentName:str=None) -> str :
+    """
+    Merge the given results-files (results/*_all_*.json) of the same benchmark into a single
+    results-file, ordered as the tasks in the dataset. If the shards were evaluated, the
+    csv- and summary-reports are re-created from the merged results. The runtime-files of
+    the shards, if present, are merged too: each time is the sum over the shards (the total
+    time spent), followed by its maximum over the shards (the time the run took, if the
+    shards ran at the same time). All shards should have used the same prompt-type.
+
+    If experimentName is not given, it is the experiment-name of the first file, without
+    the _shard<i>of<N> suffix that clispi.py gives to shards.
+
+    Returns the name of the merged results-file.
+    """
+    tasks = read_problems(datafile)
+    names = [ parse_results_filename(f) for f in resultsfiles ]
+    prompt_types = set([ prompt_type for (_,prompt_type) in names ])
+    if len(prompt_types) > 1:
+        raise Exception(f"Cannot merge results of different prompt-types: {prompt_types}")
+    prompt_type = names[0][1]
+    if experimentName == None:
+        experimentName = re.sub(r"_shard\d+of\d+$", "", names[0][0])
+
+    records = {}
+    for f in resultsfiles:
+        with open(f, "r") as fp:
+            for R in json.load(fp):
+                Tid = R["task_id"]
+                if Tid in records:
+                    raise Exception(f"Task {Tid} is in more than one of the results-files.")
+                if not (Tid in tasks):
+                    raise Exception(f"Task {Tid} of {f} is not in the dataset.")
+                records[Tid] = R
+    print(f"** Merging {len(resultsfiles)} results-files, {len(records)} tasks")
+
+    # put them in dataset order:
+    results = [ records[Tid] for Tid in tasks if Tid in records ]
+
+    current_date = (datetime.now()).strftime("%d_%m_%Y_%H_%M_%S")
+    reportfile_basename = f"results/{experimentName}_evaluation_{prompt_type}_{current_date}"
+    evaluated = all([ "post_condition_ResultsSummary" in R for R in results ])
+    if evaluated:
+        mergedTasks = {}
+        for R in results:
+            task = tasks[R["task_id"]]
+            for condTy in ["pre","post"]:
+                task[f"{condTy}_condition_ResultsSummary"] = R[f"{condTy}_condition_ResultsSummary"]
+            mergedTasks[R["task_id"]] = task
+        summaries = mk_results_summary(mergedTasks)
+        write_perTask_summaries(mergedTasks,reportfile_basename)
+        write_wholeSet_summary(summaries[0],summaries[1],reportfile_basename)
+
+    mergedfile = f"results/{experimentName}_all_{prompt_type}_{current_date}.json"
+    write_json(mergedfile, results)
+
+    runtimes = {}
+    for f in resultsfiles:
+        # only the file name is rewritten, the folders may contain _all_ too:
+        runtimefile = os.path.basename(f).replace("_all_","_runtime_",1)
+        runtimefile = os.path.join(os.path.dirname(f), os.path.splitext(runtimefile)[0] + ".txt")
+        if not os.path.exists(runtimefile): continue
+        with open(runtimefile,'r') as F:
+            for line in F:
+                (key,value) = line.strip().split(':',1)
+                runtimes.setdefault(key, []).append(float(value))
+    if len(runtimes) > 0:
+        runtimeInfofile = reportfile_basename.replace("evaluation","runtime") + ".txt"
+        with open(runtimeInfofile,'w') as F:
+            F.write("\n".join([ f"{key}:{sum(runtimes[key])}\n{key} (longest shard):{max(runtimes[key])}" for key in runtimes ]))
+
+    print(f"** Merged results written to {mergedfile}")
+    return mergedfile
+
+def merge_results_dir(datafile:str, resultsDir:str, experimentName:str=None) -> str :
+    """
+    Merge all results-files (*_all_*.json) of shards in the given directory. If it has
+    results-files of shards (named *_shard<i>of<N>_*), the others, e.g. those of an
+    earlier merge, are left out. See merge_results().
+    """
+    resultsfiles = sorted(glob.glob(os.path.join(resultsDir, "*_all_*.json")))
+    shards = [ f for f in resultsfiles if re.search(r"_shard\d+of\d+$", parse_results_filename(f)[0]) ]
+    if len(shards) > 0: resultsfiles = shards
+    return merge_results(datafile, resultsfiles, experimentName)
+
+
+if __name__ == '__main__':
+    ROOT = os.path.dirname(os.path.abspath(__file__))
+    dataset = os.path.join(ROOT, "..", "..", "llm4spiDatasets", "data", "HEx-compact.json")
+    merge_results_dir(dataset, os.path.join(ROOT, "results", "shards"))
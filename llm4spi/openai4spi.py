@@ -8,30 +8,231 @@ from typing import Dict, List
 from openai import OpenAI
 import os
 import time
+import json
+import glob
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from data import read_problems, write_json
-from prompting import create_prompt
+from data import read_problems, write_json, select_tasks, shard_tasks, parse_results_filename
+from prompting import create_prompt, create_combined_prompt, answer_token_budget, MAX_ANSWER_TOKENS, COMBINED_PROMPT_TYPES, is_reasoning_model
+from prompting import create_batched_prompt, split_batched_answer
 from basicEvaluate import evaluate_tasks_results
+from checkpoint import Checkpoint, checkpoint_filename
+from tokenCounting import TokenCounter, token_counter
+from transport import TransportFactory
 from pythonSrcUtils import extractFunctionBody, extractPythonFunctionDef_fromMarkDownQuote, fix_indentation
+from pythonSrcUtils import endOfCodeAnswer, numOfFunctionHeaders, splitPrePostAnswer, CODE_ANSWER_STOP_SEQUENCES
+
+class TruncatedAnswer(str):
+    """
+    An answer that was cut off because it reached its maximum number of tokens.
+    """
+    pass
+
+def mark_truncated(answer:str, truncated:bool) -> str :
+    """
+    Return the answer as a TruncatedAnswer if truncated is true.
+    """
+    if truncated and answer != None: return TruncatedAnswer(answer)
+    return answer
 
 class PromptResponder:
 
     def __init__(self) :
         self.DEBUG = False
+        # how many of the multiple answers to a prompt can be asked at the same time,
+        # by clients that ask them one at a time (see fanOut):
+        self.maxParallelAnswers = 1
+        # an optional RateLimiter (see rateLimiter.py), possibly shared with other responders,
+        # that the requests to the backend go through:
+        self.rateLimiter = None
+        # a guess of the number of tokens in an answer, to budget a request before its
+        # real usage is known:
+        self.answerTokensGuess = 256
+        # if true, the answers to a prompt get a maximum number of tokens estimated from its
+        # task, widened when they are truncated (see answer_budget); else the responder's own
+        # default maximum applies:
+        self.answerBudgets = False
+        # counts the tokens of prompts, and learns from the real usage (see tokenCounting.py);
+        # clients can set one with the tokenizer of their provider:
+        self.tokenCounter = TokenCounter()
+        # the TransportFactory (see transport.py) that made the SDK client, if any, to report
+        # on the reuse of its connections:
+        self.transport = None
+        # an optional AdaptiveController (see adaptiveConcurrency.py) bounding the requests
+        # in flight and retrying throttled ones:
+        self.controller = None
+        # an optional HedgingPolicy (see hedging.py) duplicating requests that are slow:
+        self.hedging = None
+        # in streaming mode (for clients that support it), an answer is streamed, and cut off
+        # as soon as stopDetector(partial-answer,prompt) gives the position where it can end;
+        # the stopSequences are then also passed to providers that support them (see
+        # stopSequencesFor):
+        self.streaming = False
+        self.stopDetector = endOfCodeAnswer
+        self.stopSequences = CODE_ANSWER_STOP_SEQUENCES
 
     """
     A template class that generically represents an LLM/AI that can respond to a prompt 
     to ask its completion.
     """
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str]:
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
         """
         Complete the given prompt. Return the answer. As some LLMs can be configured to
         generate multiple answers to the same prompt, the parameter multipleAnswer can be used
         to specify how many asnwers we want from the AI. If its one, the just one answer is 
         expected from the AI. If it is e.g. 3 then three answers are expected. 
+
+        If maxTokens is given, it is the maximum number of tokens of each answer (else the
+        responder's default applies). Answers that are cut off at that maximum should be
+        returned as TruncatedAnswer, if the backend tells.
         """
         return None
 
+    async def completeItAsync(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
+        """
+        The asynchronous version of completeIt. By default this runs completeIt in the
+        event loop's executor, so that several prompts can be in flight at the same time.
+        Subclasses can override this if their backend has a native async API.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.completeIt(multipleAnswer, prompt, maxTokens=maxTokens))
+
+    def samplingParams(self) -> Dict :
+        """
+        The parameters, other than the model and the prompt, that affect the answers of this
+        responder, e.g. its temperature. They are part of the key of cached answers.
+        """
+        return {}
+
+    def estimateTokens(self, prompt:str, numOfAnswers:int=1) -> int :
+        """
+        Estimate the number of tokens a request with the given prompt will use, asking
+        the given number of answers.
+        """
+        return self.tokenCounter.estimate(prompt, numOfAnswers, self.answerTokensGuess)
+
+    def settleBudget(self, estimate:int, actualTokens:int, prompt:str=None, numOfAnswers:int=1):
+        """
+        Tell the rate limiter, if any, the real number of tokens used by a request; and the
+        token counter, so that it estimates the next requests better.
+        """
+        if prompt != None:
+            self.tokenCounter.observe(prompt, numOfAnswers, actualTokens, self.answerTokensGuess)
+        if self.rateLimiter == None: return
+        self.rateLimiter.settle(estimate, actualTokens)
+
+    def send(self, call, prompt:str, numOfAnswers:int=1, usage=None, estimate:int=None):
+        """
+        Send a request to the backend and return its response; call() does the actual request. 
+        The request waits for the rate limiter, if any, and goes through the adaptive controller,
+        if any, which may retry it. The function usage(response), if given, returns the number
+        of tokens the request used, to settle its rate-limit budget. The budget is estimated from
+        the prompt and the number of answers asked, unless the estimate is given; the budget of
+        an attempt that fails is given back.
+        If a hedging policy is set, a slow request may be duplicated; the duplicate is only sent
+        if the controller, if any, has room for it, and the rate limiter, if any, the budget for
+        it, right away, when it starts (else it fails, and the first request is waited for).
+        Each of the two requests settles its own budget when it is done, even the abandoned one.
+        """
+        budget = 0
+        def before():
+            nonlocal budget
+            if self.rateLimiter == None: return
+            budget = self.estimateTokens(prompt, numOfAnswers) if estimate == None else estimate
+            self.rateLimiter.acquire(budget)
+        def first():
+            try:
+                response = call()
+            except Exception:
+                # a failed request uses no tokens; a retry takes its own budget:
+                self.settleBudget(budget, 0)
+                raise
+            self.settleBudget(budget, None if usage == None else usage(response), prompt, numOfAnswers)
+            return response
+        def duplicate():
+            # taken when the duplicate starts, as it may be cancelled before:
+            if self.controller != None and not self.controller.tryEnter():
+                raise Exception("No room in the controller to hedge the request")
+            hedgeBudget = 0
+            if self.rateLimiter != None:
+                hedgeBudget = self.estimateTokens(prompt, numOfAnswers) if estimate == None else estimate
+                if self.rateLimiter.tryAcquire(hedgeBudget) > 0:
+                    if self.controller != None: self.controller.exit()
+                    raise Exception("No rate-limit budget to hedge the request")
+            try:
+                response = call()
+            except Exception as e:
+                # a failed request uses no tokens:
+                self.settleBudget(hedgeBudget, 0)
+                if self.controller != None: self.controller.onError(e)
+                raise
+            finally:
+                if self.controller != None: self.controller.exit()
+            if self.controller != None: self.controller.onSuccess()
+            self.settleBudget(hedgeBudget, None if usage == None else usage(response), prompt, numOfAnswers)
+            return response
+        def attempt():
+            if self.hedging == None: return first()
+            return self.hedging.call(first, usage, duplicate)
+        if self.controller == None:
+            before()
+            return attempt()
+        return self.controller.call(attempt, before)
+
+    def requestStats(self) -> Dict :
+        """
+        Statistics of the requests sent to the backend, if any are kept.
+        """
+        stats = {}
+        if self.controller != None: stats.update(self.controller.stats())
+        if self.hedging != None: stats.update(self.hedging.stats())
+        if self.rateLimiter != None: stats["rate-limit wait"] = self.rateLimiter.waited
+        if self.tokenCounter.numOfObservations > 0: stats.update(self.tokenCounter.stats())
+        if self.transport != None: stats.update(self.transport.stats())
+        return stats
+
+    def endpoint(self) -> str :
+        """
+        The URL of the backend's API, if the responder's client has one (e.g. the base URL of
+        an OpenAI-compatible provider), else None.
+        """
+        url = getattr(getattr(self, "client", None), "base_url", None)
+        return None if url == None else str(url)
+
+    def stopSequencesFor(self, prompt:str) -> list[str] :
+        """
+        The stop sequences to pass to the provider for the given prompt, if any. They end an
+        answer at its first code block, so they are not used for prompts asking more than
+        one function.
+        """
+        if numOfFunctionHeaders(prompt) > 1: return None
+        return self.stopSequences
+
+    def readStream(self, pieces, prompt:str) -> str :
+        """
+        Collect the pieces of text of a streamed answer to the prompt, until the stop detector
+        says the answer is complete; the rest of the stream is then not read.
+        """
+        answer = ""
+        for piece in pieces:
+            if piece == None: continue
+            answer = answer + piece
+            end = None if self.stopDetector == None else self.stopDetector(answer, prompt)
+            if end != None:
+                return answer[0 : end]
+        return answer
+
+    def fanOut(self, N:int, ask) -> list :
+        """
+        Return [ask(0), ask(1), ... ask(N-1)], calling ask for up to maxParallelAnswers
+        indices at the same time. The results are in the order of the indices.
+        """
+        if self.maxParallelAnswers <= 1 or N <= 1:
+            return [ ask(k) for k in range(N) ]
+        with ThreadPoolExecutor(max_workers=min(self.maxParallelAnswers,N)) as pool:
+            return list(pool.map(ask, range(N)))
+
 def generate_results(
         AI : PromptResponder, 
         datafile:str,
@@ -39,7 +240,14 @@ def generate_results(
         experimentName:str,
         enableEvaluation: bool,
         allowMultipleAnswers: int,
-        prompt_type: str        
+        prompt_type: str,
+        evaluationWorkers: int = 1,
+        evaluationCoordinator: str = None,
+        taskSelection: str = None,
+        shard: str = None,
+        concurrency: int = 1,
+        resume: bool = False,
+        batchSize: int = 1
         )  :
     """
     The general API for evaluating an LLM/AI in its ability to construct pre- and post-conditions
@@ -54,7 +262,10 @@ def generate_results(
 
     If the parameter specificProblem is specified (it is not None), then only the problem with the
     specified id will be evaluated. So, the dataset then is just a singleton-set containing that
-    single problem. 
+    single problem. Similarly, a taskSelection expression (see data.select_tasks) can be given
+    to only evaluate the selected problems, and a shard i/N (see data.shard_tasks) to only 
+    evaluate the i-th of N parts of the dataset. The results of the shards can be merged
+    afterwards with mergeResults.py.
     
     For each Problem in the dataset, the LLM task is to generate a python code that is an executable version 
     of the corresponding pre-/post-condition.
@@ -74,6 +285,20 @@ def generate_results(
        * (5) rejected: none of the above judgement is the case.
 
     An evaluation report, along with the produced solutions from the AI are saved in files in /results.
+
+    If concurrency is more than one, up to that many prompts are sent to the AI at the
+    same time, across tasks and pre-/post-conditions (see generate_all_completions).
+    If batchSize is more than one, the prompts of that many tasks are packed in a single
+    request (see generate_completions_batched).
+
+    If evaluationWorkers is more than one, the evaluation runs on a pool of that many processes.
+    If evaluationCoordinator (host:port) is given, the evaluation is distributed over worker
+    daemons connecting to that address (see distEvaluate.py).
+
+    The progress of the run is checkpointed in results/ as it goes (see checkpoint.py). If the
+    run is interrupted, it can be resumed by calling this again with the same experimentName
+    and resume=True: the answers and evaluations already in the checkpoint are then reused.
+    The checkpoint is removed once the reports are written.
     """
     time0 = time.time()
     tasks = read_problems(datafile)
@@ -81,17 +306,85 @@ def generate_results(
 
     if specificProblem != None:
         tasks = { specificProblem : tasks[specificProblem] }
+    if taskSelection != None:
+        tasks = select_tasks(tasks, taskSelection)
+    if shard != None:
+        tasks = shard_tasks(tasks, shard)
 
-    time1 = time.time()
-    for task in tasks:
-        generate_completions(AI, tasks[task], allowMultipleAnswers, prompt_type=prompt_type)
-    timeSpentAI = time.time() - time1
+    checkpointfile = checkpoint_filename(experimentName, prompt_type)
+    runInfo = { "provider" : responder_provider(AI), "model" : getattr(AI, "model", None),
+                "prompt_type" : prompt_type, "allowMultipleAnswers" : allowMultipleAnswers }
+    checkpoint = Checkpoint(checkpointfile, runInfo, resume)
+    try:
+        time1 = time.time()
+        generate_all_completions(AI, tasks, allowMultipleAnswers, prompt_type, concurrency, checkpoint, batchSize)
+        timeSpentAI = time.time() - time1
 
-    current_date = (datetime.now()).strftime("%d_%m_%Y_%H_%M_%S")
+        current_date = (datetime.now()).strftime("%d_%m_%Y_%H_%M_%S")
 
-    time2 = time.time()
-    reportfile_basename = f"results/{experimentName}_evaluation_{prompt_type}_{current_date}"
-    # gathering AI raw-responses and extracted completions:
+        time2 = time.time()
+        reportfile_basename = f"results/{experimentName}_evaluation_{prompt_type}_{current_date}"
+        results = collect_results(tasks, enableEvaluation, reportfile_basename,
+                                  previousResults = checkpoint.previousResults() if resume else None,
+                                  workers=evaluationWorkers, coordinator=evaluationCoordinator,
+                                  onResult=checkpoint.saveEvaluation)
+        timeSpentAnalysis = time.time() - time2
+    except KeyboardInterrupt:
+        checkpoint.close()
+        print(f"** Interrupted. The progress so far is saved in {checkpointfile}; resume the run with the same experiment name.")
+        raise
+    checkpoint.close()
+
+    # Saving raw responses and evaluation results in a json-file:
+    #write_jsonl(f"results/{experimentName}_all_{prompt_type}_{current_date}.jsonl", results)
+    write_json(f"results/{experimentName}_all_{prompt_type}_{current_date}.json", results)
+    os.remove(checkpointfile)
+
+    overallTime = time.time() - time0
+
+    runtimeInfo = {
+        "time loading data" : timeSpentReadingData,
+        "time AI" : timeSpentAI,
+        "time analysis" : timeSpentAnalysis,
+        "time all" : overallTime
+    }
+
+    runtimeInfofile = reportfile_basename.replace("evaluation","runtime") + ".txt"
+    with open(runtimeInfofile,'w') as F:
+        F.write(f"time loading data:{timeSpentReadingData}\n")
+        F.write(f"time AI:{timeSpentAI}\n")
+        F.write(f"time analysis:{timeSpentAnalysis}\n")
+        F.write(f"time all:{overallTime}")
+
+    requestStats = AI.requestStats()
+    if len(requestStats) > 0:
+        print(f"** Requests: {requestStats}")
+    print( "** Time:")
+    print(f"   time loading data: {timeSpentReadingData}")
+    print(f"   time AI: {timeSpentAI}")
+    print(f"   time analysis: {timeSpentAnalysis}")
+    print(f"   time all: {overallTime}")
+    # DONE
+
+def responder_provider(AI:PromptResponder) -> str :
+    """
+    The name of the provider answering the prompts: the class of the responder, or of the
+    responder it wraps (e.g. a CachingResponder or RecordingResponder).
+    """
+    while getattr(AI, "AI", None) != None: AI = AI.AI
+    return type(AI).__name__
+
+def collect_results(tasks:Dict[str,Dict], enableEvaluation:bool, reportfile_basename:str,
+                    previousResults:Dict[str,Dict]=None, workers:int=1, coordinator:str=None,
+                    onResult=None) -> list[Dict] :
+    """
+    Gather the AI raw-responses and extracted completions of the given tasks into a list
+    of result-records, one per task. If enableEvaluation is true, the tasks are evaluated
+    too (which also writes the csv- and summary-reports), and the evaluation results are
+    added into the records. The previousResults, if given, are passed to the evaluation
+    to reuse the results of unchanged tasks. The workers, coordinator, and onResult are passed
+    to the evaluation too; see evaluate_tasks_results.
+    """
     results = [{
             "task_id": tasks[Tid]["task_id"],
             "pre_condition_prompt" : tasks[Tid]["pre_condition_prompt"],
@@ -104,7 +397,7 @@ def generate_results(
     
     if enableEvaluation:
         # then do the evaluation
-        evaluate_tasks_results(tasks,reportfile_basename)
+        evaluate_tasks_results(tasks,reportfile_basename,previousResults,workers,coordinator,onResult)
         # add the eval-summaries and raw-test-results into the results:
         for R in results :
             Tid = R["task_id"]
@@ -114,35 +407,161 @@ def generate_results(
                R[f"{condTy}_condition_ResultsSummary"] = task[f"{condTy}_condition_ResultsSummary"]
                R[f"{condTy}_condition_reference_TestResults"] = task[f"{condTy}_condition_reference_TestResults"]
                R[f"{condTy}_condition_candidates_TestResults"] = task[f"{condTy}_condition_candidates_TestResults"]
-        
-    timeSpentAnalysis = time.time() - time2
+               R[f"{condTy}_condition_hash"] = task[f"{condTy}_condition_hash"]
+    return results
 
-    # Saving raw responses and evaluation results in a json-file:
-    #write_jsonl(f"results/{experimentName}_all_{prompt_type}_{current_date}.jsonl", results)
-    write_json(f"results/{experimentName}_all_{prompt_type}_{current_date}.json", results)
+def rescore_results(datafile:str, resultsfile:str, experimentName:str=None, incremental:bool=False,
+                    evaluationWorkers:int=1, evaluationCoordinator:str=None) :
+    """
+    Re-run the evaluation on the completions stored in a results-file of a previous run
+    (a results/*_all_*.json file), without asking any AI. This is useful e.g. after the
+    test suites in the dataset, or the evaluator itself, have been changed.
 
-    overallTime = time.time() - time0
+    The stored prompts, raw-responses, and completions are re-attached to the tasks
+    of the given dataset, which are then evaluated. Fresh csv-, summary-, and json-reports
+    are written to /results. If experimentName is not given, it is taken from the name
+    of the results-file, suffixed with '_rescored'.
 
-    runtimeInfo = {
-        "time loading data" : timeSpentReadingData,
-        "time AI" : timeSpentAI,
-        "time analysis" : timeSpentAnalysis,
-        "time all" : overallTime
-    }
+    If incremental is true, only the pre-/post-conditions whose header, reference solution,
+    or tests have changed since the previous run are re-evaluated. The stored results are
+    reused for the rest. Do not use this when the evaluator itself has changed.
+    """
+    time0 = time.time()
+    tasks = read_problems(datafile)
+    with open(resultsfile, "r") as fp:
+        oldResults = json.load(fp)
+    timeSpentReadingData = time.time() - time0
+
+    (oldExperimentName, prompt_type) = parse_results_filename(resultsfile)
+    if experimentName == None:
+        experimentName = oldExperimentName + "_rescored"
+
+    print(f"** Re-scoring {resultsfile} ({len(oldResults)} tasks)")
+    rescoredTasks = {}
+    for R in oldResults:
+        Tid = R["task_id"]
+        if not (Tid in tasks):
+            print(f">>> Task {Tid} is not in the dataset; it is skipped.")
+            continue
+        task = tasks[Tid]
+        for condTy in ["pre","post"]:
+            task[f"{condTy}_condition_prompt"] = R[f"{condTy}_condition_prompt"]
+            task[f"{condTy}_condition_raw_responses"] = R[f"{condTy}_condition_raw_responses"]
+            task[f"{condTy}_condition_completions"] = R[f"{condTy}_condition_completions"]
+        rescoredTasks[Tid] = task
+
+    current_date = (datetime.now()).strftime("%d_%m_%Y_%H_%M_%S")
+    time1 = time.time()
+    reportfile_basename = f"results/{experimentName}_evaluation_{prompt_type}_{current_date}"
+    previousResults = { R["task_id"] : R for R in oldResults } if incremental else None
+    results = collect_results(rescoredTasks, True, reportfile_basename, previousResults,
+                              evaluationWorkers, evaluationCoordinator)
+    timeSpentAnalysis = time.time() - time1
 
+    write_json(f"results/{experimentName}_all_{prompt_type}_{current_date}.json", results)
+
+    overallTime = time.time() - time0
     runtimeInfofile = reportfile_basename.replace("evaluation","runtime") + ".txt"
     with open(runtimeInfofile,'w') as F:
         F.write(f"time loading data:{timeSpentReadingData}\n")
-        F.write(f"time AI:{timeSpentAI}\n")
+        F.write(f"time AI:0\n")
         F.write(f"time analysis:{timeSpentAnalysis}\n")
         F.write(f"time all:{overallTime}")
 
     print( "** Time:")
     print(f"   time loading data: {timeSpentReadingData}")
-    print(f"   time AI: {timeSpentAI}")
     print(f"   time analysis: {timeSpentAnalysis}")
     print(f"   time all: {overallTime}")
-    # DONE
+
+def rescore_results_dir(datafile:str, resultsDir:str, incremental:bool=False, evaluationWorkers:int=1,
+                        evaluationCoordinator:str=None) :
+    """
+    Re-score every results-file (*_all_*.json) in the given directory against the
+    given dataset. See rescore_results(). Files that are themselves the output of a
+    re-scoring are skipped.
+    """
+    resultsfiles = sorted(glob.glob(os.path.join(resultsDir, "*_all_*.json")))
+    resultsfiles = [ f for f in resultsfiles if not ("_rescored_all_" in os.path.basename(f)) ]
+    print(f"** Re-scoring {len(resultsfiles)} results-files in {resultsDir}")
+    for f in resultsfiles:
+        rescore_results(datafile, f, incremental=incremental, evaluationWorkers=evaluationWorkers,
+                        evaluationCoordinator=evaluationCoordinator)
+
+def chat_usage(completion) -> int :
+    """
+    The total number of tokens used by a chat-completion of an OpenAI-compatible API.
+    """
+    return None if completion.usage == None else completion.usage.total_tokens
+
+def answer_budget(AI:PromptResponder, task:Dict, kind:str, prompt_type:str) -> int :
+    """
+    The maximum number of tokens of each answer to the prompt for the pre- or post-condition
+    of the task, or both if kind is "both" (see prompting.answer_token_budget). It is None,
+    so that the responder's default maximum applies, unless AI uses answer budgets; and for
+    reasoning models, whose answers include their reasoning.
+    """
+    if not AI.answerBudgets or is_reasoning_model(getattr(AI, "model", None)): return None
+    if kind == "both":
+        return answer_token_budget(task, "pre", prompt_type) + answer_token_budget(task, "post", prompt_type)
+    return answer_token_budget(task, kind, prompt_type)
+
+def complete_within_budget(AI:PromptResponder, multipleAnswer:int, prompt:str, maxTokens:int) -> list[str] :
+    """
+    Ask AI the answers to the prompt, each with at most maxTokens tokens. The answers that
+    are cut off at that budget are logged, and asked again with twice the budget, up to
+    MAX_ANSWER_TOKENS. If maxTokens is None, the responder's default maximum applies, and
+    the answers are not asked again.
+    """
+    answers = AI.completeIt(multipleAnswer, prompt, maxTokens=maxTokens)
+    while maxTokens != None and maxTokens < MAX_ANSWER_TOKENS:
+        truncated = [ k for (k,A) in enumerate(answers) if isinstance(A,TruncatedAnswer) ]
+        if len(truncated) == 0: break
+        maxTokens = min(2*maxTokens, MAX_ANSWER_TOKENS)
+        print(f">>> {len(truncated)} answers were truncated; asking them again with max {maxTokens} tokens")
+        again = AI.completeIt(len(truncated), prompt, maxTokens=maxTokens)
+        for (k,A) in zip(truncated,again):
+            answers[k] = A
+    return answers
+
+async def complete_within_budget_async(AI:PromptResponder, multipleAnswer:int, prompt:str, maxTokens:int) -> list[str] :
+    """
+    The asynchronous version of complete_within_budget.
+    """
+    answers = await AI.completeItAsync(multipleAnswer, prompt, maxTokens=maxTokens)
+    while maxTokens != None and maxTokens < MAX_ANSWER_TOKENS:
+        truncated = [ k for (k,A) in enumerate(answers) if isinstance(A,TruncatedAnswer) ]
+        if len(truncated) == 0: break
+        maxTokens = min(2*maxTokens, MAX_ANSWER_TOKENS)
+        print(f">>> {len(truncated)} answers were truncated; asking them again with max {maxTokens} tokens")
+        again = await AI.completeItAsync(len(truncated), prompt, maxTokens=maxTokens)
+        for (k,A) in zip(truncated,again):
+            answers[k] = A
+    return answers
+
+def stream_chat(AI:PromptResponder, prompt:str, **request) -> list[str] :
+    """
+    Send a chat-completion request of an OpenAI-compatible API for the given prompt, with AI's
+    client, in streaming mode. Returns the answers, each cut off where AI's stop detector says it is complete. The
+    stream is closed as soon as all answers are complete.
+    """
+    N = request.get("n", 1)
+    answers = [ "" ] * N
+    ends = [ None ] * N
+    truncated = [ False ] * N
+    stream = AI.client.chat.completions.create(stream=True, **request)
+    try:
+        for chunk in stream:
+            for choice in chunk.choices:
+                k = choice.index
+                if ends[k] != None: continue
+                if choice.finish_reason == "length": truncated[k] = True
+                if choice.delta.content == None: continue
+                answers[k] = answers[k] + choice.delta.content
+                if AI.stopDetector != None: ends[k] = AI.stopDetector(answers[k], prompt)
+            if all([ end != None for end in ends ]): break
+    finally:
+        stream.close()
+    return [ mark_truncated(A,T) if end == None else A[0 : end] for (A,end,T) in zip(answers,ends,truncated) ]
 
 def fix_completionString(header:str, completion:str) -> str :
     """
@@ -162,7 +581,8 @@ def generate_completions(
         AI: PromptResponder,
         task: Dict,
         allowMultipleAnswers: int,
-        prompt_type: str) -> Dict:
+        prompt_type: str,
+        checkpoint: Checkpoint = None) -> Dict:
     """
     This function takes the desciption of a task/problem, represented as a dictionary.
     It then creates the completion prompt for the pre- and post-condition for the task. 
@@ -172,24 +592,221 @@ def generate_completions(
     The AI is generically represented by an object of class PromptResponder, which has
     a method that takes a prompt-string and returns a string (the answer).
 
-    The creation of the prompt is coded in the module Prompting. 
+    The creation of the prompt is coded in the module Prompting. So is the maximum number of
+    tokens of the answers, if AI uses answer budgets; answers cut off at that budget are then
+    asked again with a larger one (see answer_budget and complete_within_budget).
+
+    For the COMBINED_PROMPT_TYPES, a single prompt asks both the pre- and post-condition, and
+    each answer is split into the two (see store_combined_completions). Tasks that do not
+    have both conditions are prompted per condition, as usual.
+
+    If a checkpoint is given, answers it already has are taken from it, and new answers
+    are saved in it.
+    """
+    prompt = prepare_combined(task, prompt_type)
+    if prompt != None:
+        if checkpoint != None and checkpoint.restoreCompletions(task, "pre", prompt) and checkpoint.restoreCompletions(task, "post", prompt):
+            return task
+        maxTokens = answer_budget(AI, task, "both", prompt_type)
+        completions = complete_within_budget(AI, allowMultipleAnswers, prompt, maxTokens)
+        store_combined_completions(task, completions, checkpoint)
+        return task
+    for condType in ["pre","post"]:
+        prompt = prepare_condition(task, condType, prompt_type)
+        if prompt != None:
+            if checkpoint != None and checkpoint.restoreCompletions(task, condType, prompt): continue
+            # note that this gives one or more answers, in a list:
+            maxTokens = answer_budget(AI, task, condType, prompt_type)
+            completions = complete_within_budget(AI, allowMultipleAnswers, prompt, maxTokens)
+            store_completions(task, condType, completions, checkpoint)
+    return task
+
+def prepare_condition(task: Dict, condType: str, prompt_type: str) -> str :
+    """
+    Create the prompt for the pre- or post-condition of the task, and reset its completion
+    entries in the task. Returns the prompt, or None if the task has no such condition.
+    """
+    prompt = create_prompt(task, condition_type=condType, prompt_type=prompt_type)
+    task[condType + "_condition_prompt"] = prompt
+    task[condType + "_condition_raw_responses"] = None
+    task[condType + "_condition_completions"]   = None
+    return prompt
+
+def prepare_combined(task: Dict, prompt_type: str) -> str :
+    """
+    As prepare_condition, but for the single prompt asking both the pre- and post-condition,
+    if prompt_type is one of the COMBINED_PROMPT_TYPES. Returns None if it is not, or if the
+    task does not have both conditions.
     """
-    def worker(condType): # pre or post
-        prompt = create_prompt(task, condition_type=condType, prompt_type=prompt_type)
+    if not (prompt_type in COMBINED_PROMPT_TYPES): return None
+    prompt = create_combined_prompt(task, prompt_type)
+    if prompt == None: return None
+    for condType in ["pre","post"]:
         task[condType + "_condition_prompt"] = prompt
         task[condType + "_condition_raw_responses"] = None
         task[condType + "_condition_completions"]   = None
+    return prompt
+
+def store_combined_completions(task: Dict, completions: list[str], checkpoint: Checkpoint = None) :
+    """
+    Split each answer to a combined prompt into the pre- and post-condition functions, and
+    store these as the raw answers of each condition (see store_completions).
+    """
+    parts = [ splitPrePostAnswer(A, task["pre_condition_incomplete"], task["post_condition_incomplete"]) for A in completions ]
+    store_completions(task, "pre",  [ pre  for (pre,post) in parts ], checkpoint)
+    store_completions(task, "post", [ post for (pre,post) in parts ], checkpoint)
+
+def store_completions(task: Dict, condType: str, completions: list[str], checkpoint: Checkpoint = None) :
+    """
+    Add the raw answers of the AI for the pre- or post-condition of the task into the task,
+    along with the function bodies extracted from them, and save them in the checkpoint if given.
+    """
+    task[condType + "_condition_raw_responses"] = completions
+    header = task[condType + "_condition_incomplete"]
+    task[condType + "_condition_completions"] = [ fix_completionString(header,rawAnswer) for rawAnswer in completions ]
+    if checkpoint != None: checkpoint.saveCompletions(task, condType)
+
+async def generate_completions_async(
+        AI: PromptResponder,
+        task: Dict,
+        allowMultipleAnswers: int,
+        prompt_type: str,
+        slots: asyncio.Semaphore,
+        checkpoint: Checkpoint = None) -> Dict:
+    """
+    The asynchronous version of generate_completions. The prompts for the pre- and
+    post-condition are sent concurrently; a prompt is only sent when it gets one of
+    the given slots, which bounds the number of prompts in flight.
+    """
+    prompt = prepare_combined(task, prompt_type)
+    if prompt != None:
+        if checkpoint != None and checkpoint.restoreCompletions(task, "pre", prompt) and checkpoint.restoreCompletions(task, "post", prompt):
+            return task
+        async with slots:
+            maxTokens = answer_budget(AI, task, "both", prompt_type)
+            completions = await complete_within_budget_async(AI, allowMultipleAnswers, prompt, maxTokens)
+        store_combined_completions(task, completions, checkpoint)
+        return task
+
+    async def worker(condType): # pre or post
+        prompt = prepare_condition(task, condType, prompt_type)
         if prompt != None:
-            # note that this gives one or more answers, in a list:
-            completions = AI.completeIt(allowMultipleAnswers,prompt)
-            task[condType + "_condition_raw_responses"] = completions
-            header = task[condType + "_condition_incomplete"]
-            task[condType + "_condition_completions"] = [ fix_completionString(header,rawAnswer) for rawAnswer in completions ]
-  
-    worker("pre")
-    worker("post")
+            if checkpoint != None and checkpoint.restoreCompletions(task, condType, prompt): return
+            async with slots:
+                maxTokens = answer_budget(AI, task, condType, prompt_type)
+                completions = await complete_within_budget_async(AI, allowMultipleAnswers, prompt, maxTokens)
+            store_completions(task, condType, completions, checkpoint)
+
+    await asyncio.gather(worker("pre"), worker("post"))
     return task
 
+def generate_all_completions(
+        AI: PromptResponder,
+        tasks: Dict[str,Dict],
+        allowMultipleAnswers: int,
+        prompt_type: str,
+        concurrency: int = 1,
+        checkpoint: Checkpoint = None,
+        batchSize: int = 1) :
+    """
+    Generate the completions for all the given tasks, see generate_completions.
+
+    If concurrency is more than one, the prompts of all tasks are sent asynchronously,
+    keeping up to that many of them in flight at the same time. The completions are stored
+    in their own tasks, so the results are in the same order as with a sequential run.
+    The checkpoint, if given, is used as in generate_completions.
+
+    If batchSize is more than one, the prompts are sent in batches, see generate_completions_batched.
+    """
+    if batchSize > 1:
+        generate_completions_batched(AI, tasks, allowMultipleAnswers, prompt_type, batchSize, concurrency, checkpoint)
+        return
+    if concurrency <= 1:
+        for task in tasks:
+            generate_completions(AI, tasks[task], allowMultipleAnswers, prompt_type=prompt_type, checkpoint=checkpoint)
+        return
+
+    async def run():
+        # synchronous completeIt implementations run in threads, one per slot:
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+        slots = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[ generate_completions_async(AI, tasks[task], allowMultipleAnswers, prompt_type, slots, checkpoint)
+                                for task in tasks ])
+
+    asyncio.run(run())
+
+def generate_completions_batched(
+        AI: PromptResponder,
+        tasks: Dict[str,Dict],
+        allowMultipleAnswers: int,
+        prompt_type: str,
+        batchSize: int,
+        concurrency: int = 1,
+        checkpoint: Checkpoint = None) :
+    """
+    Generate the completions for all the given tasks, as generate_completions does, but
+    packing the prompts of up to batchSize pre-/post-conditions (or combined prompts) in a
+    single request, see prompting.create_batched_prompt. This is useful when the number of
+    requests, rather than tokens, is what the provider limits.
+
+    Each answer is split into the answers to the packed prompts. The answers that cannot be
+    found in it are asked again, with the prompt of their own task only. If concurrency is
+    more than one, up to that many batches are sent at the same time.
+    """
+    # the prompts to ask, as (task,kind,prompt), where kind is pre, post, or both:
+    items = []
+    for Tid in tasks:
+        task = tasks[Tid]
+        prompt = prepare_combined(task, prompt_type)
+        if prompt != None:
+            prompts = [ ("both",prompt) ]
+        else:
+            prompts = [ (condType, prepare_condition(task, condType, prompt_type)) for condType in ["pre","post"] ]
+        for (kind,prompt) in prompts:
+            if prompt == None: continue
+            if checkpoint != None:
+                condTypes = ["pre","post"] if kind == "both" else [kind]
+                if all([ checkpoint.restoreCompletions(task, condType, prompt) for condType in condTypes ]): continue
+            items.append((task,kind,prompt))
+
+    def budget(task, kind):
+        return answer_budget(AI, task, kind, prompt_type)
+
+    def store(task, kind, completions):
+        if kind == "both":
+            store_combined_completions(task, completions, checkpoint)
+        else:
+            store_completions(task, kind, completions, checkpoint)
+
+    def askBatch(batch):
+        if len(batch) == 1:
+            (task,kind,prompt) = batch[0]
+            store(task, kind, complete_within_budget(AI, allowMultipleAnswers, prompt, budget(task,kind)))
+            return
+        prompt = create_batched_prompt([ P for (_,_,P) in batch ])
+        budgets = [ budget(task,kind) for (task,kind,_) in batch ]
+        maxTokens = None if None in budgets else min(MAX_ANSWER_TOKENS, sum(budgets))
+        answers = complete_within_budget(AI, allowMultipleAnswers, prompt, maxTokens)
+        sections = [ split_batched_answer(A, len(batch)) for A in answers ]
+        for (i,(task,kind,P)) in enumerate(batch):
+            completions = [ S[i] for S in sections ]
+            missing = [ j for (j,A) in enumerate(completions) if A == None ]
+            if len(missing) > 0:
+                print(f">>> {len(missing)} answers for task {task['task_id']} ({kind}) are missing in the batched answer; asking them separately")
+                again = complete_within_budget(AI, len(missing), P, budget(task,kind))
+                for (j,A) in zip(missing,again):
+                    completions[j] = A
+            store(task, kind, completions)
+
+    batches = [ items[i : i+batchSize] for i in range(0, len(items), batchSize) ]
+    print(f"** Sending {len(items)} prompts in {len(batches)} batches")
+    if concurrency <= 1:
+        for batch in batches:
+            askBatch(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(askBatch, batches))
+
 class MyOpenAIClient(PromptResponder):
     """
     An instance of prompt-responder that uses openAI LLM as the backend model.
@@ -203,8 +820,17 @@ class MyOpenAIClient(PromptResponder):
         # at a time, despite the feature.
         # Default is true. 
         self.enableMultipleAnswer = True
+        # when the answers need more than one request, they are sent concurrently:
+        self.maxParallelAnswers = 4
+        self.tokenCounter = token_counter("openAI", modelId)
     
-    def completeIt(self, multipleAnswer:int, prompt:str) -> list[str] :
+    def samplingParams(self) -> Dict :
+        # some models do not allow temperature to be set!!
+        if self.model.startswith("o1") :
+            return { "temperature" : 1 }
+        return { "temperature" : 0.7 }
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
         if self.DEBUG: print(">>> PROMPT:\n" + prompt)
 
         # some models limit the number of multiple-answers it could give:
@@ -214,31 +840,45 @@ class MyOpenAIClient(PromptResponder):
         if self.enableMultipleAnswer == False:
             maxMultipleAnswers = 1
         
-        # some models do not allow temperature to be set!!
-        xtemperature = 0.7
-        if self.model.startswith("o1") :
-            xtemperature = 1
+        xtemperature = self.samplingParams()["temperature"]
         
+        # split the answers in requests of at most maxMultipleAnswers answers each:
+        requestSizes = []
         remainToDo = multipleAnswer
-        responses = []
         while remainToDo > 0:
-            numberOfAnswersToAsk = min(remainToDo,maxMultipleAnswers)
+            requestSizes.append(min(remainToDo,maxMultipleAnswers))
+            remainToDo = remainToDo - requestSizes[-1]
+
+        def ask(j):
+            numberOfAnswersToAsk = requestSizes[j]
             if self.DEBUG: 
                 print(f">>> asking {numberOfAnswersToAsk} answers")
-            completion = self.client.chat.completions.create(
-                model = self.model,
-                temperature = xtemperature,
-                n = numberOfAnswersToAsk,
-                messages=[
+            request = {
+                "model" : self.model,
+                "temperature" : xtemperature,
+                "n" : numberOfAnswersToAsk,
+                "messages" : [
                     {
                         "role": "user",
                         "content": prompt
                     }
                     ]
-                )
+                }
+            # the tokens of o1 models include their reasoning, so do not limit them:
+            if maxTokens != None and not self.model.startswith("o1") : request["max_tokens"] = maxTokens
+            if self.streaming:
+                # o1 models do not support stop sequences
+                stops = self.stopSequencesFor(prompt)
+                if stops != None and not self.model.startswith("o1") : request["stop"] = stops
+                return self.send(lambda: stream_chat(self, prompt, **request), prompt, numberOfAnswersToAsk)
+            completion = self.send(lambda: self.client.chat.completions.create(**request),
+                                   prompt, numberOfAnswersToAsk, usage=chat_usage)
             N = min(numberOfAnswersToAsk, len(completion.choices))
-            responses = responses + [ completion.choices[k].message.content for k in range(N) ]
-            remainToDo = remainToDo - numberOfAnswersToAsk
+            return [ mark_truncated(completion.choices[k].message.content, completion.choices[k].finish_reason == "length")
+                     for k in range(N) ]
+
+        # the requests are sent concurrently, up to maxParallelAnswers at a time:
+        responses = [ R for answers in self.fanOut(len(requestSizes), ask) for R in answers ]
 
         if self.DEBUG: 
             for k in range(len(responses)):
@@ -249,7 +889,8 @@ class MyOpenAIClient(PromptResponder):
 
 if __name__ == '__main__':
     openai_api_key = os.environ.get('OPENAI_API_KEY') 
-    openAIclient = OpenAI(api_key=openai_api_key)
+    transport = TransportFactory()
+    openAIclient = transport.openai(api_key=openai_api_key)
     modelId = "gpt-3.5-turbo"
     #modelId ="gpt-4-turbo"  --->  this model is expensive!
     #modelId ="gpt-4o" 
@@ -257,6 +898,7 @@ if __name__ == '__main__':
     #modelId ="o3-mini"  --> not recognized (yet?)
 
     myAIclient = MyOpenAIClient(openAIclient,modelId)
+    myAIclient.transport = transport
     myAIclient.DEBUG = True
     #myAIclient.enableMultipleAnswer = False
 
@@ -0,0 +1,103 @@
+#
+# Contain functions for running the basic evaluation (see basicEvaluate.py) with a pool
+# of worker processes. The unit of work is a single candidate of a single pre-/post-condition
+# of a task; so the candidates of the same task are spread over the workers.
+#
+# The reference solution is still run in the main process. The parsed test suites of
+# each task, along with the reference results on them, are then placed once in a shared
+# memory block. A work item only carries the name of that block, so the test inputs are
+# not pickled and sent again for every candidate. A worker reads a block straight from
+# the shared memory, and keeps what it has read, so it only does this once per task.
+# A block is released as soon as all the candidates of its task are evaluated; a worker
+# then forgets what it read from it, the next time it reads a new block.
+#
+from typing import Dict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import pickle
+
+from basicEvaluate import prepare_task_evaluation, evaluate_candidate, summarize_task_result
+
+# the test suites and reference results a worker process has loaded, by shared memory name:
+_loadedSuites = {}
+
+def put_in_shared_memory(suites: tuple, reference: tuple) -> shared_memory.SharedMemory :
+    """
+    Serialize the test suites and reference results of a job into a new shared memory
+    block, and return the block. The caller is responsible for unlinking it.
+    """
+    blob = pickle.dumps((suites,reference), protocol=pickle.HIGHEST_PROTOCOL)
+    shm = shared_memory.SharedMemory(create=True, size=max(1,len(blob)))
+    shm.buf[:len(blob)] = blob
+    return shm
+
+def load_from_shared_memory(shmName: str) -> tuple :
+    """
+    Return the (suites,reference) pair stored in the shared memory block with the given
+    name. The pair is unpickled directly from the shared buffer, and cached, so a worker
+    only reads a block once.
+    """
+    if shmName in _loadedSuites:
+        return _loadedSuites[shmName]
+    evict_released_suites()
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        # pickle ignores the trailing padding the OS may add to the block:
+        pair = pickle.loads(shm.buf)
+    finally:
+        shm.close()
+    _loadedSuites[shmName] = pair
+    return pair
+
+def evict_released_suites():
+    """
+    Forget the loaded test suites whose shared memory block has been released.
+    """
+    for shmName in list(_loadedSuites):
+        try:
+            shared_memory.SharedMemory(name=shmName).close()
+        except FileNotFoundError:
+            del _loadedSuites[shmName]
+
+def _evaluate_candidate_worker(job: Dict, shmName: str, k: int, body: str) -> Dict :
+    (suites,reference) = load_from_shared_memory(shmName)
+    return evaluate_candidate(job, suites, reference, k, body)
+
+def evaluate_tasks_parallel(tasks: Dict[str,Dict], todo: list[tuple], workers: int, onResult=None):
+    """
+    Evaluate the given (task-id,condition) pairs of the tasks, as evaluate_task_result
+    would do, but distributing the candidates over a pool of the given number of
+    worker processes. The results are added into the task-dictionaries, in the same
+    order as the sequential evaluation would. If given, onResult(task,condition) is
+    called as each pre-/post-condition is complete.
+    """
+    blocks = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for (tID,condition) in todo:
+                task = tasks[tID]
+                job = prepare_task_evaluation(task, condition)
+                if job == None:
+                    # nothing to evaluate, but it is still complete, in its order:
+                    pending.append((task,condition,None))
+                    continue
+                shm = put_in_shared_memory(job["suites"], job["reference"])
+                blocks[(task["task_id"],condition)] = shm
+                # the job is sent along with every work item, so drop the big parts:
+                smallJob = { key:job[key] for key in job if not (key in ["suites","reference"]) }
+                futures = [ pool.submit(_evaluate_candidate_worker, smallJob, shm.name, k, body)
+                            for (k,body) in enumerate(task[f"{condition}_condition_completions"]) ]
+                pending.append((task,condition,futures))
+            for (task,condition,futures) in pending:
+                if futures != None:
+                    summarize_task_result(task, condition, [ f.result() for f in futures ])
+                    release_shared_memory(blocks.pop((task["task_id"],condition)))
+                if onResult != None: onResult(task, condition)
+    finally:
+        for shm in blocks.values():
+            release_shared_memory(shm)
+
+def release_shared_memory(shm: shared_memory.SharedMemory):
+    shm.close()
+    shm.unlink()
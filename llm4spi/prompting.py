@@ -1,8 +1,52 @@
 from typing import Dict
+import re
 
+# bounds of the number of tokens an answer may take (see answer_token_budget):
+MIN_ANSWER_TOKENS = 128
+MAX_ANSWER_TOKENS = 4096
+
+def answer_token_budget(task: Dict, condition_type: str, prompt_type: str) -> int:
+    """
+    The maximum number of tokens the answer to the prompt for the pre- or post-condition
+    of the task may take. It is estimated from the size of the reference solution, which
+    is about the size of the code we expect, and from the prompt-type: chain-of-thought
+    prompts ask for reasoning before the code, usePrgDesc asks for the condition in English
+    first, and usePredDesc only asks for the code.
+    """
+    if prompt_type in COMBINED_PROMPT_TYPES:
+        prompt_type = COMBINED_PROMPT_TYPES[prompt_type]
+    solution = task.get(condition_type + "_condition_solution")
+    if solution == None: solution = ""
+    # roughly three characters per token for code:
+    solutionTokens = len(solution) // 3
+    if prompt_type == "usePredDesc":
+        budget = 2*solutionTokens + 128
+    elif prompt_type == "usePrgDesc":
+        budget = 2*solutionTokens + 256
+    else:
+        budget = 3*solutionTokens + 768
+    return max(MIN_ANSWER_TOKENS, min(budget, MAX_ANSWER_TOKENS))
+
+# models that reason before answering (e.g. o1, o3, deepseek-r1, qwq), whose answers include
+# their reasoning, so that the budgets above are far too small for them:
+_reasoningModel = re.compile(r"(^|[-/_.])(o1|o3|o4|r1|qwq|reasoner|thinking)([-/_.:]|$)", re.IGNORECASE)
+
+def is_reasoning_model(model: str) -> bool:
+    return model != None and _reasoningModel.search(model) != None
+
+
+# prompt-types asking the pre- and post-condition in a single prompt (see create_combined_prompt),
+# mapped to the prompt-type used for tasks that only have one of them:
+COMBINED_PROMPT_TYPES = {
+    "usePrgDescPrePost"  : "usePrgDesc",
+    "usePredDescPrePost" : "usePredDesc"
+}
 
 def create_prompt(task: Dict, condition_type: str, prompt_type: str) -> str:
     
+    if prompt_type in COMBINED_PROMPT_TYPES:
+        prompt_type = COMBINED_PROMPT_TYPES[prompt_type]
+
     # check first if the condition-type (pre/post) exists in the task:
     if not (condition_type + "_condition") in task: return None
     condition = task[condition_type + "_condition"]
@@ -67,4 +111,99 @@ def create_prompt(task: Dict, condition_type: str, prompt_type: str) -> str:
         poscFunctionName = z.split()[1].strip()
         prompt = f"Consider a Python function {poscFunctionName} with the header:\n\n{condition_incomplete}.\n\nThe function checks if the following condition is true. {condition}\n\nnINSTRUCTION:\n(1) reformulate the mentioned condition as clauses, where each clause is of the form \"if condition1 then condition2\".\n(2) Then, reformulate each clause as implicative Horn clauses of the form \"c1 and c2 ... implies ck\".\n(3) Finally, translate the Horn clauses to Python code to complete the code of {poscFunctionName}."        
 
-    return prompt  
\ No newline at end of file
+    return prompt  
+
+def create_combined_prompt(task: Dict, prompt_type: str) -> str:
+    """
+    Create a single prompt asking both the pre- and the post-condition of the task, for one
+    of the COMBINED_PROMPT_TYPES. Returns None if the task does not have both conditions;
+    they should then be asked separately, with create_prompt.
+    """
+    for condition_type in ["pre","post"]:
+        condition = task.get(condition_type + "_condition")
+        if condition == None or condition == "": return None
+
+    pre_incomplete  = task["pre_condition_incomplete"]
+    post_incomplete = task["post_condition_incomplete"]
+    preFunctionName  = pre_incomplete.split('(')[0].strip().split()[1].strip()
+    postFunctionName = post_incomplete.split('(')[0].strip().split()[1].strip()
+
+    if prompt_type == "usePrgDescPrePost":
+        if not('program' in task) : return None 
+        programName = task['program'].split('(')[0].strip().split()[1].strip()
+        programDesc = task['program-desc']
+        zz = post_incomplete.split('(')[1].split(',')[0]
+        if ':' in zz :
+            retvalParamName = zz.split(':')[0].strip()
+        elif ')' in zz :
+            retvalParamName = zz.split(')')[0].strip()
+        else:
+            retvalParamName = zz.strip()
+        prompt = f"Consider a program {programName}. {programDesc}\n\nINSTRUCTION:\n(1) Extract the pre-condition and the post-condition of {programName} (in English). \n(2) Then, code the pre-condition as a Python function with the first header shown below, and the post-condition as a Python function with the second header shown below, where the parameter {retvalParamName} represents {programName}'s return value.\nGive each function in its own code block. Do not explain. If a helper function is needed, define it as an inner function. Import packages, if needed, locally within the function.\n\n{pre_incomplete}\n\n{post_incomplete}"
+
+    elif prompt_type == "usePredDescPrePost":
+        prompt = f"Consider two Python functions {preFunctionName} and {postFunctionName} with headers:\n\n{pre_incomplete}\n\n{post_incomplete}\n\nThe function {preFunctionName} checks if the following condition holds. {task['pre_condition']}\n\nThe function {postFunctionName} checks if the following condition holds. {task['post_condition']}\n\nINSTRUCTION: please complete the code of both functions, each in its own code block. Only give the code. Do not explain. If a helper function is needed, define it as an inner function. Import packages, if needed, locally within the function."
+
+    else:
+        return None
+
+    return prompt
+
+
+def create_batched_prompt(prompts: list[str]) -> str:
+    """
+    Pack the given prompts, e.g. those of several tasks, into a single prompt, which asks
+    the answer to each of them in its own section, marked by a line ### ANSWER <i>.
+    See split_batched_answer.
+    """
+    K = len(prompts)
+    prompt = f"Below are {K} separate tasks, numbered 1 to {K}. Do each task independently of the others.\nStart the answer to task i with a line containing only ### ANSWER i, and give the answers in the order of the tasks.\n"
+    for (i,P) in enumerate(prompts):
+        prompt += f"\n=== TASK {i+1} ===\n{P}\n"
+    return prompt
+
+_batchedPromptHead = re.compile(r"^Below are (\d+) separate tasks, numbered 1 to \1\.")
+
+def split_batched_prompt(prompt: str) -> list[str]:
+    """
+    The prompts packed by create_batched_prompt in the given prompt, or None if it is not
+    such a prompt.
+    """
+    m = _batchedPromptHead.match(prompt)
+    if m == None: return None
+    K = int(m.group(1))
+    prompts = []
+    for i in range(K):
+        start = prompt.find(f"\n=== TASK {i+1} ===\n")
+        if start < 0: return None
+        start += len(f"\n=== TASK {i+1} ===\n")
+        end = prompt.find(f"\n\n=== TASK {i+2} ===\n", start) if i+1 < K else len(prompt) - 1
+        if end < 0: return None
+        prompts.append(prompt[start:end])
+    return prompts
+
+_answerMarker = re.compile(r"^[\s#*]*ANSWER\s*(?:TO\s*TASK\s*)?(\d+)[\s#*:.]*$", re.IGNORECASE)
+
+def split_batched_answer(answer: str, K: int) -> list[str]:
+    """
+    Split an answer to a prompt made by create_batched_prompt from K prompts into the K
+    answers. An element is None if the answer to that prompt cannot be found. The markers
+    are recognized leniently (e.g. in bold, or with a colon), but not inside Markdown-quoted
+    code, where e.g. a comment # ANSWER 2 is just code; if a number is marked more than
+    once, the first is taken.
+    """
+    sections = [ None ] * K
+    if answer == None: return sections
+    current = None
+    inQuote = False
+    for z in answer.split('\n'):
+        if z.strip().startswith('```'):
+            inQuote = not inQuote
+        m = None if inQuote else _answerMarker.match(z)
+        if m != None:
+            i = int(m.group(1)) - 1
+            current = i if 0 <= i < K and sections[i] == None else None
+            if current != None: sections[current] = []
+            continue
+        if current != None: sections[current].append(z)
+    return [ None if S == None or '\n'.join(S).strip() == "" else '\n'.join(S).strip() for S in sections ]
@@ -67,6 +67,104 @@ def extractPythonFunctionDef_fromMarkDownQuote(pythonStr:str) -> str :
 
     return '\n'.join(functionDef)
 
+# Stop sequences for providers, ending an answer at the blank line after a closing code fence. An
+# opening fence is followed by code rather than by a blank line, so it does not match.
+CODE_ANSWER_STOP_SEQUENCES = [ "\n```\n\n" ]
+
+def numOfFunctionHeaders(prompt:str) -> int :
+    """
+    The number of function headers (lines starting with def) in a prompt, i.e. the number
+    of functions it asks to complete.
+    """
+    return len([ z for z in prompt.split('\n') if z.strip().startswith('def ') ])
+
+def endOfCodeAnswer(txt:str, prompt:str=None) -> int :
+    """
+    To be used as a stop detector on a partial answer of an LLM that is being streamed.
+    If the answer already contains as many complete Markdown-quoted code blocks as the prompt
+    asks functions (at least one), or else a complete unquoted function definition (followed
+    by a blank line and a line that is less indented than the def), return the length of the
+    prefix of the answer up to the end of that code. Else return None. Only complete lines
+    are considered.
+
+    The rest of the answer is not needed, since extractPythonFunctionDef_fromMarkDownQuote
+    only takes the first code block anyway (and splitPrePostAnswer the first two).
+    """
+    blocksNeeded = 1 if prompt == None else max(1, numOfFunctionHeaders(prompt))
+    lines = txt.split('\n')
+    # the last line may still be incomplete:
+    lines = lines[0 : len(lines)-1]
+    position = 0
+    inQuote = False
+    defColumn = None
+    previousIsEmpty = False
+    for z in lines:
+        striped_z = z.strip()
+        lineEnd = position + len(z) + 1
+        if striped_z.startswith('```'):
+            if inQuote : 
+                # the quote is closed
+                blocksNeeded = blocksNeeded - 1
+                if blocksNeeded == 0: return lineEnd
+                inQuote = False
+                position = lineEnd
+                previousIsEmpty = False
+                continue
+            if defColumn != None :
+                # a quote after an unquoted function
+                return position
+            inQuote = True
+        elif not inQuote:
+            if defColumn == None:
+                if striped_z.startswith('def '): defColumn = getColumnStart(z)
+            elif (previousIsEmpty and striped_z != '' and getColumnStart(z) <= defColumn
+                  and not striped_z.startswith('def ') and not striped_z.startswith('@') and not striped_z.startswith('#')):
+                # text after the function
+                return position
+        previousIsEmpty = striped_z == ''
+        position = lineEnd
+    return None
+
+def splitPrePostAnswer(answer:str, preHeader:str, postHeader:str) -> tuple :
+    """
+    Split an answer to a prompt asking both the pre- and the post-condition of a program
+    into two: the definition of the pre-condition function, and that of the post-condition
+    function, recognized by the names in the given headers. The code is taken from the
+    Markdown-quoted blocks of the answer if there are any (whether the functions are in
+    separate blocks or in the same one), else from the whole answer. A function runs until
+    the definition of the other one, or the end of its block.
+
+    Returns a pair (pre,post); an element is None if that function cannot be found.
+    """
+    if answer == None: return (None,None)
+    names = [ header.split('(')[0].strip().split()[1].strip() for header in [preHeader,postHeader] ]
+    # gather the code blocks:
+    if answer.find("```") < 0:
+        blocks = [ answer.split('\n') ]
+    else:
+        blocks = []
+        inQuote = False
+        for z in answer.split('\n'):
+            if z.strip().startswith('```'):
+                inQuote = not inQuote
+                if inQuote: blocks.append([])
+                continue
+            if inQuote: blocks[-1].append(z)
+    parts = [ None, None ]
+    for lines in blocks:
+        # the start of each of the two functions in this block, if there:
+        starts = [ None, None ]
+        for (i,z) in enumerate(lines):
+            for k in [0,1]:
+                if starts[k] == None and z.strip().startswith(f"def {names[k]}("):
+                    starts[k] = i
+        for k in [0,1]:
+            if starts[k] == None or parts[k] != None: continue
+            other = starts[1-k]
+            end = other if other != None and other > starts[k] else len(lines)
+            parts[k] = '\n'.join(lines[starts[k] : end]).rstrip()
+    return (parts[0], parts[1])
+
 def getColumnStart(z:str) -> int :
     """
     Given a string z, this gives the index of the first character in z
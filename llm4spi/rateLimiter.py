@@ -0,0 +1,93 @@
+#
+# A rate limiter for the requests sent to LLM providers, enforcing the usual quota of
+# requests per minute (RPM), tokens per minute (TPM), and requests per day (RPD).
+#
+# Each quota is a token bucket: it holds up to its limit, and refills continuously at
+# limit-per-period. A request takes one from the RPM and RPD buckets, and its estimated
+# number of tokens from the TPM bucket; it waits until all three have enough. When the
+# response arrives, the estimate is corrected with the real usage reported by the provider
+# (this may push the TPM bucket below zero, which then delays the next requests).
+#
+# A limiter can be shared by several PromptResponders (e.g. when they use the same API key),
+# and is safe to use from several threads (the asyncio mode of generate_results also sends
+# its requests from threads). The token budget of a request that fails is given back.
+#
+import threading
+import time
+
+class TokenBucket:
+    """
+    A bucket holding up to capacity tokens, refilled at capacity tokens per period seconds.
+    Not thread-safe by itself; RateLimiter guards it.
+    """
+    def __init__(self, capacity:float, period:float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.lastRefill = time.monotonic()
+
+    def refill(self, now:float):
+        self.level = min(self.capacity, self.level + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+
+    def waitTime(self, amount:float) -> float :
+        """
+        The time (in seconds) until the bucket holds the given amount. A request larger
+        than the capacity only waits for a full bucket.
+        """
+        amount = min(amount, self.capacity)
+        if self.level >= amount: return 0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount:float):
+        self.level = self.level - amount
+
+
+class RateLimiter:
+    """
+    Enforce RPM, TPM, and RPD budgets. A budget that is None is not enforced.
+    """
+    def __init__(self, rpm:int=None, tpm:int=None, rpd:int=None):
+        self.lock = threading.Lock()
+        self.rpm = None if rpm == None else TokenBucket(rpm, 60)
+        self.tpm = None if tpm == None else TokenBucket(tpm, 60)
+        self.rpd = None if rpd == None else TokenBucket(rpd, 24*60*60)
+        # the total time requests have been waiting, for reporting:
+        self.waited = 0
+        self.DEBUG = False
+
+    def tryAcquire(self, estimatedTokens:int, requests:int=1) -> float :
+        """
+        Take the budget for the given number of requests and estimated tokens, if it is
+        available. Returns 0 if so, else the time to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            needs = [ (self.rpm,requests), (self.tpm,estimatedTokens), (self.rpd,requests) ]
+            needs = [ (B,amount) for (B,amount) in needs if B != None ]
+            for (B,amount) in needs: B.refill(now)
+            wait = max([ B.waitTime(amount) for (B,amount) in needs ], default=0)
+            if wait > 0: return wait
+            for (B,amount) in needs: B.take(amount)
+            return 0
+
+    def acquire(self, estimatedTokens:int, requests:int=1):
+        """
+        Block until the budget for the given number of requests and estimated tokens
+        is available, and take it.
+        """
+        while True:
+            wait = self.tryAcquire(estimatedTokens, requests)
+            if wait == 0: return
+            if self.DEBUG: print(f">>> rate limit reached, waiting {wait:.1f}s")
+            with self.lock: self.waited += wait
+            time.sleep(wait)
+
+    def settle(self, estimatedTokens:int, actualTokens:int):
+        """
+        Correct the token budget taken for a request with its real usage, once known
+        (0 for a request that failed).
+        """
+        if self.tpm == None or actualTokens == None: return
+        with self.lock:
+            self.tpm.take(actualTokens - estimatedTokens)
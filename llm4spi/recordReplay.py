@@ -0,0 +1,222 @@
+#
+# Recording the answers of an LLM during a run, and replaying them later without the LLM,
+# so that the rest of the pipeline (extracting the completions, evaluating them, reporting)
+# can be benchmarked and debugged offline, repeatably, and without spending any quota.
+#
+# A RecordingResponder wraps the PromptResponder of a run, and appends every request it
+# answers to a recording: the prompt, the sampling parameters, the maximum number of tokens,
+# the answers (and whether they were truncated), and how long the request took. A recording
+# is a gzip'd JSONL file; it is flushed after every request, so that what was recorded
+# before a crash can still be read.
+#
+# A ReplayResponder answers the prompts from one or more recordings, or from the results
+# files of previous runs (results/*_all_*.json, from their *_condition_prompt and
+# *_condition_raw_responses), optionally waiting a simulated latency. A prompt asked several
+# times with the same maximum number of tokens gets the recorded answers in their order
+# (e.g. the re-asked truncated answers); a prompt that was recorded with another maximum
+# gets the answers recorded for it, preferably not truncated ones. Prompts that pack several
+# prompts (see --batch) are answered from the answers to the packed prompts, if the batch
+# itself was not recorded; so results of a run without batches can be replayed with them.
+#
+from typing import Dict
+import threading
+import hashlib
+import gzip
+import json
+import glob
+import time
+import os
+
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated
+from prompting import split_batched_prompt
+from data import parse_results_filename
+
+class ReplayMiss(Exception):
+    """
+    Raised when a prompt to replay is not in the recordings.
+    """
+    pass
+
+def open_recording(path:str, mode:str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def read_recording(path:str) -> list[Dict] :
+    """
+    The records of a recording. A recording cut off by a crash is read up to its last
+    complete record.
+    """
+    records = []
+    with open_recording(path, "r") as fp:
+        try:
+            for line in fp:
+                if not line.endswith("\n"): break
+                records.append(json.loads(line))
+        except EOFError:
+            pass
+    return records
+
+def join_pre_post_answer(pre:str, post:str) -> str :
+    """
+    An answer to a combined prompt, rebuilt from the pre- and post-condition functions it
+    was split into (see pythonSrcUtils.splitPrePostAnswer), each in its own code block.
+    """
+    if pre == None and post == None: return None
+    return "\n".join([ f"```python\n{F}\n```" for F in [pre,post] if F != None ])
+
+def records_from_results(resultsfile:str) -> list[Dict] :
+    """
+    Records, as in a recording, of the prompts and raw answers in a results-file of a
+    previous run. Their maximum number of tokens and latency are not known.
+    """
+    with open(resultsfile, "r") as fp:
+        results = json.load(fp)
+    (experimentName,_) = parse_results_filename(resultsfile)
+    records = []
+    for R in results:
+        pre  = (R.get("pre_condition_prompt"),  R.get("pre_condition_raw_responses"))
+        post = (R.get("post_condition_prompt"), R.get("post_condition_raw_responses"))
+        if pre[0] != None and pre[0] == post[0]:
+            # a combined prompt, whose answers were split into the two conditions:
+            answers = [ join_pre_post_answer(A,B) for (A,B) in zip(pre[1] or [], post[1] or []) ]
+            prompts = [ (pre[0], answers) ]
+        else:
+            prompts = [ pre, post ]
+        for (prompt,answers) in prompts:
+            if prompt == None or answers == None: continue
+            records.append({ "model" : experimentName, "prompt" : prompt, "params" : None, "maxTokens" : None,
+                             "answers" : [ [A,False] for A in answers ], "latency" : None })
+    return records
+
+
+class RecordingResponder(PromptResponder):
+    """
+    A prompt-responder that passes the prompts to another responder, and records the
+    requests and their answers in the given file (see the top of this module).
+    """
+    def __init__(self, AI:PromptResponder, path:str):
+        PromptResponder.__init__(self)
+        self.AI = AI
+        self.path = path
+        self.model = getattr(AI, "model", None)
+        self.lock = threading.Lock()
+        self.file = open_recording(path, "a")
+        self.numOfRecords = 0
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        time0 = time.time()
+        answers = self.AI.completeIt(multipleAnswer, prompt, maxTokens=maxTokens)
+        record = { "model" : self.model, "prompt" : prompt, "params" : self.AI.samplingParams(), "maxTokens" : maxTokens,
+                   "answers" : [ [A, isinstance(A,TruncatedAnswer)] for A in answers ],
+                   "latency" : round(time.time() - time0, 3) }
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.numOfRecords += 1
+        return answers
+
+    def close(self):
+        with self.lock: self.file.close()
+
+    def samplingParams(self) -> Dict :
+        return self.AI.samplingParams()
+
+    def endpoint(self) -> str :
+        return self.AI.endpoint()
+
+    def requestStats(self) -> Dict :
+        stats = dict(self.AI.requestStats())
+        stats["recorded requests"] = self.numOfRecords
+        return stats
+
+
+class ReplayResponder(PromptResponder):
+    """
+    A prompt-responder that answers with the answers in the given records (see the top of
+    this module). The latency is None (answer right away), a number of seconds to wait for
+    every request, or "recorded" to wait as long as the recorded request took.
+    """
+    def __init__(self, records:list[Dict], latency=None):
+        PromptResponder.__init__(self)
+        if not (latency == None or latency == "recorded" or isinstance(latency,(int,float))):
+            raise Exception(f"Unknown replay latency {latency}, it should be a number of seconds or 'recorded'")
+        self.latency = latency
+        self.model = next((R["model"] for R in records if R.get("model") != None), "replay")
+        self.params = next((R["params"] for R in records if R.get("params") != None), {})
+        # the records of each prompt, by the hash of the prompt, in their order:
+        self.records = {}
+        for R in records:
+            self.records.setdefault(self.promptKey(R["prompt"]), []).append(R)
+        self.lock = threading.Lock()
+        # how many times each (prompt,maxTokens) has been asked:
+        self.numOfAsks = {}
+        # statistics:
+        self.numOfReplayed = 0
+        self.numOfMisses = 0
+
+    @staticmethod
+    def load(paths:list[str], latency=None) -> "ReplayResponder" :
+        """
+        A ReplayResponder of the given recordings, results-files, and folders of results-files.
+        """
+        records = []
+        for path in paths:
+            if os.path.isdir(path):
+                resultsfiles = sorted(glob.glob(os.path.join(path, "*_all_*.json")))
+                for f in resultsfiles: records.extend(records_from_results(f))
+            elif path.endswith(".json"):
+                records.extend(records_from_results(path))
+            else:
+                records.extend(read_recording(path))
+        print(f"** Replaying {len(records)} recorded requests")
+        return ReplayResponder(records, latency=latency)
+
+    def promptKey(self, prompt:str) -> str :
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def find(self, prompt:str, maxTokens:int) -> Dict :
+        """
+        The record to answer the prompt with, or None if the prompt was not recorded.
+        """
+        records = self.records.get(self.promptKey(prompt))
+        if records == None: return None
+        same = [ R for R in records if R["maxTokens"] == maxTokens ]
+        if len(same) > 0:
+            with self.lock:
+                k = self.numOfAsks.get((prompt,maxTokens), 0)
+                self.numOfAsks[(prompt,maxTokens)] = k + 1
+            return same[min(k, len(same)-1)]
+        complete = [ R for R in records if not any([ truncated for (_,truncated) in R["answers"] ]) ]
+        return max(complete if len(complete) > 0 else records, key=lambda R: len(R["answers"]))
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        record = self.find(prompt, maxTokens)
+        if record != None:
+            answers = [ mark_truncated(A, truncated) for (A,truncated) in record["answers"][:multipleAnswer] ]
+            delay = record["latency"] if self.latency == "recorded" else self.latency
+        else:
+            prompts = split_batched_prompt(prompt)
+            records = None if prompts == None else [ self.find(P, None) for P in prompts ]
+            if records == None or None in records:
+                with self.lock: self.numOfMisses += 1
+                raise ReplayMiss(f"A prompt is not in the recordings:\n{prompt[:200]}")
+            answers = []
+            for k in range(multipleAnswer):
+                sections = [ (i,R["answers"][k][0]) for (i,R) in enumerate(records) if k < len(R["answers"]) ]
+                answers.append("\n".join([ f"### ANSWER {i+1}\n{A}" for (i,A) in sections if A != None ]))
+            delay = max([ R["latency"] or 0 for R in records ]) if self.latency == "recorded" else self.latency
+        if delay != None and delay > 0: time.sleep(delay)
+        with self.lock: self.numOfReplayed += 1
+        if self.DEBUG: print(f">>> {len(answers)} answers replayed")
+        return answers
+
+    def samplingParams(self) -> Dict :
+        return self.params
+
+    def requestStats(self) -> Dict :
+        stats = dict(PromptResponder.requestStats(self))
+        stats["replayed requests"] = self.numOfReplayed
+        stats["replay misses"] = self.numOfMisses
+        return stats
@@ -0,0 +1,203 @@
+#
+# A persistent cache of the answers of LLMs, so that re-running an experiment (e.g. after a
+# crash, or after changing the evaluation) does not send the same requests again.
+#
+# The cache is a single sqlite file. An answer is keyed by the provider and the URL of its API
+# (so e.g. a local OpenAI-compatible server does not share answers with OpenAI), the model,
+# the prompt, the sampling parameters, the maximum number of tokens, the stop sequences of
+# streamed answers (which are cut off), and its index among the multiple answers asked for
+# the prompt; so asking 5 answers after having asked 3 only sends a request for the 2 missing ones. Several
+# processes (e.g. the shards of a run) can share the same cache file. If the cache is given a
+# maximum size, the least recently used answers are evicted when it grows beyond it.
+#
+# The cache is used by wrapping a PromptResponder in a CachingResponder, in one of the modes:
+#
+#   * readthrough : answers in the cache are used, missing ones are asked to the LLM and stored.
+#   * refresh     : all answers are asked to the LLM, and replace those in the cache.
+#   * offline     : only answers in the cache are used; a missing answer is an error.
+#
+# Identical prompts that are in flight at the same time (e.g. with --concurrency) are only
+# sent once; the others wait for its answers.
+#
+from typing import Dict
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated
+
+CACHE_MODES = [ "readthrough", "refresh", "offline" ]
+
+class CacheMiss(Exception):
+    """
+    Raised in offline mode when an answer is not in the cache.
+    """
+    pass
+
+class ResponseCache:
+    """
+    The sqlite file holding the cached answers. Each thread gets its own connection.
+    """
+    def __init__(self, path:str, maxBytes:int=None):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.local = threading.local()
+        C = self.connection()
+        C.execute("""CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        provider TEXT, model TEXT,
+                        answer TEXT,
+                        size INTEGER,
+                        created REAL, lastUsed REAL,
+                        truncated INTEGER DEFAULT 0)""")
+        # caches made before answers could be truncated lack that column:
+        columns = [ row[1] for row in C.execute("PRAGMA table_info(responses)") ]
+        if not ("truncated" in columns):
+            C.execute("ALTER TABLE responses ADD COLUMN truncated INTEGER DEFAULT 0")
+        C.execute("CREATE INDEX IF NOT EXISTS responses_lastUsed ON responses(lastUsed)")
+        C.commit()
+
+    def connection(self) -> sqlite3.Connection :
+        C = getattr(self.local, "connection", None)
+        if C == None:
+            # a generous timeout, as other processes may be writing too:
+            C = sqlite3.connect(self.path, timeout=60)
+            C.execute("PRAGMA journal_mode=WAL")
+            C.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = C
+        return C
+
+    def get(self, keys:list[str]) -> Dict[str,str] :
+        """
+        Return the cached answers of the given keys, as a dictionary; missing keys are
+        not in it. The answers found are marked as recently used. Truncated answers are
+        returned as TruncatedAnswer.
+        """
+        if len(keys) == 0: return {}
+        C = self.connection()
+        marks = ",".join("?" * len(keys))
+        rows = C.execute(f"SELECT key, answer, truncated FROM responses WHERE key IN ({marks})", keys).fetchall()
+        if len(rows) > 0:
+            now = time.time()
+            C.executemany("UPDATE responses SET lastUsed=? WHERE key=?", [ (now,key) for (key,_,_) in rows ])
+            C.commit()
+        return { key : mark_truncated(answer, truncated == 1) for (key,answer,truncated) in rows }
+
+    def put(self, entries:list[tuple]):
+        """
+        Store the given (key,provider,model,answer) entries, replacing existing ones.
+        """
+        if len(entries) == 0: return
+        now = time.time()
+        C = self.connection()
+        C.executemany("""INSERT OR REPLACE INTO responses (key, provider, model, answer, size, created, lastUsed, truncated)
+                         VALUES (?,?,?,?,?,?,?,?)""",
+                      [ (key, provider, model, answer, len(answer.encode('utf-8')), now, now, int(isinstance(answer,TruncatedAnswer)))
+                        for (key,provider,model,answer) in entries ])
+        C.commit()
+        if self.maxBytes != None: self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used answers, until the cache is back below its maximum size
+        (to 90% of it, so that eviction does not happen at every put).
+        """
+        C = self.connection()
+        (total,) = C.execute("SELECT COALESCE(SUM(size),0) FROM responses").fetchone()
+        if total <= self.maxBytes: return
+        target = int(0.9 * self.maxBytes)
+        removed = []
+        for (key,size) in C.execute("SELECT key, size FROM responses ORDER BY lastUsed"):
+            if total <= target: break
+            removed.append((key,))
+            total -= size
+        C.executemany("DELETE FROM responses WHERE key=?", removed)
+        C.commit()
+
+
+class CachingResponder(PromptResponder):
+    """
+    A prompt-responder that answers from a ResponseCache, and asks the answers that are not
+    in the cache to another responder (see the modes at the top of this module).
+    """
+    def __init__(self, AI:PromptResponder, cache:ResponseCache, mode:str="readthrough"):
+        PromptResponder.__init__(self)
+        if not (mode in CACHE_MODES):
+            raise Exception(f"Unknown cache mode {mode}, it should be one of {CACHE_MODES}")
+        self.AI = AI
+        self.cache = cache
+        self.mode = mode
+        self.provider = type(AI).__name__
+        self.model = getattr(AI, "model", None)
+        self.lock = threading.Lock()
+        # the prompts being asked to the AI, with an event set when their answers are in:
+        self.inflight = {}
+        # statistics:
+        self.numOfHits = 0
+        self.numOfMisses = 0
+
+    def promptKey(self, prompt:str, maxTokens:int) -> str :
+        params = self.AI.samplingParams()
+        key = [self.provider, self.model, prompt, params]
+        # keep the keys of answers without a maximum as they were:
+        if maxTokens != None: key.append(maxTokens)
+        endpoint = self.AI.endpoint()
+        if endpoint != None: key.append({ "endpoint" : endpoint })
+        if self.AI.streaming: key.append({ "streaming" : True, "stop" : self.AI.stopSequencesFor(prompt) })
+        key = json.dumps(key, sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        promptKey = self.promptKey(prompt, maxTokens)
+        keys = [ f"{promptKey}/{k}" for k in range(multipleAnswer) ]
+        if self.mode == "refresh":
+            return self.askAndStore(prompt, keys, maxTokens)
+        while True:
+            cached = self.cache.get(keys)
+            missing = [ key for key in keys if not (key in cached) ]
+            if len(missing) == 0:
+                with self.lock: self.numOfHits += len(keys)
+                if self.DEBUG: print(f">>> {len(keys)} answers from the cache")
+                return [ cached[key] for key in keys ]
+            if self.mode == "offline":
+                raise CacheMiss(f"{len(missing)} of {len(keys)} answers to a prompt are not in the cache (offline mode)")
+            with self.lock:
+                pending = self.inflight.get(promptKey)
+                if pending == None:
+                    self.inflight[promptKey] = threading.Event()
+            if pending == None: break
+            # the same prompt is already being asked; wait for it, then look again:
+            pending.wait()
+        try:
+            answers = self.askAndStore(prompt, missing, maxTokens)
+        finally:
+            with self.lock:
+                self.inflight.pop(promptKey).set()
+        with self.lock: self.numOfHits += len(keys) - len(missing)
+        answers = dict(zip(missing, answers))
+        # the AI may give fewer answers than asked:
+        return [ cached[key] if key in cached else answers[key] for key in keys
+                 if key in cached or key in answers ]
+
+    def askAndStore(self, prompt:str, keys:list[str], maxTokens:int) -> list[str] :
+        """
+        Ask as many answers as there are keys to the AI, and store them under those keys.
+        """
+        answers = self.AI.completeIt(len(keys), prompt, maxTokens=maxTokens)
+        with self.lock: self.numOfMisses += len(keys)
+        self.cache.put([ (key, self.provider, self.model, A) for (key,A) in zip(keys,answers) if A != None ])
+        return answers
+
+    def samplingParams(self) -> Dict :
+        return self.AI.samplingParams()
+
+    def endpoint(self) -> str :
+        return self.AI.endpoint()
+
+    def requestStats(self) -> Dict :
+        stats = dict(self.AI.requestStats())
+        stats["cache hits"] = self.numOfHits
+        stats["cache misses"] = self.numOfMisses
+        return stats
@@ -0,0 +1,190 @@
+#
+# Local estimation of the number of tokens of prompts, to budget the requests to the LLM
+# providers (see rateLimiter.py) without asking the provider to count them.
+#
+# A TokenCounter counts the tokens of a text with the tokenizer of the provider, if one is
+# installed and works offline (tiktoken for OpenAI, the local tokenizer of google-genai for
+# Gemini), and else with a heuristic that splits the text as BPE tokenizers roughly do. The
+# counts are cached by the hash of the text, as the same prompts are budgeted repeatedly.
+#
+# The tokens used by a request are estimated as a*prompt + b*answers, where prompt is the
+# count of its prompt. The factor a (correcting the heuristic, and the tokens the provider
+# adds around a prompt) and the tokens per answer b are fitted, by recursive least squares,
+# to the usage the provider reports for every request; so the estimates keep improving as
+# the run goes, and follow changes in the answers' length.
+#
+from collections import OrderedDict
+import threading
+import tempfile
+import hashlib
+import os
+import re
+
+# how many counts are cached:
+CACHE_SIZE = 4096
+
+# the pieces a BPE tokenizer would roughly make of a text: words (camelCase identifiers are
+# split in their parts), groups of up to 3 digits, runs of punctuation, and runs of whitespace:
+TEXT_PIECES = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]{1,3}|[^\sA-Za-z0-9]+|\s+")
+
+def heuristic_count(text:str) -> int :
+    """
+    Estimate the number of tokens of a text, without a tokenizer: a word, or a part of an
+    identifier, is a token per 8 letters (most words are a single token), a group of digits
+    is one, punctuation is a token per 2 characters, and so is a run of whitespace (e.g. a
+    newline and indentation), except a single space, which is merged with the next word.
+    """
+    count = 0
+    for piece in TEXT_PIECES.findall(text):
+        if piece[0].isalpha():
+            count += (len(piece) + 7) // 8
+        elif piece[0].isdigit():
+            count += 1
+        elif piece[0].isspace():
+            count += 0 if piece == " " else 1
+        else:
+            count += (len(piece) + 1) // 2
+    return count
+
+def tiktoken_cached(encodingName:str) -> bool :
+    """
+    Whether the file of the given tiktoken encoding is in tiktoken's cache (where it puts the
+    files it downloads, see tiktoken.load.read_file_cached), so that loading it does not
+    download it.
+    """
+    blob = f"https://openaipublic.blob.core.windows.net/encodings/{encodingName}.tiktoken"
+    cacheDir = os.environ.get("TIKTOKEN_CACHE_DIR", os.environ.get("DATA_GYM_CACHE_DIR",
+                              os.path.join(tempfile.gettempdir(), "data-gym-cache")))
+    if cacheDir == "": return False
+    return os.path.exists(os.path.join(cacheDir, hashlib.sha1(blob.encode()).hexdigest()))
+
+def openai_tokenizer(model:str):
+    """
+    The tokenize function of tiktoken for the given OpenAI model, or None if tiktoken, or
+    its encoding, is not available offline. tiktoken downloads an encoding the first time it
+    is used; it is then cached, e.g. by counting a text with tiktoken once while online.
+    """
+    try:
+        import tiktoken
+        from tiktoken.model import encoding_name_for_model
+        try:
+            encodingName = encoding_name_for_model(model)
+        except KeyError:
+            encodingName = "o200k_base"
+        if not tiktoken_cached(encodingName): return None
+        encoding = tiktoken.get_encoding(encodingName)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return None
+
+def gemini_tokenizer_cached(model:str) -> bool :
+    """
+    Whether the sentencepiece model of the local tokenizer of google-genai for the given
+    Gemini model is in its cache (where the tokenizer puts the model it downloads, see
+    google.genai._local_tokenizer_loader), so that loading it does not download it.
+    """
+    try:
+        from google.genai import _local_tokenizer_loader as loader
+        tokenizer = loader._TOKENIZERS.get(loader.get_tokenizer_name(model))
+        # the tokenizers of the newer models come from Hugging Face:
+        if tokenizer == None: return False
+        cacheDir = os.path.join(tempfile.gettempdir(), "vertexai_tokenizer_model")
+        return os.path.exists(os.path.join(cacheDir, hashlib.sha1(tokenizer.model_url.encode()).hexdigest()))
+    except Exception:
+        return False
+
+def gemini_tokenizer(model:str):
+    """
+    The tokenize function of the local tokenizer of google-genai for the given Gemini model,
+    or None if it, or its sentencepiece model, is not available offline. As tiktoken, the
+    tokenizer downloads its model the first time it is used.
+    """
+    try:
+        from google.genai.local_tokenizer import LocalTokenizer
+        if not gemini_tokenizer_cached(model): return None
+        tokenizer = LocalTokenizer(model_name=model)
+        return lambda text: tokenizer.count_tokens(text).total_tokens
+    except Exception:
+        return None
+
+def token_counter(provider:str, model:str) -> "TokenCounter" :
+    """
+    A TokenCounter for the given provider and model, with their tokenizer if there is one.
+    """
+    match provider:
+        case "openAI": tokenize = openai_tokenizer(model)
+        case "gemini": tokenize = gemini_tokenizer(model)
+        case _: tokenize = None
+    return TokenCounter(tokenize)
+
+
+class TokenCounter:
+    """
+    Count the tokens of prompts, and estimate the tokens requests use (see the top of
+    this module). If tokenize is None, the heuristic is used.
+    """
+    def __init__(self, tokenize=None, forgetting:float=0.98):
+        self.tokenize = heuristic_count if tokenize == None else tokenize
+        self.exact = tokenize != None
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        # the fitted factor of the prompt tokens, and tokens per answer (None until a usage
+        # is known), and the covariance of the fit:
+        self.factor = 1.0
+        self.perAnswer = None
+        self.P = None
+        self.forgetting = forgetting
+        self.numOfObservations = 0
+
+    def count(self, text:str) -> int :
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        with self.lock:
+            n = self.cache.get(key)
+            if n != None:
+                self.cache.move_to_end(key)
+                return n
+        n = self.tokenize(text)
+        with self.lock:
+            self.cache[key] = n
+            if len(self.cache) > CACHE_SIZE: self.cache.popitem(last=False)
+        return n
+
+    def estimate(self, prompt:str, numOfAnswers:int, answerTokensGuess:int) -> int :
+        """
+        Estimate the tokens of a request with the given prompt and number of answers;
+        before any usage is known, an answer is taken to have answerTokensGuess tokens.
+        """
+        n = self.count(prompt)
+        with self.lock:
+            perAnswer = answerTokensGuess if self.perAnswer == None else self.perAnswer
+            return int(self.factor * n + numOfAnswers * perAnswer) + 1
+
+    def observe(self, prompt:str, numOfAnswers:int, actualTokens:int, answerTokensGuess:int):
+        """
+        Correct the fit with the real number of tokens a request used.
+        """
+        if actualTokens == None or actualTokens <= 0: return
+        x = (self.count(prompt), numOfAnswers)
+        with self.lock:
+            if self.perAnswer == None:
+                self.perAnswer = float(answerTokensGuess)
+                # how uncertain the initial factor and tokens per answer are (as variances);
+                # an exact count of the prompt needs little correcting:
+                self.P = [[0.01 if self.exact else 0.25, 0.0], [0.0, float(answerTokensGuess)**2]]
+            P = self.P
+            L = self.forgetting
+            Px = (P[0][0]*x[0] + P[0][1]*x[1], P[1][0]*x[0] + P[1][1]*x[1])
+            denominator = L + x[0]*Px[0] + x[1]*Px[1]
+            gain = (Px[0] / denominator, Px[1] / denominator)
+            error = actualTokens - (self.factor * x[0] + self.perAnswer * x[1])
+            self.factor = min(4.0, max(0.25, self.factor + gain[0] * error))
+            self.perAnswer = max(1.0, self.perAnswer + gain[1] * error)
+            self.P = [ [ (P[i][j] - gain[i] * Px[j]) / L for j in range(2) ] for i in range(2) ]
+            self.numOfObservations += 1
+
+    def stats(self) -> dict :
+        with self.lock:
+            return {
+                "prompt token factor" : round(self.factor, 3),
+                "tokens per answer" : None if self.perAnswer == None else round(self.perAnswer, 1)
+            }
@@ -0,0 +1,156 @@
+#
+# The HTTP transport of the SDK clients of the remote LLM providers (OpenAI and the
+# OpenAI-compatible ones like Groq, Anthropic, and Gemini).
+#
+# By default every SDK client gets its own connection pool, sized for a handful of requests
+# at a time; with many requests in flight (see --concurrency), requests then wait for a
+# connection, or open new ones, paying a TCP and TLS handshake each time. A TransportFactory
+# creates the SDK clients with one shared pool per SDK, whose limits and timeouts are set
+# for many concurrent requests, with long-lived keep-alive connections, and HTTP/2 if the h2
+# package is installed (then many requests share a single connection).
+#
+# The factory also counts the requests, the new connections, and the TLS handshakes, so that
+# the connection reuse can be checked (see requestStats).
+#
+# When the requests are retried by an AdaptiveController (see adaptiveConcurrency.py), the
+# factory should be given maxRetries=0, so that the SDK clients do not retry throttled
+# requests themselves, hiding the throttling from the controller.
+#
+from typing import Dict
+import threading
+import time
+import httpx
+
+DEFAULT_MAX_CONNECTIONS = 256
+DEFAULT_MAX_KEEPALIVE = 64
+DEFAULT_KEEPALIVE_EXPIRY = 90  # in seconds
+DEFAULT_TIMEOUT = 600          # in seconds, for a whole answer to come
+DEFAULT_CONNECT_TIMEOUT = 10   # in seconds
+
+def h2_available() -> bool :
+    try:
+        import h2
+        return True
+    except ImportError:
+        return False
+
+
+class TransportStats:
+    """
+    Counts of the HTTP requests, and of the connections they had to open, collected from
+    the trace events of the connection pool.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.numOfRequests = 0
+        self.numOfConnections = 0
+        self.numOfHandshakes = 0
+        self.connectTime = 0
+
+    def onRequest(self, request:httpx.Request):
+        with self.lock: self.numOfRequests += 1
+        started = {}
+        def trace(event:str, info:Dict):
+            if event.endswith(".started"):
+                started[event[:-len(".started")]] = time.monotonic()
+            elif event.endswith(".complete"):
+                step = event[:-len(".complete")]
+                duration = time.monotonic() - started.pop(step, time.monotonic())
+                if step == "connection.connect_tcp":
+                    with self.lock:
+                        self.numOfConnections += 1
+                        self.connectTime += duration
+                elif step == "connection.start_tls":
+                    with self.lock:
+                        self.numOfHandshakes += 1
+                        self.connectTime += duration
+        request.extensions["trace"] = trace
+
+    def stats(self) -> Dict :
+        with self.lock:
+            return {
+                "http requests" : self.numOfRequests,
+                "new connections" : self.numOfConnections,
+                "tls handshakes" : self.numOfHandshakes,
+                "connection reuse" : 1 - self.numOfConnections / max(1,self.numOfRequests),
+                "connect time" : round(self.connectTime, 2)
+            }
+
+
+class TransportFactory:
+    """
+    Create the SDK clients of the providers, sharing a tuned connection pool per SDK.
+    If http2 is None, it is used if the h2 package is installed. If maxRetries is None,
+    the SDK clients retry failed requests as they do by default.
+    """
+    def __init__(self, maxConnections:int=DEFAULT_MAX_CONNECTIONS, maxKeepalive:int=DEFAULT_MAX_KEEPALIVE,
+                 keepaliveExpiry:float=DEFAULT_KEEPALIVE_EXPIRY, timeout:float=DEFAULT_TIMEOUT,
+                 connectTimeout:float=DEFAULT_CONNECT_TIMEOUT, http2:bool=None, maxRetries:int=None):
+        self.maxConnections = maxConnections
+        self.maxKeepalive = min(maxKeepalive, maxConnections)
+        self.keepaliveExpiry = keepaliveExpiry
+        self.timeout = timeout
+        self.connectTimeout = connectTimeout
+        self.http2 = h2_available() if http2 == None else http2
+        self.maxRetries = maxRetries
+        self.transportStats = TransportStats()
+        self.lock = threading.Lock()
+        # the shared pools, by SDK:
+        self.pools = {}
+
+    def clientArgs(self) -> Dict :
+        """
+        The arguments of an httpx client with the settings of this factory.
+        """
+        return {
+            "limits" : httpx.Limits(max_connections=self.maxConnections,
+                                    max_keepalive_connections=self.maxKeepalive,
+                                    keepalive_expiry=self.keepaliveExpiry),
+            "timeout" : httpx.Timeout(self.timeout, connect=self.connectTimeout),
+            "http2" : self.http2,
+            "event_hooks" : { "request" : [ self.transportStats.onRequest ] }
+        }
+
+    def retryArgs(self) -> Dict :
+        return {} if self.maxRetries == None else { "max_retries" : self.maxRetries }
+
+    def sharedPool(self, sdk:str, httpClientClass):
+        with self.lock:
+            pool = self.pools.get(sdk)
+            if pool == None:
+                pool = httpClientClass(**self.clientArgs())
+                self.pools[sdk] = pool
+            return pool
+
+    def openai(self, api_key:str, base_url:str=None):
+        """
+        An OpenAI client, or a client of an OpenAI-compatible provider if base_url is given.
+        """
+        from openai import OpenAI, DefaultHttpxClient
+        return OpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout,
+                      http_client=self.sharedPool("openai", DefaultHttpxClient), **self.retryArgs())
+
+    def anthropic(self, api_key:str):
+        from anthropic import Anthropic, DefaultHttpxClient
+        return Anthropic(api_key=api_key, timeout=self.timeout,
+                         http_client=self.sharedPool("anthropic", DefaultHttpxClient), **self.retryArgs())
+
+    def genai(self, api_key:str):
+        """
+        A Gemini client. The genai SDK counts its retries in attempts, the first request included.
+        """
+        from google import genai
+        from google.genai import types
+        retries = None if self.maxRetries == None else types.HttpRetryOptions(attempts = self.maxRetries + 1)
+        return genai.Client(api_key=api_key,
+                            http_options=types.HttpOptions(httpx_client=self.sharedPool("genai", httpx.Client),
+                                                           retry_options=retries,
+                                                           timeout=int(self.timeout * 1000)))
+
+    def stats(self) -> Dict :
+        return self.transportStats.stats()
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values(): pool.close()
+            self.pools = {}
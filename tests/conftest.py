@@ -0,0 +1,48 @@
+#
+# The modules of llm4spi import each other by their plain names (they are run from the
+# llm4spi folder), so the tests put that folder on the path. Run the tests from the root
+# of the repository with:  python -m pytest -q
+#
+# The tests use the small dataset mini.json, at the root of the repository.
+#
+import sys
+import os
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "llm4spi"))
+
+from data import read_problems
+
+@pytest.fixture
+def mini() -> str :
+    return os.path.join(ROOT, "mini.json")
+
+@pytest.fixture
+def answered_tasks(mini) -> dict :
+    """
+    The tasks of mini.json, as if an AI answered each condition twice: with the body of its
+    solution, and with a body that is always true.
+    """
+    tasks = read_problems(mini)
+    for T in tasks.values():
+        for c in ["pre","post"]:
+            solution = T[f"{c}_condition_solution"]
+            T[f"{c}_condition_prompt"] = f"the {c}-condition of {T['task_id']}"
+            if solution in (None,""):
+                T[f"{c}_condition_raw_responses"] = None
+                T[f"{c}_condition_completions"] = None
+            else:
+                body = solution.split("\n",1)[1]
+                T[f"{c}_condition_raw_responses"] = [ f"```python\n{body}\n```", "    return True" ]
+                T[f"{c}_condition_completions"] = [ body, "    return True" ]
+    return tasks
+
+@pytest.fixture
+def results_dir(tmp_path, monkeypatch) -> str :
+    """
+    Run the test in a temporary folder, where the runs write their results/.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("results")
+    return "results"
@@ -0,0 +1,81 @@
+#
+# The AIMD controller: the bound on the requests in flight, and the retries of throttled and
+# transiently failing requests.
+#
+import threading
+import time
+import pytest
+
+from adaptiveConcurrency import AdaptiveController, error_status, retry_after
+
+class Response:
+    def __init__(self, headers:dict):
+        self.headers = headers
+
+class ProviderError(Exception):
+    """
+    An error like those of the provider SDKs, with the HTTP status and the response.
+    """
+    def __init__(self, status_code:int, headers:dict={}):
+        Exception.__init__(self, f"status {status_code}")
+        self.status_code = status_code
+        self.response = Response(headers)
+
+def failing(errors:list, result:str="ok"):
+    """
+    A request failing with the given errors, one per attempt, and then answering.
+    """
+    attempts = []
+    def fn():
+        attempts.append(time.monotonic())
+        if len(attempts) <= len(errors): raise errors[len(attempts)-1]
+        return result
+    return (fn,attempts)
+
+def test_retry_throttled_requests():
+    controller = AdaptiveController(initialLimit=8, maxRetries=3)
+    (fn,attempts) = failing([ ProviderError(429, {"retry-after-ms":"10"}), ProviderError(503, {"retry-after":"0.01"}) ])
+    assert controller.call(fn) == "ok"
+    assert len(attempts) == 3
+    assert controller.stats() == { "requests" : 1, "throttled" : 2, "retries" : 2, "max in flight" : 2 }
+    assert controller.inflight == 0
+
+def test_transient_errors_are_retried_and_others_not():
+    controller = AdaptiveController(initialLimit=10, baseDelay=0.01)
+    (fn,attempts) = failing([ ProviderError(500), TimeoutError("read timed out") ])
+    assert controller.call(fn) == "ok"
+    assert len(attempts) == 3
+    assert controller.stats()["throttled"] == 0
+    assert controller.limit < 10
+    (fn,attempts) = failing([ ProviderError(400) ])
+    with pytest.raises(ProviderError):
+        controller.call(fn)
+    assert len(attempts) == 1
+    assert controller.inflight == 0
+
+def test_give_up_after_max_retries():
+    controller = AdaptiveController(maxRetries=2)
+    (fn,attempts) = failing([ ProviderError(429, {"retry-after":"0"}) ] * 5)
+    with pytest.raises(ProviderError):
+        controller.call(fn)
+    assert len(attempts) == 3
+    assert controller.limit == controller.minLimit
+
+def test_bound_on_requests_in_flight():
+    controller = AdaptiveController(initialLimit=3, minLimit=3, maxLimit=3)
+    inflight = []
+    lock = threading.Lock()
+    def fn():
+        with lock: inflight.append(controller.inflight)
+        time.sleep(0.02)
+    threads = [ threading.Thread(target=controller.call, args=[fn]) for k in range(9) ]
+    for T in threads: T.start()
+    for T in threads: T.join()
+    assert max(inflight) == 3
+    assert controller.stats()["max in flight"] == 3
+
+def test_error_status_and_retry_after():
+    assert error_status(ProviderError(529)) == 529
+    assert error_status(Exception()) == None
+    assert retry_after(ProviderError(429, {"retry-after":"2"})) == 2
+    assert retry_after(ProviderError(429)) == None
@@ -0,0 +1,58 @@
+#
+# The max_tokens budgets of answers, and asking truncated answers again with a larger one.
+#
+from data import read_problems
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated, answer_budget, complete_within_budget
+from prompting import answer_token_budget, is_reasoning_model, MIN_ANSWER_TOKENS, MAX_ANSWER_TOKENS
+
+class BudgetedResponder(PromptResponder):
+    """
+    Gives answers of the given number of tokens, cut off at the maximum it is asked.
+    """
+    def __init__(self, answerTokens:list[int], model:str="gpt-4o"):
+        PromptResponder.__init__(self)
+        self.model = model
+        self.answerBudgets = True
+        self.answerTokens = answerTokens
+        self.asked = []
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        self.asked.append((multipleAnswer,maxTokens))
+        tokens = self.answerTokens[0 : multipleAnswer]
+        self.answerTokens = self.answerTokens[multipleAnswer:]
+        return [ mark_truncated(f"answer of {T} tokens", maxTokens != None and T > maxTokens) for T in tokens ]
+
+def test_budgets_of_prompt_types(mini):
+    task = read_problems(mini)["HE13"]
+    budgets = [ answer_token_budget(task, "post", pt) for pt in ["usePredDesc", "usePrgDesc", "cot1"] ]
+    assert budgets == sorted(budgets)
+    assert all([ MIN_ANSWER_TOKENS <= B <= MAX_ANSWER_TOKENS for B in budgets ])
+    # a missing solution gets the least:
+    assert answer_token_budget({}, "pre", "usePredDesc") == MIN_ANSWER_TOKENS
+
+def test_budgets_are_opt_in(mini):
+    task = read_problems(mini)["HE13"]
+    AI = BudgetedResponder([])
+    assert answer_budget(AI, task, "post", "usePrgDesc") == answer_token_budget(task, "post", "usePrgDesc")
+    AI.answerBudgets = False
+    assert answer_budget(AI, task, "post", "usePrgDesc") == None
+    # reasoning models need more than the budget, for their reasoning:
+    assert answer_budget(BudgetedResponder([], model="o3-mini"), task, "post", "usePrgDesc") == None
+    assert [ is_reasoning_model(m) for m in ["o1-preview", "deepseek-r1:7b", "qwq-32b", "gpt-4o", "llama3-70b"] ] == [ True, True, True, False, False ]
+
+def test_truncated_answers_are_asked_again():
+    AI = BudgetedResponder([ 100, 300, 200, 500, 250, 550 ])
+    answers = complete_within_budget(AI, 3, "a prompt", 150)
+    assert answers == [ "answer of 100 tokens", "answer of 550 tokens", "answer of 250 tokens" ]
+    assert not any([ isinstance(A,TruncatedAnswer) for A in answers ])
+    # the truncated answers are asked again, with twice the budget, until they fit:
+    assert AI.asked == [ (3,150), (2,300), (1,600) ]
+
+def test_no_budget_no_retry():
+    AI = BudgetedResponder([ 5000 ])
+    assert complete_within_budget(AI, 1, "a prompt", None) == [ "answer of 5000 tokens" ]
+    AI = BudgetedResponder([ 5000, 5000 ])
+    [answer] = complete_within_budget(AI, 1, "a prompt", MAX_ANSWER_TOKENS // 2)
+    # it is still truncated at the maximum:
+    assert isinstance(answer, TruncatedAnswer)
+    assert AI.asked == [ (1,MAX_ANSWER_TOKENS // 2), (1,MAX_ANSWER_TOKENS) ]
@@ -0,0 +1,80 @@
+#
+# Resuming an interrupted run from its checkpoint must give the same results as an
+# uninterrupted run, without asking or evaluating again what was already done.
+#
+import glob
+import json
+import os
+import pytest
+
+import basicEvaluate
+from openai4spi import PromptResponder, generate_results
+
+class InterruptedResponder(PromptResponder):
+    """
+    Answers with answers that only depend on the prompt; the run is interrupted when it
+    asks more than the given number of prompts.
+    """
+    def __init__(self, model:str="m1", interruptAfter:int=None):
+        PromptResponder.__init__(self)
+        self.model = model
+        self.interruptAfter = interruptAfter
+        self.prompts = []
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        if self.interruptAfter != None and len(self.prompts) >= self.interruptAfter:
+            raise KeyboardInterrupt()
+        self.prompts.append(prompt)
+        return [ f"```python\n    return {len(prompt) % 7} > {k}\n```" for k in range(multipleAnswer) ]
+
+def run(mini:str, AI:PromptResponder, experimentName:str, resume:bool=False) -> list :
+    generate_results(AI, mini, None, experimentName, True, 2, "usePrgDesc", resume=resume)
+    [path] = glob.glob(f"results/{experimentName}_all_usePrgDesc_*.json")
+    with open(path) as fp:
+        return json.load(fp)
+
+def test_resume_answers(mini, results_dir):
+    AI = InterruptedResponder()
+    expected = run(mini, AI, "whole")
+    with pytest.raises(KeyboardInterrupt):
+        run(mini, InterruptedResponder(interruptAfter=3), "interrupted")
+    checkpoint = "results/interrupted_checkpoint_usePrgDesc.jsonl"
+    assert os.path.exists(checkpoint)
+    resumed = InterruptedResponder()
+    assert run(mini, resumed, "interrupted", resume=True) == expected
+    # only the prompts not answered before the interrupt are asked:
+    assert resumed.prompts == AI.prompts[3:]
+    assert not os.path.exists(checkpoint)
+
+def test_resume_evaluations(mini, results_dir, monkeypatch):
+    expected = run(mini, InterruptedResponder(), "whole")
+    evaluated = []
+    interruptAfter = [4]
+    evaluate_task_result = basicEvaluate.evaluate_task_result
+    def interrupting(task, condition):
+        if len(evaluated) == interruptAfter[0]: raise KeyboardInterrupt()
+        evaluated.append((task["task_id"],condition))
+        evaluate_task_result(task, condition)
+    monkeypatch.setattr(basicEvaluate, "evaluate_task_result", interrupting)
+    with pytest.raises(KeyboardInterrupt):
+        run(mini, InterruptedResponder(), "interrupted")
+    done = list(evaluated)
+    evaluated.clear()
+    interruptAfter[0] = None
+    resumed = InterruptedResponder()
+    assert run(mini, resumed, "interrupted", resume=True) == expected
+    # all answers were in, and the evaluated conditions are not evaluated again:
+    assert resumed.prompts == []
+    assert len(evaluated) > 0
+    assert set(evaluated).isdisjoint(done)
+
+def test_resume_refuses_other_settings(mini, results_dir):
+    with pytest.raises(KeyboardInterrupt):
+        run(mini, InterruptedResponder(interruptAfter=3), "interrupted")
+    with pytest.raises(Exception, match="other settings"):
+        run(mini, InterruptedResponder(model="m2"), "interrupted", resume=True)
+    # a run that is not resumed keeps the checkpoint of the interrupted one aside:
+    checkpoint = "results/interrupted_checkpoint_usePrgDesc.jsonl"
+    run(mini, InterruptedResponder(model="m2"), "interrupted")
+    assert os.path.exists(checkpoint + ".1")
+    assert not os.path.exists(checkpoint)
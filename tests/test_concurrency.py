@@ -0,0 +1,68 @@
+#
+# Sending the prompts concurrently must give the same results, in the same order, as sending
+# them one at a time, whatever order the answers come back in.
+#
+import glob
+import hashlib
+import json
+import random
+import threading
+import time
+
+from openai4spi import PromptResponder, generate_results
+
+class SlowResponder(PromptResponder):
+    """
+    Answers each prompt after a random delay, with answers that only depend on the prompt.
+    Keeps the largest number of prompts it was asked at the same time, and the order in
+    which it answered them.
+    """
+    def __init__(self):
+        PromptResponder.__init__(self)
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        self.inflight = 0
+        self.maxInflight = 0
+        self.answered = []
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str]:
+        with self.lock:
+            self.inflight += 1
+            self.maxInflight = max(self.maxInflight, self.inflight)
+            delay = self.random.uniform(0.01, 0.05)
+        time.sleep(delay)
+        digest = hashlib.sha1(prompt.encode()).hexdigest()
+        with self.lock:
+            self.inflight -= 1
+            self.answered.append(prompt)
+        return [ f"```python\n    return True # {digest[:8]} {k}\n```" for k in range(multipleAnswer) ]
+
+def run(mini:str, experimentName:str, concurrency:int) -> tuple :
+    AI = SlowResponder()
+    generate_results(AI, mini, None, experimentName, True, 2, "usePrgDesc", concurrency=concurrency)
+    [path] = glob.glob(f"results/{experimentName}_all_usePrgDesc_*.json")
+    with open(path) as fp:
+        return (AI, json.load(fp))
+
+def test_concurrent_generation_agrees(mini, results_dir):
+    (sequentialAI, sequential) = run(mini, "sequential", 1)
+    (concurrentAI, concurrent) = run(mini, "concurrent", 4)
+    assert sequentialAI.maxInflight == 1
+    assert 1 < concurrentAI.maxInflight <= 4
+    # the answers came back in another order, but are stored in the same:
+    assert concurrentAI.answered != sequentialAI.answered
+    assert sorted(concurrentAI.answered) == sorted(sequentialAI.answered)
+    assert concurrent == sequential
+
+def test_fan_out_keeps_the_order():
+    AI = SlowResponder()
+    AI.maxParallelAnswers = 3
+    def ask(k):
+        return AI.completeIt(1, f"prompt {k}")[0]
+    answers = AI.fanOut(8, ask)
+    assert answers == [ ask(k) for k in range(8) ]
+    assert AI.maxInflight == 3
+    AI.maxParallelAnswers = 1
+    AI.maxInflight = 0
+    assert AI.fanOut(4, ask) == answers[0:4]
+    assert AI.maxInflight == 1
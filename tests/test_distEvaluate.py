@@ -0,0 +1,28 @@
+#
+# The distributed evaluation, with worker daemons on this machine, must give the same results
+# as the sequential one, and report them in the same order.
+#
+import copy
+import json
+import pytest
+
+import basicEvaluate
+import distEvaluate
+
+def test_distributed_evaluation_agrees(answered_tasks):
+    todo = [ (t,c) for t in answered_tasks for c in ["pre","post"] ]
+    sequential = copy.deepcopy(answered_tasks)
+    for (t,c) in todo:
+        basicEvaluate.evaluate_task_result(sequential[t], c)
+    distributed = copy.deepcopy(answered_tasks)
+    reported = []
+    distEvaluate.evaluate_tasks_distributed(distributed, todo, "127.0.0.1", 0, secret="test", localWorkers=2,
+                                            onResult=lambda T,c: reported.append((T["task_id"],c)))
+    dump = lambda tasks: json.dumps(tasks, sort_keys=True, default=str)
+    assert dump(distributed) == dump(sequential)
+    assert reported == todo
+
+def test_secret_required_beyond_loopback(monkeypatch):
+    monkeypatch.delenv("LLM4SPI_EVAL_SECRET", raising=False)
+    with pytest.raises(Exception, match="secret"):
+        distEvaluate.Coordinator("0.0.0.0", 0)
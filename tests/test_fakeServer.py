@@ -0,0 +1,128 @@
+#
+# The OpenAI client, with the rate limiter, the adaptive controller, hedging, and the response
+# cache, against the fake OpenAI-compatible server (fakeOpenAIServer.py).
+#
+import threading
+import time
+import pytest
+
+openai = pytest.importorskip("openai")
+
+from fakeOpenAIServer import FakeOpenAIServer
+from openai4spi import MyOpenAIClient
+from rateLimiter import RateLimiter
+from adaptiveConcurrency import AdaptiveController
+from hedging import HedgingPolicy
+from responseCache import ResponseCache, CachingResponder
+
+PROMPT = "Complete the function:\ndef is_even(x):"
+
+def start_server(**kwargs) -> FakeOpenAIServer :
+    kwargs.setdefault("latency", "fixed:0.01")
+    kwargs.setdefault("throughput", 10000)
+    server = FakeOpenAIServer(port=0, seed=1, **kwargs)
+    server.start()
+    return server
+
+def openai_responder(server:FakeOpenAIServer) -> MyOpenAIClient :
+    # the retries are left to the controller:
+    client = openai.OpenAI(api_key="fake", base_url=server.url, max_retries=0)
+    return MyOpenAIClient(client, "gpt-4o")
+
+@pytest.fixture
+def server():
+    server = start_server()
+    yield server
+    server.close()
+
+def test_answers(server):
+    AI = openai_responder(server)
+    answers = AI.completeIt(3, PROMPT)
+    assert len(answers) == 3
+    assert all([ isinstance(A,str) and A != "" for A in answers ])
+    assert server.stats()["answers"] == 3
+
+def test_rate_limiter_delays_requests(server):
+    AI = openai_responder(server)
+    AI.rateLimiter = RateLimiter(rpm=120)
+    # the budget is shared with other requests, that have taken all of it:
+    AI.rateLimiter.acquire(0, requests=120)
+    t0 = time.monotonic()
+    AI.completeIt(1, PROMPT)
+    # one request is refilled in 0.5s:
+    assert time.monotonic() - t0 >= 0.4
+    assert AI.rateLimiter.waited > 0
+    assert server.stats()["requests"] == 1
+
+def test_rate_limiter_refunds_failed_requests():
+    server = start_server(throttleRate=1, retryAfter=0.01)
+    try:
+        AI = openai_responder(server)
+        AI.rateLimiter = RateLimiter(tpm=100000)
+        AI.controller = AdaptiveController(maxRetries=2)
+        with pytest.raises(openai.RateLimitError):
+            AI.completeIt(1, PROMPT)
+        assert server.stats()["requests"] == 3
+        # every attempt was throttled, so none of them used tokens:
+        assert AI.rateLimiter.tpm.level == pytest.approx(100000)
+    finally:
+        server.close()
+
+def test_controller_retries_throttled_requests():
+    server = start_server(throttleRate=0.3, retryAfter=0.01)
+    try:
+        AI = openai_responder(server)
+        AI.controller = AdaptiveController(initialLimit=4, maxRetries=20)
+        answers = []
+        def ask():
+            answers.append(AI.completeIt(1, PROMPT))
+        threads = [ threading.Thread(target=ask) for k in range(12) ]
+        for T in threads: T.start()
+        for T in threads: T.join()
+        assert len(answers) == 12
+        stats = AI.controller.stats()
+        assert stats["throttled"] > 0
+        assert stats["throttled"] == server.stats()["throttled"]
+        assert stats["retries"] == stats["throttled"]
+        assert AI.controller.inflight == 0
+    finally:
+        server.close()
+
+def test_hedging_slow_requests():
+    server = start_server(latency="exp:0.05")
+    try:
+        AI = openai_responder(server)
+        AI.controller = AdaptiveController()
+        AI.hedging = HedgingPolicy(percentile=50, minSamples=5, maxHedgeRate=0.5)
+        for k in range(30):
+            assert len(AI.completeIt(1, PROMPT)) == 1
+        # wait for the abandoned requests:
+        AI.hedging.pool.shutdown(wait=True)
+        stats = AI.hedging.stats()
+        assert stats["hedged"] > 0
+        assert stats["hedge rate"] <= 0.5
+        assert server.stats()["requests"] == 30 + stats["hedged"]
+        assert AI.controller.inflight == 0
+    finally:
+        server.close()
+
+def test_cache_answers_repeated_prompts(server, tmp_path):
+    AI = CachingResponder(openai_responder(server), ResponseCache(str(tmp_path / "cache.sqlite")))
+    first = AI.completeIt(3, PROMPT)
+    assert server.stats()["answers"] == 3
+    assert AI.completeIt(3, PROMPT) == first
+    assert server.stats()["answers"] == 3
+    # only the answers not in the cache are asked:
+    more = AI.completeIt(5, PROMPT)
+    assert more[:3] == first
+    assert len(more) == 5
+    assert server.stats()["answers"] == 5
+    assert AI.numOfHits == 6
+
+def test_cache_keys_depend_on_the_endpoint(server, tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    A = CachingResponder(openai_responder(server), cache)
+    other = openai.OpenAI(api_key="fake", base_url=server.url.replace("127.0.0.1","localhost"))
+    B = CachingResponder(MyOpenAIClient(other, "gpt-4o"), cache)
+    assert A.promptKey(PROMPT, None) != B.promptKey(PROMPT, None)
+    assert A.promptKey(PROMPT, None) != A.promptKey(PROMPT, 100)
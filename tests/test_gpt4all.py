@@ -0,0 +1,62 @@
+#
+# The GPT4All client, which ingests a prompt once and rewinds the model's context to the end
+# of it for every answer. It needs a GGUF model, given by the environment variable
+# LLM4SPI_TEST_GGUF (any small model will do).
+#
+import os
+import pytest
+
+gpt4all = pytest.importorskip("gpt4all")
+
+import llm4spi
+from openai4spi import TruncatedAnswer
+
+PROMPT = "Write a python function is_even(x) that returns whether x is even.\ndef is_even(x):"
+
+def load(n_ctx:int):
+    modelPath = os.environ.get("LLM4SPI_TEST_GGUF")
+    if modelPath == None:
+        pytest.skip("LLM4SPI_TEST_GGUF is not set")
+    return gpt4all.GPT4All(os.path.basename(modelPath), model_path=os.path.dirname(modelPath), allow_download=False,
+                           device="cpu", n_ctx=n_ctx, verbose=False)
+
+def counting_ingests(AI) -> list :
+    ingests = []
+    ingest = AI.ingest
+    def counting(*args):
+        ingests.append(args)
+        return ingest(*args)
+    AI.ingest = counting
+    return ingests
+
+def test_answers_from_the_rewound_context(monkeypatch):
+    model = load(256)
+    AI = llm4spi.MyGPT4ALL_Client(model)
+    ingests = counting_ingests(AI)
+    answers = AI.completeIt(4, PROMPT, maxTokens=20)
+    assert len(answers) == 4
+    assert len(ingests) == 1
+    # the answers are sampled, not the same answer four times:
+    assert len(set(answers)) > 1
+    # unless the answer ends right away, it is cut off at its first token:
+    assert all([ isinstance(A,TruncatedAnswer) or A == "" for A in AI.completeIt(2, PROMPT, maxTokens=1) ])
+    # greedy answers are those of a fresh chat session:
+    monkeypatch.setitem(llm4spi.GENERATION_PARAMS, "temp", 0.01)
+    monkeypatch.setitem(llm4spi.GENERATION_PARAMS, "top_k", 1)
+    answers = AI.completeIt(2, PROMPT, maxTokens=20)
+    with model.chat_session():
+        expected = model.generate(PROMPT, max_tokens=20, **llm4spi.GENERATION_PARAMS)
+    assert answers == [ expected, expected ]
+
+def test_context_swaps(monkeypatch):
+    model = load(128)
+    AI = llm4spi.MyGPT4ALL_Client(model)
+    ingests = counting_ingests(AI)
+    monkeypatch.setitem(llm4spi.GENERATION_PARAMS, "temp", 0.01)
+    monkeypatch.setitem(llm4spi.GENERATION_PARAMS, "top_k", 1)
+    answers = AI.completeIt(3, "def is_even(x): return x % 2 == 0 " * 2, maxTokens=200)
+    # answers longer than the context make the model swap it, and the prompt is ingested again,
+    # so the next answer starts from the same state:
+    assert len(ingests) > 1
+    assert len(answers) == 3
+    assert answers[0] == answers[1] == answers[2]
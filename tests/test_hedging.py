@@ -0,0 +1,46 @@
+#
+# Hedging slow requests with a duplicate.
+#
+import time
+import pytest
+
+from hedging import HedgingPolicy
+
+def warmed_up() -> HedgingPolicy :
+    """
+    A policy that has seen enough fast requests to hedge the slow ones.
+    """
+    policy = HedgingPolicy(percentile=50, minSamples=5, maxHedgeRate=0.5)
+    for k in range(6):
+        assert policy.call(lambda: time.sleep(0.01) or "fast") == "fast"
+    assert policy.threshold() == pytest.approx(0.01, abs=0.05)
+    assert policy.stats()["hedged"] == 0
+    return policy
+
+def test_the_duplicate_wins():
+    policy = warmed_up()
+    t0 = time.monotonic()
+    answer = policy.call(lambda: time.sleep(0.5) or "slow", usage=lambda answer: 100, duplicate=lambda: "duplicate")
+    assert answer == "duplicate"
+    assert time.monotonic() - t0 < 0.4
+    stats = policy.stats()
+    assert (stats["hedged"], stats["hedge wins"]) == (1,1)
+    # the abandoned request still used its tokens:
+    policy.pool.shutdown(wait=True)
+    assert policy.stats()["wasted tokens"] == 100
+
+def test_failing_duplicate_waits_for_the_request():
+    policy = warmed_up()
+    def duplicate():
+        raise Exception("No room to hedge the request")
+    assert policy.call(lambda: time.sleep(0.2) or "slow", duplicate=duplicate) == "slow"
+    stats = policy.stats()
+    assert (stats["hedged"], stats["hedge wins"]) == (1,0)
+
+def test_hedge_rate_is_bounded():
+    policy = warmed_up()
+    for k in range(10):
+        policy.call(lambda: time.sleep(0.1) or "slow", duplicate=lambda: "duplicate")
+    stats = policy.stats()
+    assert 0 < stats["hedged"] < 10
+    assert stats["hedge rate"] <= 0.5
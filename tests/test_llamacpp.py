@@ -0,0 +1,63 @@
+#
+# Smoke tests of the llama.cpp clients. BatchingServer calls the llama.cpp C API directly,
+# whose names change between versions of llama-cpp-python; these tests catch that when the
+# pinned version (requirements.txt) is bumped. The tests that generate need a GGUF model,
+# given by the environment variable LLM4SPI_TEST_GGUF (any small model will do).
+#
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pytest
+
+llama_cpp = pytest.importorskip("llama_cpp")
+
+from llamacpp4spi import LLAMAcppClient, BatchingServer, LLAMAcppBatchingClient, SAMPLING_PARAMS
+
+# the C API used by BatchingServer:
+C_API = [ "llama_context_params", "llama_init_from_model", "llama_model_get_vocab", "llama_vocab_is_eog",
+          "llama_batch_init", "llama_batch_free", "llama_decode", "llama_free", "llama_kv_cache_seq_rm",
+          "llama_sampler_chain_init", "llama_sampler_chain_default_params", "llama_sampler_chain_add",
+          "llama_sampler_init_penalties", "llama_sampler_init_top_k", "llama_sampler_init_typical",
+          "llama_sampler_init_top_p", "llama_sampler_init_min_p", "llama_sampler_init_temp",
+          "llama_sampler_init_dist", "llama_sampler_sample", "llama_sampler_free" ]
+
+def test_c_api_is_there():
+    missing = [ f for f in C_API if not hasattr(llama_cpp, f) ]
+    assert missing == []
+
+@pytest.fixture(scope="module")
+def llama():
+    modelPath = os.environ.get("LLM4SPI_TEST_GGUF")
+    if modelPath == None:
+        pytest.skip("LLM4SPI_TEST_GGUF is not set")
+    return llama_cpp.Llama(model_path=modelPath, n_ctx=512, verbose=False)
+
+def test_client_answers(llama):
+    AI = LLAMAcppClient(llama)
+    answers = AI.completeIt(3, "def is_even(x):", maxTokens=8)
+    assert len(answers) == 3
+    assert all([ isinstance(A,str) for A in answers ])
+    assert AI.samplingParams() == SAMPLING_PARAMS
+
+def test_batching_server_answers(llama):
+    server = BatchingServer(llama, slots=4, contextPerSlot=128)
+    try:
+        AI = LLAMAcppBatchingClient(server)
+        prompts = [ "def is_even(x):", "def is_odd(x):", "def is_positive(x):" ]
+        # more answers than slots, so that some wait for a free sequence:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            results = list(pool.map(lambda P: AI.completeIt(3, P, maxTokens=8), prompts))
+        for answers in results:
+            assert len(answers) == 3
+            assert all([ isinstance(A,str) for A in answers ])
+        assert AI.samplingParams() == SAMPLING_PARAMS
+        assert server.stats()["decode steps"] > 0
+    finally:
+        server.close()
+
+def test_batching_server_refuses_long_prompts(llama):
+    server = BatchingServer(llama, slots=2, contextPerSlot=16)
+    try:
+        with pytest.raises(ValueError):
+            server.submit("x " * 64, 1, 8).result()
+    finally:
+        server.close()
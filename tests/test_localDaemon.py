@@ -0,0 +1,61 @@
+#
+# The daemon keeping local models loaded, run in a thread of the test. The tests that
+# generate need a GGUF model, given by the environment variable LLM4SPI_TEST_GGUF (any small
+# model will do).
+#
+import threading
+import os
+import pytest
+
+from localDaemon import LocalModelDaemon, LocalDaemonClient, daemon_is_running
+
+@pytest.fixture
+def daemon(tmp_path):
+    """
+    A daemon with a memory budget of 1 MB, stopping once idle.
+    """
+    socketPath = str(tmp_path / "daemon.sock")
+    daemon = LocalModelDaemon(socketPath, 2**20, idleTimeout=0.5)
+    thread = threading.Thread(target=daemon.run, daemon=True)
+    thread.start()
+    yield daemon
+    thread.join(10)
+
+def test_refuses_what_it_cannot_do(daemon, tmp_path):
+    assert daemon_is_running(daemon.socketPath)
+    with open(tmp_path / "large.gguf", "wb") as fp:
+        fp.truncate(2**21)
+    AI = LocalDaemonClient("llamacpp", "large.gguf", str(tmp_path), socketPath=daemon.socketPath, autostart=False)
+    with pytest.raises(Exception, match="does not fit"):
+        AI.completeIt(1, "def f(x):")
+    with pytest.raises(Exception, match="Unknown request"):
+        AI.ask({ "type" : "shutdown" })
+    # the connection is still usable:
+    assert AI.ask({ "type" : "stats" })["stats"]["loads"] == 0
+    with pytest.raises(Exception):
+        LocalModelDaemon(daemon.socketPath, 2**20)
+
+def test_models_stay_loaded(tmp_path):
+    pytest.importorskip("llama_cpp")
+    modelPath = os.environ.get("LLM4SPI_TEST_GGUF")
+    if modelPath == None:
+        pytest.skip("LLM4SPI_TEST_GGUF is not set")
+    socketPath = str(tmp_path / "daemon.sock")
+    daemon = LocalModelDaemon(socketPath, 2**34, idleTimeout=0.5)
+    thread = threading.Thread(target=daemon.run, daemon=True)
+    thread.start()
+    for run in range(2):
+        # as two runs of clispi would:
+        AI = LocalDaemonClient("llamacpp", os.path.basename(modelPath), os.path.dirname(modelPath),
+                               socketPath=socketPath, autostart=False)
+        answers = AI.completeIt(2, "def is_even(x):", maxTokens=8)
+        assert len(answers) == 2
+        (sock,reader) = AI.local.connection
+        reader.close()
+        sock.close()
+    stats = daemon.stats()
+    assert (stats["loads"], stats["prompts"]) == (1,2)
+    thread.join(10)
+    # it stopped once idle:
+    assert not thread.is_alive()
+    assert not os.path.exists(socketPath)
@@ -0,0 +1,71 @@
+#
+# The pool of local model processes. The tests that generate need a GGUF model, given by the
+# environment variable LLM4SPI_TEST_GGUF (any small model will do).
+#
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import pytest
+
+from localPool import LocalPoolResponder, partition_cores
+
+def test_partition_cores():
+    assert partition_cores(2, [0,1,2,3,4]) == [ [0,1,2], [3,4] ]
+    assert partition_cores(3, list(range(6))) == [ [0,1], [2,3], [4,5] ]
+    # fewer cores than workers:
+    assert partition_cores(3, [0,1]) == [ [0], [1], [0] ]
+
+@pytest.fixture
+def gguf() -> str :
+    pytest.importorskip("llama_cpp")
+    modelPath = os.environ.get("LLM4SPI_TEST_GGUF")
+    if modelPath == None:
+        pytest.skip("LLM4SPI_TEST_GGUF is not set")
+    return modelPath
+
+def wait_for(condition, timeout:float=60):
+    t0 = time.monotonic()
+    while not condition():
+        assert time.monotonic() - t0 < timeout
+        time.sleep(0.05)
+
+def test_pool_answers(gguf):
+    pool = LocalPoolResponder("llamacpp", os.path.basename(gguf), os.path.dirname(gguf), 2)
+    try:
+        prompts = [ f"def f{k}(x):" for k in range(6) ]
+        with ThreadPoolExecutor(max_workers=4) as threads:
+            results = list(threads.map(lambda P: pool.completeIt(2, P, maxTokens=8), prompts))
+        assert all([ len(answers) == 2 for answers in results ])
+        assert sum(pool.requestStats()["prompts per local worker"]) == 6
+    finally:
+        pool.close()
+
+def test_prompts_of_a_dead_worker_are_requeued(gguf):
+    pool = LocalPoolResponder("llamacpp", os.path.basename(gguf), os.path.dirname(gguf), 2)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as threads:
+            F = threads.submit(pool.completeIt, 1, "def f(x):", 2000)
+            wait_for(lambda: len(pool.assignedTo) > 0)
+            [k] = pool.assignedTo.values()
+            pool.processes[k].kill()
+            assert len(F.result(timeout=120)) == 1
+        assert pool.requestStats()["prompts requeued"] == 1
+    finally:
+        pool.close()
+
+def test_close_fails_the_prompts_left(gguf):
+    pool = LocalPoolResponder("llamacpp", os.path.basename(gguf), os.path.dirname(gguf), 1)
+    with ThreadPoolExecutor(max_workers=4) as threads:
+        futures = [ threads.submit(pool.completeIt, 1, f"def f{k}(x):", 2000) for k in range(4) ]
+        wait_for(lambda: len(pool.assignedTo) > 0)
+        pool.close()
+        failed = 0
+        for F in futures:
+            try:
+                F.result(timeout=60)
+            except Exception as e:
+                assert "closed" in str(e)
+                failed += 1
+        assert failed > 0
+    with pytest.raises(Exception, match="closed"):
+        pool.completeIt(1, "def g(x):")
@@ -0,0 +1,61 @@
+#
+# Selecting and sharding the tasks of a run, and merging the results of the shards.
+#
+import copy
+import json
+import os
+import pytest
+
+from data import read_problems, select_tasks, shard_tasks
+import basicEvaluate
+from mergeResults import merge_results_dir
+
+def test_select_tasks(mini):
+    tasks = read_problems(mini)
+    assert list(select_tasks(tasks, "HE13,HE1")) == [ "HE1", "HE13" ]
+    assert list(select_tasks(tasks, "re:HE1\\d*")) == [ "HE1", "HE120", "HE13", "HE132" ]
+    assert list(select_tasks(tasks, "re:HE1\\d+ ; HE13")) == [ "HE13" ]
+    sample = select_tasks(tasks, "sample:3:7")
+    assert len(sample) == 3
+    assert sample == select_tasks(tasks, "sample:3:7")
+    with pytest.raises(Exception):
+        select_tasks(tasks, "HE999")
+
+def test_shard_tasks(mini):
+    tasks = read_problems(mini)
+    shards = [ shard_tasks(tasks, f"{i}/2") for i in [1,2] ]
+    assert list(shards[0]) == [ "HE0", "HE120", "HE132" ]
+    assert list(shards[1]) == [ "HE1", "HE13" ]
+    with pytest.raises(Exception):
+        shard_tasks(tasks, "3/2")
+
+def test_merge_shards(answered_tasks, mini, results_dir):
+    for T in answered_tasks.values():
+        for c in ["pre","post"]:
+            basicEvaluate.evaluate_task_result(T, c)
+    fields = [ "task_id" ] + [ f"{c}_condition_{f}" for c in ["pre","post"]
+                               for f in ["completions","candidates_TestResults","ResultsSummary"] ]
+    # the folder of the shards has _all_ in its name too:
+    shardsDir = os.path.join(results_dir, "run_all_shards")
+    os.mkdir(shardsDir)
+    for i in [1,2]:
+        shard = shard_tasks(answered_tasks, f"{i}/2")
+        name = f"mini_shard{i}of2_%s_usePrgDesc_01_01_2025_00_00_0{i}"
+        with open(os.path.join(shardsDir, name % "all" + ".json"), "w") as fp:
+            json.dump([ { f : T[f] for f in fields } for T in shard.values() ], fp)
+        with open(os.path.join(shardsDir, name % "runtime" + ".txt"), "w") as fp:
+            fp.write(f"Total runtime:{10*i}\n")
+    # an earlier merge in the same folder is left out:
+    with open(os.path.join(shardsDir, "mini_all_usePrgDesc_01_01_2025_00_00_00.json"), "w") as fp:
+        json.dump([], fp)
+
+    mergedfile = merge_results_dir(mini, shardsDir)
+    assert os.path.dirname(mergedfile) == "results"
+    with open(mergedfile) as fp:
+        merged = json.load(fp)
+    assert [ R["task_id"] for R in merged ] == list(answered_tasks)
+    assert merged == [ json.loads(json.dumps({ f : T[f] for f in fields })) for T in answered_tasks.values() ]
+    [runtimefile] = [ f for f in os.listdir(results_dir) if f.startswith("mini_runtime_") ]
+    with open(os.path.join(results_dir, runtimefile)) as fp:
+        assert fp.read().split("\n") == [ "Total runtime:30.0", "Total runtime (longest shard):20.0" ]
+    assert any([ f.startswith("mini_evaluation_") for f in os.listdir(results_dir) ])
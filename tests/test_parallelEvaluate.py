@@ -0,0 +1,29 @@
+#
+# The parallel evaluation must give the same results as the sequential one, and report them
+# in the same order.
+#
+import copy
+import json
+import os
+
+import basicEvaluate
+import parallelEvaluate
+
+def shared_blocks() -> set :
+    return set([ f for f in os.listdir("/dev/shm") if f.startswith("psm_") ]) if os.path.isdir("/dev/shm") else set()
+
+def test_parallel_evaluation_agrees(answered_tasks):
+    todo = [ (t,c) for t in answered_tasks for c in ["pre","post"] ]
+    sequential = copy.deepcopy(answered_tasks)
+    for (t,c) in todo:
+        basicEvaluate.evaluate_task_result(sequential[t], c)
+    parallel = copy.deepcopy(answered_tasks)
+    blocks = shared_blocks()
+    reported = []
+    parallelEvaluate.evaluate_tasks_parallel(parallel, todo, 2, lambda T,c: reported.append((T["task_id"],c)))
+    dump = lambda tasks: json.dumps(tasks, sort_keys=True, default=str)
+    assert dump(parallel) == dump(sequential)
+    # also the conditions without anything to evaluate (the pre-condition of HE0) are reported:
+    assert reported == todo
+    # the shared memory blocks of the test suites are released:
+    assert shared_blocks() <= blocks
@@ -0,0 +1,118 @@
+#
+# Round trips of packing several prompts into one (--batch) and splitting the answer, and of
+# splitting the answer to a combined pre/post prompt into the two conditions.
+#
+from data import read_problems
+from openai4spi import PromptResponder, generate_all_completions
+from prompting import create_combined_prompt, create_batched_prompt, split_batched_prompt, split_batched_answer
+from pythonSrcUtils import splitPrePostAnswer
+
+PRE  = "def check_pre_T1(x:int) -> bool:\n    return x > 0"
+POST = "def check_post_T1(r:int, x:int) -> bool:\n    # the result is positive:\n    return r > 0"
+PRE_HEADER  = "def check_pre_T1(x:int) -> bool:"
+POST_HEADER = "def check_post_T1(r:int, x:int) -> bool:"
+
+class HeadersResponder(PromptResponder):
+    """
+    Completes every function header in the prompt, each in its own code block, with a body
+    that returns the number of the header.
+    """
+    def __init__(self):
+        PromptResponder.__init__(self)
+        self.prompts = []
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        self.prompts.append(prompt)
+        headers = [ z.strip() for z in prompt.split("\n") if z.strip().startswith("def ") ]
+        answer = "\n".join([ f"```python\n{H}\n    return {k}\n```" for (k,H) in enumerate(headers) ])
+        return [ answer ] * multipleAnswer
+
+def test_pre_post_answer_in_two_blocks():
+    answer = f"The pre-condition:\n```python\n{PRE}\n```\nThe post-condition:\n```python\n{POST}\n```\n"
+    assert splitPrePostAnswer(answer, PRE_HEADER, POST_HEADER) == (PRE, POST)
+    answer = f"```python\n{POST}\n```\n"
+    assert splitPrePostAnswer(answer, PRE_HEADER, POST_HEADER) == (None, POST)
+
+def test_pre_post_answer_in_one_block():
+    answer = f"Here they are:\n```python\n{POST}\n\n{PRE}\n```\nDone."
+    assert splitPrePostAnswer(answer, PRE_HEADER, POST_HEADER) == (PRE, POST)
+    # without quotes, the whole answer is the code:
+    assert splitPrePostAnswer(f"{PRE}\n{POST}", PRE_HEADER, POST_HEADER) == (PRE, POST)
+    assert splitPrePostAnswer(None, PRE_HEADER, POST_HEADER) == (None, None)
+
+def test_combined_prompts(mini):
+    tasks = read_problems(mini)
+    # HE0 has no pre-condition, and is asked per condition:
+    assert create_combined_prompt(tasks["HE0"], "usePrgDescPrePost") == None
+    prompt = create_combined_prompt(tasks["HE1"], "usePredDescPrePost")
+    assert tasks["HE1"]["pre_condition_incomplete"] in prompt
+    assert tasks["HE1"]["post_condition_incomplete"] in prompt
+
+    AI = HeadersResponder()
+    generate_all_completions(AI, tasks, 2, "usePrgDescPrePost")
+    # one prompt per task, half as many as with usePrgDesc:
+    assert len(AI.prompts) == len(tasks)
+    for T in tasks.values():
+        if T["pre_condition_prompt"] != None:
+            assert T["pre_condition_prompt"] == T["post_condition_prompt"]
+            assert T["pre_condition_completions"] == [ "    return 0" ] * 2
+        assert T["post_condition_completions"] == [ "    return 1" if T["pre_condition_prompt"] != None else "    return 0" ] * 2
+
+PROMPTS = [ "Write a function f(x) that checks x > 0.",
+            "Write a function g(s).\n\nIt checks that s is not empty.",
+            "Write h()." ]
+
+def test_batched_prompt_round_trip():
+    prompt = create_batched_prompt(PROMPTS)
+    assert split_batched_prompt(prompt) == PROMPTS
+    assert split_batched_prompt(PROMPTS[0]) == None
+
+def test_batched_answer_round_trip():
+    answers = [ f"```python\ndef f{i}(x):\n    return x > {i}\n```" for i in range(3) ]
+    answer = "\n".join([ f"### ANSWER {i+1}\n{A}" for (i,A) in enumerate(answers) ])
+    assert split_batched_answer(answer, 3) == answers
+
+def test_batched_answer_lenient_markers():
+    answer = "Sure!\n**ANSWER 1:**\nx > 0\n\n## Answer to task 2\ns != ''\n"
+    assert split_batched_answer(answer, 3) == [ "x > 0", "s != ''", None ]
+    assert split_batched_answer(None, 2) == [ None, None ]
+
+def test_batched_answer_markers_in_code_are_code():
+    first = "```python\ndef f(x):\n# ANSWER 2\n    return x > 0\n```"
+    answer = f"### ANSWER 1\n{first}\n### ANSWER 2\ns != ''"
+    assert split_batched_answer(answer, 2) == [ first, "s != ''" ]
+
+def test_batched_answer_first_marker_wins():
+    answer = "### ANSWER 1\nA\n### ANSWER 1\nB\n### ANSWER 2\nC"
+    assert split_batched_answer(answer, 2) == [ "A", "C" ]
+
+class BatchResponder(HeadersResponder):
+    """
+    Answers each of the prompts packed in a batched prompt, except those containing skip.
+    """
+    def __init__(self, skip:str=None):
+        HeadersResponder.__init__(self)
+        self.skip = skip
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        prompts = split_batched_prompt(prompt)
+        if prompts == None: return HeadersResponder.completeIt(self, multipleAnswer, prompt, maxTokens)
+        self.prompts.append(prompt)
+        answers = [ HeadersResponder().completeIt(1, P)[0] for P in prompts ]
+        answer = "\n".join([ f"### ANSWER {i+1}\n{A}" for (i,A) in enumerate(answers)
+                             if self.skip == None or not (self.skip in prompts[i]) ])
+        return [ answer ] * multipleAnswer
+
+def test_batched_generation(mini):
+    expected = read_problems(mini)
+    generate_all_completions(HeadersResponder(), expected, 2, "usePredDesc")
+    tasks = read_problems(mini)
+    AI = BatchResponder(skip=expected["HE13"]["post_condition_incomplete"])
+    generate_all_completions(AI, tasks, 2, "usePredDesc", batchSize=4)
+    # 9 prompts in 3 batches, and the missing answer asked alone:
+    assert len(AI.prompts) == 3 + 1
+    assert expected["HE13"]["post_condition_prompt"] in AI.prompts
+    for T in tasks.values():
+        for f in ["prompt", "raw_responses", "completions"]:
+            for c in ["pre","post"]:
+                assert T[f"{c}_condition_{f}"] == expected[T["task_id"]][f"{c}_condition_{f}"]
@@ -0,0 +1,53 @@
+#
+# The token buckets of the rate limiter.
+#
+import threading
+import time
+import pytest
+
+from rateLimiter import RateLimiter
+
+def test_requests_wait_for_the_budget():
+    limiter = RateLimiter(rpm=600)
+    assert limiter.tryAcquire(0, requests=600) == 0
+    # one request is refilled in 0.1s:
+    assert limiter.tryAcquire(0) == pytest.approx(0.1, abs=0.02)
+    t0 = time.monotonic()
+    limiter.acquire(0)
+    assert time.monotonic() - t0 >= 0.08
+    assert limiter.waited > 0
+
+def test_all_budgets_are_needed():
+    limiter = RateLimiter(rpm=600, tpm=6000)
+    assert limiter.tryAcquire(5000) == 0
+    # there are requests left, but not tokens:
+    assert limiter.tryAcquire(2000) > 0
+    assert limiter.rpm.level == pytest.approx(599, abs=0.1)
+    # a request larger than the whole budget waits for a full bucket only:
+    assert limiter.tryAcquire(10000) == pytest.approx(5000/100, abs=0.1)
+
+def test_settle_with_the_real_usage():
+    limiter = RateLimiter(tpm=1000)
+    limiter.acquire(500)
+    limiter.settle(500, 800)
+    assert limiter.tpm.level == pytest.approx(200, abs=1)
+    # unknown usage leaves the estimate, a failed request gives it back:
+    limiter.settle(100, None)
+    assert limiter.tpm.level == pytest.approx(200, abs=1)
+    limiter.acquire(100)
+    limiter.settle(100, 0)
+    assert limiter.tpm.level == pytest.approx(200, abs=1)
+
+def test_shared_by_threads():
+    limiter = RateLimiter(rpm=60*50)
+    limiter.tryAcquire(0, requests=60*50)
+    times = []
+    def request():
+        limiter.acquire(0)
+        times.append(time.monotonic())
+    t0 = time.monotonic()
+    threads = [ threading.Thread(target=request) for k in range(10) ]
+    for T in threads: T.start()
+    for T in threads: T.join()
+    # 50 requests per second are refilled:
+    assert max(times) - t0 >= 0.15
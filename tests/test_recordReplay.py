@@ -0,0 +1,93 @@
+#
+# Recording the answers of a run, and replaying them: from the recording, and from the
+# results-file of the run, also with batched prompts.
+#
+import glob
+import gzip
+import json
+import pytest
+
+from openai4spi import PromptResponder, TruncatedAnswer, mark_truncated, generate_results
+from pythonSrcUtils import splitPrePostAnswer
+from recordReplay import RecordingResponder, ReplayResponder, ReplayMiss, read_recording, join_pre_post_answer
+
+class NumberingResponder(PromptResponder):
+    """
+    Completes the function headers in the prompt with bodies numbering the answers it gave,
+    so that asking the same prompt again gives other answers.
+    """
+    def __init__(self):
+        PromptResponder.__init__(self)
+        self.model = "numbering"
+        self.numOfAnswers = 0
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        headers = [ z.strip() for z in prompt.split("\n") if z.strip().startswith("def ") ]
+        answers = []
+        for k in range(multipleAnswer):
+            self.numOfAnswers += 1
+            answers.append("\n".join([ f"```python\n{H}\n    return {self.numOfAnswers} > 0\n```" for H in headers ]))
+        return answers
+
+def run(mini:str, AI:PromptResponder, experimentName:str, prompt_type:str="usePredDesc", batchSize:int=1) -> tuple :
+    generate_results(AI, mini, None, experimentName, True, 2, prompt_type, batchSize=batchSize)
+    [path] = glob.glob(f"results/{experimentName}_all_{prompt_type}_*.json")
+    with open(path) as fp:
+        return (path, json.load(fp))
+
+def test_replay_a_recording(mini, results_dir):
+    AI = RecordingResponder(NumberingResponder(), "results/run.jsonl.gz")
+    (_,recorded) = run(mini, AI, "recorded")
+    AI.close()
+    assert AI.requestStats()["recorded requests"] == 9
+    records = read_recording("results/run.jsonl.gz")
+    assert len(records) == 9
+    assert all([ R["model"] == "numbering" and R["maxTokens"] == None for R in records ])
+    replay = ReplayResponder.load([ "results/run.jsonl.gz" ])
+    (_,replayed) = run(mini, replay, "replayed")
+    assert replayed == recorded
+    assert replay.requestStats()["replayed requests"] == 9
+    with pytest.raises(ReplayMiss):
+        replay.completeIt(1, "def not_recorded(x):")
+
+def test_replay_results_with_batches(mini, results_dir):
+    (resultsfile,expected) = run(mini, NumberingResponder(), "first")
+    replay = ReplayResponder.load([ resultsfile ])
+    # the batched prompts are answered from the answers to the prompts they pack:
+    (_,replayed) = run(mini, replay, "batched", batchSize=4)
+    assert replay.numOfReplayed == 3
+    assert replayed == expected
+
+def test_replay_combined_results(mini, results_dir):
+    (resultsfile,expected) = run(mini, NumberingResponder(), "first", prompt_type="usePredDescPrePost")
+    (_,replayed) = run(mini, ReplayResponder.load([ "results" ]), "replayed", prompt_type="usePredDescPrePost")
+    assert replayed == expected
+
+def test_replay_truncated_answers():
+    cut = mark_truncated("```python\ndef f(x):\n    return", True)
+    records = [ { "model" : "m", "prompt" : "def f(x):", "params" : { "temperature" : 0.7 }, "maxTokens" : 8,
+                  "answers" : [ [cut,True] ], "latency" : 0.1 },
+                { "model" : "m", "prompt" : "def f(x):", "params" : { "temperature" : 0.7 }, "maxTokens" : 16,
+                  "answers" : [ ["```python\ndef f(x):\n    return x > 0\n```",False] ], "latency" : 0.2 } ]
+    replay = ReplayResponder(records)
+    assert replay.samplingParams() == { "temperature" : 0.7 }
+    [answer] = replay.completeIt(1, "def f(x):", maxTokens=8)
+    assert answer == cut and isinstance(answer, TruncatedAnswer)
+    # another maximum gets the complete answer:
+    [answer] = replay.completeIt(1, "def f(x):")
+    assert not isinstance(answer, TruncatedAnswer)
+    assert answer.endswith("x > 0\n```")
+
+def test_read_cut_off_recording(tmp_path):
+    path = str(tmp_path / "cut.jsonl.gz")
+    with gzip.open(path, "wt") as fp:
+        fp.write(json.dumps({ "prompt" : "a" }) + "\n" + json.dumps({ "prompt" : "b" })[0:8])
+    assert read_recording(path) == [ { "prompt" : "a" } ]
+
+def test_join_pre_post_answer():
+    pre  = "def check_pre_T1(x:int) -> bool:\n    return x > 0"
+    post = "def check_post_T1(r:int, x:int) -> bool:\n    return r > 0"
+    headers = [ "def check_pre_T1(x:int) -> bool:", "def check_post_T1(r:int, x:int) -> bool:" ]
+    assert splitPrePostAnswer(join_pre_post_answer(pre, post), *headers) == (pre, post)
+    assert splitPrePostAnswer(join_pre_post_answer(None, post), *headers) == (None, post)
+    assert join_pre_post_answer(None, None) == None
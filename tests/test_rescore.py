@@ -0,0 +1,74 @@
+#
+# Re-scoring the completions stored in a results-file, without asking an AI.
+#
+import copy
+import glob
+import json
+import pytest
+
+from data import read_problems
+import basicEvaluate
+from openai4spi import rescore_results
+
+def write_results(path:str, tasks:dict):
+    fields = [ f"{c}_condition_{f}" for c in ["pre","post"] for f in ["prompt","raw_responses","completions"] ]
+    with open(path, "w") as fp:
+        json.dump([ dict([("task_id",T["task_id"])] + [ (f,T[f]) for f in fields ]) for T in tasks.values() ], fp)
+
+@pytest.fixture
+def resultsfile(results_dir, answered_tasks) -> str :
+    path = f"{results_dir}/mini_all_usePrgDesc_01_01_2025_00_00_00.json"
+    write_results(path, answered_tasks)
+    return path
+
+def rescored(experimentName:str) -> list :
+    [path] = glob.glob(f"results/{experimentName}_all_usePrgDesc_*.json")
+    with open(path) as fp:
+        return json.load(fp)
+
+def test_rescore(mini, answered_tasks, resultsfile):
+    rescore_results(mini, resultsfile)
+    results = rescored("mini_rescored")
+    assert [ R["task_id"] for R in results ] == list(answered_tasks)
+    assert len(glob.glob("results/mini_rescored_evaluation_usePrgDesc_*")) > 0
+    # the same as evaluating the completions right away:
+    for R in results:
+        for c in ["pre","post"]:
+            T = copy.deepcopy(answered_tasks[R["task_id"]])
+            basicEvaluate.evaluate_task_result(T, c)
+            assert R[f"{c}_condition_ResultsSummary"] == T[f"{c}_condition_ResultsSummary"]
+            assert R[f"{c}_condition_candidates_TestResults"] == T[f"{c}_condition_candidates_TestResults"]
+            if T[f"{c}_condition_completions"] != None:
+                # the body of the solution is accepted:
+                assert R[f"{c}_condition_candidates_TestResults"][0]["allsuites-verdict"] == "accepted"
+
+def test_incremental_rescore(mini, resultsfile, monkeypatch):
+    rescore_results(mini, resultsfile, experimentName="full")
+    full = rescored("full")
+    tasks = read_problems(mini)
+    assert all([ R[f"{c}_condition_hash"] == basicEvaluate.task_content_hash(tasks[R["task_id"]], c)
+                 for R in full for c in ["pre","post"] ])
+    # change the tests of a post-condition:
+    changed = list(tasks)[1]
+    tests = tasks[changed]["post_condition_tests"]
+    tasks[changed]["post_condition_tests"] = tests.replace("[['()'],'()'],", "", 1)
+    assert tasks[changed]["post_condition_tests"] != tests
+    with open("changed.json", "w") as fp:
+        json.dump(list(tasks.values()), fp)
+
+    evaluated = []
+    evaluate_task_result = basicEvaluate.evaluate_task_result
+    def counting(task, condition):
+        evaluated.append((task["task_id"],condition))
+        evaluate_task_result(task, condition)
+    monkeypatch.setattr(basicEvaluate, "evaluate_task_result", counting)
+    [fullfile] = glob.glob("results/full_all_*.json")
+    rescore_results("changed.json", fullfile, experimentName="incremental", incremental=True)
+    # only the changed condition is evaluated again:
+    assert evaluated == [ (changed,"post") ]
+    evaluated.clear()
+    rescore_results("changed.json", fullfile, experimentName="again")
+    assert len(evaluated) == 2 * len(tasks)
+    dump = lambda results: json.dumps(results, sort_keys=True)
+    assert dump(rescored("incremental")) == dump(rescored("again"))
+    assert dump(rescored("incremental")) != dump(full)
@@ -0,0 +1,81 @@
+#
+# The persistent cache of answers, with a responder that counts the answers it is asked.
+#
+import pytest
+
+from openai4spi import PromptResponder
+from responseCache import ResponseCache, CachingResponder, CacheMiss
+
+PROMPT = "Complete the function:\ndef is_even(x):"
+
+class CountingResponder(PromptResponder):
+    def __init__(self, model:str="m1"):
+        PromptResponder.__init__(self)
+        self.model = model
+        self.numOfAnswers = 0
+
+    def completeIt(self, multipleAnswer:int, prompt:str, maxTokens:int=None) -> list[str] :
+        answers = [ f"    return x % 2 == 0 # {self.numOfAnswers + k}" for k in range(multipleAnswer) ]
+        self.numOfAnswers += multipleAnswer
+        return answers
+
+@pytest.fixture
+def cache(tmp_path) -> ResponseCache :
+    return ResponseCache(str(tmp_path / "cache.sqlite"))
+
+def test_answers_are_cached(cache):
+    AI = CountingResponder()
+    cached = CachingResponder(AI, cache)
+    first = cached.completeIt(3, PROMPT)
+    assert AI.numOfAnswers == 3
+    assert cached.completeIt(3, PROMPT) == first
+    assert AI.numOfAnswers == 3
+    # only the answers not in the cache are asked:
+    more = cached.completeIt(5, PROMPT)
+    assert more[0:3] == first
+    assert len(set(more)) == 5
+    assert AI.numOfAnswers == 5
+    assert cached.requestStats() == { "cache hits" : 6, "cache misses" : 5 }
+    # another responder with the same model finds them in the same cache file:
+    again = CachingResponder(CountingResponder(), ResponseCache(cache.path), mode="offline")
+    assert again.completeIt(5, PROMPT) == more
+
+def test_cache_modes(cache):
+    AI = CountingResponder()
+    first = CachingResponder(AI, cache).completeIt(2, PROMPT)
+    with pytest.raises(CacheMiss):
+        CachingResponder(AI, cache, mode="offline").completeIt(3, PROMPT)
+    refreshed = CachingResponder(AI, cache, mode="refresh").completeIt(2, PROMPT)
+    assert refreshed != first
+    assert CachingResponder(AI, cache, mode="offline").completeIt(2, PROMPT) == refreshed
+    with pytest.raises(Exception):
+        CachingResponder(AI, cache, mode="sometimes")
+
+def test_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), maxBytes=200)
+    cached = CachingResponder(CountingResponder(), cache)
+    for k in range(10):
+        cached.completeIt(1, f"{PROMPT} {k}")
+    (total,) = cache.connection().execute("SELECT SUM(size) FROM responses").fetchone()
+    assert total <= 200
+    # the most recently used answers are kept:
+    assert len(cache.get([ cached.promptKey(f"{PROMPT} 9", None) + "/0" ])) == 1
+
+def test_keys_depend_on_the_model(cache):
+    A = CachingResponder(CountingResponder("m1"), cache)
+    B = CachingResponder(CountingResponder("m2"), cache)
+    assert A.promptKey(PROMPT, None) != B.promptKey(PROMPT, None)
+    assert A.promptKey(PROMPT, None) == CachingResponder(CountingResponder("m1"), cache).promptKey(PROMPT, None)
+
+def test_keys_of_gemini_models(cache):
+    pytest.importorskip("google.genai")
+    from google4spi import GoogleResponder
+    A = CachingResponder(GoogleResponder(None, "gemini-1.5-flash", None, None, None), cache)
+    B = CachingResponder(GoogleResponder(None, "gemini-2.0-flash", None, None, None), cache)
+    assert A.model == "gemini-1.5-flash"
+    assert A.promptKey(PROMPT, None) != B.promptKey(PROMPT, None)
+
+def test_keys_depend_on_the_max_tokens(cache):
+    A = CachingResponder(CountingResponder(), cache)
+    assert A.promptKey(PROMPT, None) != A.promptKey(PROMPT, 100)
+    assert A.completeIt(1, PROMPT, maxTokens=100) != A.completeIt(1, PROMPT)
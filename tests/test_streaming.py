@@ -0,0 +1,86 @@
+#
+# Streaming an answer and stopping it once its code is complete.
+#
+import pytest
+
+from openai4spi import PromptResponder, TruncatedAnswer
+from pythonSrcUtils import endOfCodeAnswer
+
+CODE = "```python\ndef f(x):\n    return x > 0\n```\n"
+
+def test_end_of_quoted_code():
+    answer = "Here it is:\n" + CODE + "\nThis checks that x is positive.\n"
+    assert answer[0 : endOfCodeAnswer(answer)] == "Here it is:\n" + CODE
+    # the closing fence may still be followed by more of its line:
+    assert endOfCodeAnswer(CODE[0:-1]) == None
+    assert endOfCodeAnswer("```python\ndef f(x):\n") == None
+
+def test_end_of_unquoted_function():
+    function = "def f(x):\n    y = x\n\n    return y > 0\n\n"
+    answer = function + "The function checks that x is positive.\n"
+    assert answer[0 : endOfCodeAnswer(answer)] == function
+    assert endOfCodeAnswer(function) == None
+
+def pieces_of(answer:str, read:list):
+    for k in range(0, len(answer), 5):
+        read.append(answer[k : k+5])
+        yield answer[k : k+5]
+
+def test_stream_stops_at_the_end_of_the_code():
+    AI = PromptResponder()
+    answer = CODE + "\nThis checks that x is positive.\n" * 10
+    read = []
+    assert AI.readStream(pieces_of(answer, read), "def f(x):") == CODE
+    assert len("".join(read)) < len(CODE) + 10
+    AI.stopDetector = None
+    assert AI.readStream(pieces_of(answer, []), "def f(x):") == answer
+
+class FakeGeminiModels:
+    """
+    The models of a fake genai client, streaming the given chunks of text; the last one
+    has the given finish reason.
+    """
+    def __init__(self, texts:list, finishReason):
+        self.texts = texts
+        self.finishReason = finishReason
+        self.closed = False
+
+    def generate_content_stream(self, model:str, contents:str, config):
+        from google.genai import types
+        try:
+            for (k,text) in enumerate(self.texts):
+                reason = self.finishReason if k == len(self.texts)-1 else None
+                yield types.GenerateContentResponse(candidates=[ types.Candidate(
+                          content=types.Content(role="model", parts=[ types.Part(text=text) ]), finish_reason=reason) ])
+        finally:
+            self.closed = True
+
+class FakeGeminiClient:
+    def __init__(self, texts:list, finishReason):
+        self.models = FakeGeminiModels(texts, finishReason)
+
+def test_gemini_stream():
+    pytest.importorskip("google.genai")
+    from google.genai import types
+    from google4spi import GoogleResponder
+    cut = [ "```python\n", "def f(x):\n", "    return" ]
+    AI = GoogleResponder(FakeGeminiClient(cut, types.FinishReason.MAX_TOKENS), "gemini-2.0-flash", None, None, None)
+    AI.streaming = True
+    [answer] = AI.completeIt(1, "def f(x):", maxTokens=10)
+    assert answer == "".join(cut)
+    assert isinstance(answer, TruncatedAnswer)
+    # a complete answer is not read further than its code, and its stream is closed:
+    client = FakeGeminiClient([ CODE, "\nThis checks", " that x is positive.\n" ], types.FinishReason.STOP)
+    AI.client = client
+    [answer] = AI.completeIt(1, "def f(x):")
+    assert answer == CODE
+    assert not isinstance(answer, TruncatedAnswer)
+    assert client.models.closed
+
+def test_end_of_code_of_combined_prompts():
+    prompt = "def check_pre_f(x):\n\ndef check_post_f(r, x):\n"
+    answer = CODE + "and\n" + CODE + "\nDone.\n"
+    assert endOfCodeAnswer(answer, prompt) == len(CODE + "and\n" + CODE)
+    AI = PromptResponder()
+    assert AI.stopSequencesFor(prompt) == None
+    assert AI.stopSequencesFor("def f(x):") == AI.stopSequences
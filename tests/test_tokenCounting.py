@@ -0,0 +1,52 @@
+#
+# Counting tokens locally, and fitting the estimates of requests to their real usage.
+#
+import hashlib
+import os
+import tempfile
+import pytest
+
+from tokenCounting import TokenCounter, heuristic_count, token_counter, openai_tokenizer, gemini_tokenizer, gemini_tokenizer_cached
+
+PROMPT = "Complete the function:\ndef isEven(x:int) -> bool:\n    # x is even\n"
+
+def test_heuristic_count():
+    assert heuristic_count("") == 0
+    # words, the parts of an identifier, digits, and punctuation:
+    assert heuristic_count("is even") == 2
+    assert heuristic_count("isEven(x)") == 5
+    assert heuristic_count("12345") == 2
+    assert 10 <= heuristic_count(PROMPT) <= 30
+
+def test_estimates_learn_from_usage():
+    counter = TokenCounter()
+    prompts = [ PROMPT * k for k in range(1,6) ]
+    assert counter.estimate(prompts[0], 2, 256) == counter.count(prompts[0]) + 2*256 + 1
+    # the provider counts 1.5 tokens where the heuristic counts one, and answers of 100 tokens:
+    for k in range(40):
+        P = prompts[k % 5]
+        N = 1 + k % 3
+        counter.observe(P, N, int(1.5 * counter.count(P)) + 100*N, 256)
+    assert counter.stats()["prompt token factor"] == pytest.approx(1.5, abs=0.1)
+    assert counter.stats()["tokens per answer"] == pytest.approx(100, abs=5)
+    assert counter.estimate(prompts[2], 3, 256) == pytest.approx(1.5 * counter.count(prompts[2]) + 300, rel=0.05)
+
+def test_tokenizers_only_work_offline(tmp_path, monkeypatch):
+    # nothing is cached in an empty folder:
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    assert openai_tokenizer("gpt-4o") == None
+    assert gemini_tokenizer("gemini-2.0-flash") == None
+    assert not token_counter("openAI", "gpt-4o").exact
+    assert not token_counter("gemini", "gemini-2.0-flash").exact
+
+def test_gemini_tokenizer_cache(tmp_path, monkeypatch):
+    loader = pytest.importorskip("google.genai._local_tokenizer_loader")
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    assert not gemini_tokenizer_cached("gemini-2.0-flash")
+    # unknown models have no local tokenizer:
+    assert not gemini_tokenizer_cached("gemini-1.0-pro")
+    url = loader._TOKENIZERS[loader.get_tokenizer_name("gemini-2.0-flash")].model_url
+    os.mkdir(tmp_path / "vertexai_tokenizer_model")
+    (tmp_path / "vertexai_tokenizer_model" / hashlib.sha1(url.encode()).hexdigest()).write_bytes(b"")
+    assert gemini_tokenizer_cached("gemini-2.0-flash")
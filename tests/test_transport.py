@@ -0,0 +1,88 @@
+#
+# The shared HTTP pools of the SDK clients, and the retries they are given, against a local
+# HTTP server.
+#
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import json
+import pytest
+
+from transport import TransportFactory
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Answers every chat-completion, or throttles it if the server is told so.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.numOfRequests += 1
+        self.rfile.read(int(self.headers["Content-Length"]))
+        if self.server.throttle:
+            self.reply(429, { "error" : { "code" : 429, "message" : "slow down", "status" : "RESOURCE_EXHAUSTED" } })
+        else:
+            self.reply(200, { "id" : "1", "object" : "chat.completion", "created" : 0, "model" : "gpt-4o",
+                              "choices" : [ { "index" : 0, "finish_reason" : "stop",
+                                              "message" : { "role" : "assistant", "content" : "    return True" } } ] })
+
+    def reply(self, status:int, body:dict):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("retry-after-ms", "10")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.numOfRequests = 0
+    server.throttle = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def ask_openai(client):
+    return client.chat.completions.create(model="gpt-4o", messages=[ { "role" : "user", "content" : "def f(x):" } ])
+
+def test_openai_clients_share_the_pool(server):
+    pytest.importorskip("openai")
+    transport = TransportFactory(http2=False)
+    url = f"http://127.0.0.1:{server.server_port}/v1"
+    clients = [ transport.openai("fake", base_url=url) for k in range(2) ]
+    for k in range(6):
+        assert ask_openai(clients[k % 2]).choices[0].message.content == "    return True"
+    stats = transport.stats()
+    assert stats["http requests"] == 6
+    assert stats["new connections"] == 1
+    transport.close()
+
+@pytest.mark.parametrize("maxRetries", [ 0, 2 ])
+def test_openai_retries(server, maxRetries):
+    openai = pytest.importorskip("openai")
+    server.throttle = True
+    transport = TransportFactory(http2=False, maxRetries=maxRetries)
+    client = transport.openai("fake", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    with pytest.raises(openai.RateLimitError):
+        ask_openai(client)
+    assert server.numOfRequests == 1 + maxRetries
+    transport.close()
+
+@pytest.mark.parametrize("maxRetries", [ 0, 1 ])
+def test_genai_retries_on_the_shared_pool(server, maxRetries):
+    pytest.importorskip("google.genai")
+    server.throttle = True
+    transport = TransportFactory(http2=False, maxRetries=maxRetries)
+    client = transport.genai("fake")
+    client._api_client._http_options.base_url = f"http://127.0.0.1:{server.server_port}/"
+    with pytest.raises(Exception):
+        client.models.generate_content(model="gemini-2.0-flash", contents="def f(x):")
+    assert server.numOfRequests == 1 + maxRetries
+    # the requests went through the shared pool, which counted them:
+    assert transport.stats()["http requests"] == 1 + maxRetries
+    transport.close()